@@ -1,7 +1,15 @@
-from .core import Docker
+from .configs import Settings
+from .core import Batch, BuildService, Docker
 
 
 def main():
+    settings = Settings()
+    if settings.args.serve:
+        BuildService().serve()
+        return
+    if Batch.applies(settings.args.configs):
+        Batch().build()
+        return
     docker = Docker()
     docker.build()
 
@@ -5,9 +5,13 @@ from abc import ABC
 __all__ = ['Constants']
 
 
+# Compiled patterns are shared by every instance
+_cache = {}
+
+
 class Constants(ABC):
     def __init__(self):
         self.IS_WINDOWS_PLATFORM = (sys.platform == 'win32')
         self._SEP = re.compile('/|\\\\') if self.IS_WINDOWS_PLATFORM else re.compile('/')
-        self._cache = {}
+        self._cache = _cache
         self._MAXCACHE = 100
\ No newline at end of file
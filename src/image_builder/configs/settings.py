@@ -1,37 +1,97 @@
 import argparse
+import contextvars
 import json
+import os
 from abc import ABC
+from contextlib import contextmanager
 
 __all__ = ['Settings']
 
 
+# Arguments of the build running in the current context (serve mode jobs,
+# batch configs): an argv to parse instead of sys.argv, and parsed values
+# to replace. An override without argv keeps the enclosing one's.
+_override = contextvars.ContextVar('settings_override', default=(None, {}))
+
+
 class Settings(ABC):
     def __init__(self):
         self.args = self.get_arg()
 
+    @classmethod
+    @contextmanager
+    def override(cls, argv=None, **values):
+        if argv is None:
+            argv, outer = _override.get()
+            values = dict(outer, **values)
+        token = _override.set((list(argv) if argv is not None else None, values))
+        try:
+            yield
+        finally:
+            _override.reset(token)
+
     def get_arg(self):
         self.parser = argparse.ArgumentParser()
         self.parser.add_argument('--opts', type=json.loads, help='Set script arguments')
         self.parser.add_argument('--log_level', choices=('debug', 'info', 'warning', 'error', 'critical'), default='info', const='info', nargs='?', required=False, help='Set script log level of verbosity')
-        self.parser.add_argument('config', type=str, default='default', help="Location of build YAML file")
+        self.parser.add_argument('--log_format', choices=('text', 'json'), default='text', required=False, help='Log as colored text or as JSON lines')
+        self.parser.add_argument('--log_sample', type=int, default=20, required=False, help='Log the first N messages of high-volume categories, then one in every N (0 logs all)')
+        self.parser.add_argument('config', type=str, default=['default'], nargs='*', help="Location of build YAML files, or directories of them")
         self.parser.add_argument('--push', action='store_true', default=False, required=False, help="Push images to repositoy")
         self.parser.add_argument('--pull', action='store_true', default=False, required=False, help="Pull images from repositoy")
         self.parser.add_argument('--local', action='store_true', default=False, required=False, help="build all images locally")
         self.parser.add_argument('--nocache', action='store_true', default=False, required=False, help="build using cache")
+        self.parser.add_argument('--multistage', action='store_true', default=False, required=False, help="Build the image chain as one multi-stage Dockerfile")
+        self.parser.add_argument('--matrix_workers', type=int, default=2, required=False, help="Number of matrix variants to build concurrently")
+        self.parser.add_argument('--config_workers', type=int, default=4, required=False, help="Number of configs of a batch to build concurrently")
+        self.parser.add_argument('--engine', choices=('sync', 'async'), default='sync', required=False, help="Drive concurrent builds from threads or from one asyncio event loop, which also pulls, tags and pushes")
+        self.parser.add_argument('--cache_from', action='store_true', default=False, required=False, help="Use previously pushed tags of each image as build cache")
+        self.parser.add_argument('--cache_workers', type=int, default=4, required=False, help="Number of cache images to pull concurrently")
+        self.parser.add_argument('--daemon', action='append', required=False, help="Docker daemon URL to build on (repeat for a pool of daemons)")
+        self.parser.add_argument('--registry_ttl', type=int, default=300, required=False, help="Seconds to trust cached registry digests (0 disables the cache)")
         self.parser.add_argument('--repository', type=str, default='', required=False, help="Repository to push to")
         self.parser.add_argument('--save', type=str, required=False, help="Location to save image")
+        self.parser.add_argument('--save_compression', choices=('none', 'gzip', 'zstd'), default='gzip', required=False, help="Compression for saved images")
+        self.parser.add_argument('--load_cache', type=str, required=False, help="Load saved image archives (file or directory) before pulling")
+        self.parser.add_argument('--save_mode', choices=('image', 'bundle'), default='image', required=False, help="Save one archive per image or one layer-deduplicated archive per config")
+        self.parser.add_argument('--save_workers', type=int, default=2, required=False, help="Number of images to save concurrently")
+        self.parser.add_argument('--minimal_context', action='store_true', default=False, required=False, help="Send only the paths referenced by COPY/ADD as the build context")
+        self.parser.add_argument('--context_report', type=int, const=10, nargs='?', required=False, help="Report build context sizes, largest paths and unreferenced paths (top N) instead of building")
+        self.parser.add_argument('--context_warning', type=int, default=500, required=False, help="Warn when a build context exceeds this size in MiB (0 disables)")
+        self.parser.add_argument('--resume', action='store_true', default=False, required=False, help="Skip images, tags and pushes recorded as completed in the run journal")
+        self.parser.add_argument('--watch', action='store_true', default=False, required=False, help="Keep running and rebuild the images affected by file changes")
+        self.parser.add_argument('--watch_debounce', type=float, default=0.5, required=False, help="Seconds without changes before a watch rebuild starts")
+        self.parser.add_argument('--serve', type=str, const=f"unix://{os.environ.get('XDG_RUNTIME_DIR') or '/tmp'}/image-builder.sock", nargs='?', required=False, help="Run as a build service accepting jobs on 'unix:///path.sock' (default: $XDG_RUNTIME_DIR/image-builder.sock) or over HTTP on host:port")
+        self.parser.add_argument('--serve_workers', type=int, default=2, required=False, help="Number of service jobs to build concurrently")
+        self.parser.add_argument('--plan', type=str, const='-', nargs='?', required=False, help="Write the execution plan (pull, skip or build per image, context sizes, pushes, estimated time) as JSON to a file or '-' for stdout, without building")
         self.parser.add_argument('--dryrun', action='store_true', default=False, required=False, help='Execute as a dry run')
         self.parser.add_argument('--gzip', action='store_true', default=False, required=False, help='Compress context files')
+        self.parser.add_argument('--reproducible', action='store_true', default=False, required=False, help='Send byte-identical contexts for identical trees: members sorted, mtimes set to --source_date_epoch, owned by root')
+        self.parser.add_argument('--source_date_epoch', type=int, default=int(os.environ.get('SOURCE_DATE_EPOCH') or 0), required=False, help='Mtime of every context member with --reproducible (default: $SOURCE_DATE_EPOCH or 0)')
         self.parser.add_argument('--overwrite', action='store_true', default=False, required=False, help='Overwrite existing build files and images')
         self.parser.add_argument('--show', action='store_true', default=False, required=False, help='Show Dockerfiles on console')
         self.parser.add_argument('--rm_build_files', action='store_true', default=False, required=False, help='Remove build files')
         self.parser.add_argument('-f', '--force', action='store_true', default=False, required=False, help='Force a command without checks')
         self.parser.add_argument('-rmi', '--rm_inter_imgs', action='store_true', default=False, required=False, help='Remove intermediary images')
+        self.parser.add_argument('--metrics_file', type=str, required=False, help='Write Prometheus metrics to a textfile collector file')
+        self.parser.add_argument('--metrics_port', type=int, required=False, help='Serve Prometheus metrics on this port during the run')
+        self.parser.add_argument('--profile', choices=('cprofile', 'sampling'), const='cprofile', nargs='?', required=False, help='Profile the build pipeline per phase')
+        self.parser.add_argument('--profile_top', type=int, default=25, required=False, help='Number of hot functions to report when profiling')
+        self.parser.add_argument('--profile_memory', action='store_true', default=False, required=False, help='Report peak memory with tracemalloc when profiling')
         #self.parser.add_argument('-s, --save', type=str, required=False, help="Location to save image")
         
-        args, unknown = self.parser.parse_known_args()
+        argv, values = _override.get()
+        args, unknown = self.parser.parse_known_args(argv)
         if unknown:
             print("Unknown arguments " + str(unknown))
 
-        self.args = self.parser.parse_args()
+        self.args = self.parser.parse_args(argv)
+        # One config per build; several (or a directory) are built as a batch
+        self.args.configs = list(self.args.config or ['default'])
+        self.args.config = self.args.configs[0]
+        # Planning never changes the filesystem, daemon or registry
+        if self.args.plan:
+            self.args.dryrun = True
+        for name, value in values.items():
+            setattr(self.args, name, value)
         return self.args
\ No newline at end of file
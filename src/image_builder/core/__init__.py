@@ -1,2 +1,12 @@
+from .archive import Archive
+from .context import ContextCache, ContextStream
+from .daemons import DaemonPool
+from .engine import AsyncDocker
+from .history import TimingHistory
+from .journal import Journal
+from .registry import RegistryCache
+from .watch import Watcher
 from .docker import Docker
-from .operations import Operations
\ No newline at end of file
+from .operations import Operations
+from .batch import Batch
+from .service import BuildService
\ No newline at end of file
@@ -0,0 +1,334 @@
+import gzip
+import importlib.util
+import json
+import os
+import re
+import tarfile
+import threading
+from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from datetime import datetime
+from queue import Queue
+from time import time
+
+import docker
+import requests
+
+from ..configs import Settings
+from ..internal import Logging, OperationError
+
+__all__ = ['Archive']
+
+
+# Chunks read from the daemon and the number of chunks that may wait for the
+# compressor; together they bound the memory used by a single export.
+CHUNK_SIZE = 2 * 1024 * 1024
+QUEUE_DEPTH = 8
+
+EXTENSIONS = {
+    'none': '.tar',
+    'gzip': '.tar.gz',
+    'zstd': '.tar.zst',
+}
+
+INDEX_NAME = 'image-builder-index.json'
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+BLOCK_SIZE = tarfile.BLOCKSIZE
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+
+
+def append_tar_member(chunks, name, data):
+    """Yield the tar stream from chunks with an extra member appended.
+
+    Member headers are parsed on the fly so the extra member can be placed
+    before the end-of-archive marker without buffering the archive.
+    """
+    buf = bytearray()
+    skip = 0
+    ended = False
+    for chunk in chunks:
+        if ended:
+            continue
+        buf += chunk
+        pos = 0
+        while True:
+            if skip:
+                step = min(skip, len(buf) - pos)
+                pos += step
+                skip -= step
+                if skip:
+                    break
+            if len(buf) - pos < BLOCK_SIZE:
+                break
+            header = bytes(buf[pos:pos + BLOCK_SIZE])
+            if header == ZERO_BLOCK:
+                ended = True
+                break
+            size = tarfile.nti(header[124:136])
+            pos += BLOCK_SIZE
+            skip = -(-size // BLOCK_SIZE) * BLOCK_SIZE
+        if pos:
+            yield bytes(buf[:pos])
+            del buf[:pos]
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time())
+    info.mode = 0o644
+    yield info.tobuf(format=tarfile.USTAR_FORMAT)
+    yield data + bytes(-len(data) % BLOCK_SIZE)
+    yield ZERO_BLOCK * 2
+
+
+class Archive(ABC):
+    def __init__(self, base_url, name=None, tracer=None):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        self.base_url = base_url
+        self.name = name or 'images'
+        self.tracer = tracer
+        self.directory = self.settings.args.save
+        self.mode = self.settings.args.save_mode
+        self.bundle = {}
+        self.compression = self.settings.args.save_compression
+        if self.compression == 'zstd' and importlib.util.find_spec('zstandard') is None:
+            self.logger.warning("zstandard is not installed, saving images with gzip")
+            self.compression = 'gzip'
+        self.executor = ThreadPoolExecutor(max_workers=self.settings.args.save_workers)
+        self.futures = {}
+
+    def filename(self, reference):
+        name = re.sub(r'[/:@]', '_', reference)
+        return os.path.join(self.directory, f"{name}{EXTENSIONS.get(self.compression)}")
+
+    def open_writer(self, raw):
+        if self.compression == 'gzip':
+            return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6)
+        elif self.compression == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(threads=-1).stream_writer(raw, closefd=False)
+        return raw
+
+    def write(self, chunks, path):
+        """Stream chunks to path, compressing on a separate thread.
+
+        The queue is bounded, so a slow disk or compressor applies back pressure
+        to the daemon read instead of buffering the image in memory.
+        """
+        queue = Queue(maxsize=QUEUE_DEPTH)
+        errors = []
+        written = [0]
+        done = [False]
+        tmp_path = f"{path}.part"
+
+        def compress():
+            try:
+                with open(tmp_path, 'wb') as raw:
+                    writer = self.open_writer(raw)
+                    while True:
+                        chunk = queue.get()
+                        if chunk is None:
+                            done[0] = True
+                            break
+                        writer.write(chunk)
+                    if writer is not raw:
+                        writer.close()
+                    written[0] = raw.tell()
+            except Exception as err:
+                errors.append(err)
+                # Keep draining so the reader never blocks on a full queue
+                while not done[0] and queue.get() is not None:
+                    pass
+
+        compressor = threading.Thread(target=compress, daemon=True)
+        compressor.start()
+        read = 0
+        try:
+            for chunk in chunks:
+                read += len(chunk)
+                queue.put(chunk)
+        except Exception as err:
+            # The daemon stream broke off (e.g. ChunkedEncodingError)
+            errors.insert(0, err)
+        finally:
+            queue.put(None)
+            compressor.join()
+        if errors:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise OperationError(f"failed to write '{path}': {errors[0]}")
+        os.replace(tmp_path, path)
+        return read, written[0]
+
+    def export(self, reference, base_url=None):
+        path = self.filename(reference)
+        client = docker.APIClient(base_url=base_url or self.base_url)
+        try:
+            if self.tracer:
+                with self.tracer.span('save', reference) as counters:
+                    counters['bytes'], counters['written'] = self.write(client.get_image(reference, chunk_size=CHUNK_SIZE), path)
+            else:
+                self.write(client.get_image(reference, chunk_size=CHUNK_SIZE), path)
+        except (docker.errors.APIError, requests.exceptions.RequestException) as err:
+            raise OperationError(f"failed to export '{reference}': {err}")
+        finally:
+            client.close()
+        return path
+
+    def save_images(self, client, references):
+        """Yield the raw archive of references saved by one request."""
+        if len(references) == 1:
+            return client.get_image(references[0], chunk_size=CHUNK_SIZE)
+        # docker-py only saves single images; the multi-name save goes through
+        # the client's requests session
+        res = client.get(f"{client.base_url}/v{client.api_version}/images/get", params={'names': references}, stream=True)
+        if res.status_code >= 400:
+            raise docker.errors.APIError(f"{res.status_code} {res.reason}", response=res)
+        return res.iter_content(CHUNK_SIZE)
+
+    def export_bundle(self, references, base_url=None, name=None):
+        """Save all references with a single multi-name request.
+
+        The daemon writes every shared layer once; an index of the contained
+        tags is appended to the archive as INDEX_NAME.
+        """
+        path = self.filename(name or f"{self.name}.bundle")
+        client = docker.APIClient(base_url=base_url or self.base_url)
+        try:
+            index = {
+                'name': self.name,
+                'created': datetime.now().isoformat(),
+                'images': [],
+            }
+            for reference in references:
+                index['images'].append({
+                    'reference': reference,
+                    'id': client.inspect_image(reference).get("Id"),
+                })
+            chunks = append_tar_member(
+                self.save_images(client, references),
+                INDEX_NAME,
+                json.dumps(index, indent=4).encode('utf-8'),
+            )
+            if self.tracer:
+                with self.tracer.span('save', None, images=len(references)) as counters:
+                    counters['bytes'], counters['written'] = self.write(chunks, path)
+            else:
+                self.write(chunks, path)
+        except (docker.errors.APIError, requests.exceptions.RequestException) as err:
+            raise OperationError(f"failed to export bundle '{path}': {err}")
+        finally:
+            client.close()
+        return path
+
+    def read(self, path):
+        """Yield the decompressed contents of an archive in chunks."""
+        with open(path, 'rb') as raw:
+            magic = raw.read(4)
+            raw.seek(0)
+            if magic.startswith(GZIP_MAGIC):
+                reader = gzip.GzipFile(fileobj=raw, mode='rb')
+            elif magic == ZSTD_MAGIC:
+                try:
+                    import zstandard
+                except ImportError:
+                    raise OperationError(f"zstandard is required to load: '{path}'")
+                reader = zstandard.ZstdDecompressor().stream_reader(raw)
+            else:
+                reader = raw
+            chunk = reader.read(CHUNK_SIZE)
+            while chunk:
+                yield chunk
+                chunk = reader.read(CHUNK_SIZE)
+
+    def import_archive(self, path):
+        loaded = []
+        client = docker.APIClient(base_url=self.base_url)
+        try:
+            with self.tracer.span('load', None, archive=path) if self.tracer else nullcontext() as counters:
+                for line in client.load_image(self.read(path)):
+                    if line.get("errorDetail"):
+                        raise OperationError(f"failed to load '{path}': {line.get('errorDetail').get('message')}")
+                    stream = (line.get("stream") or "").strip()
+                    if stream.startswith("Loaded image"):
+                        loaded.append(stream.split(": ", 1)[-1])
+                if counters is not None:
+                    counters['images'] = len(loaded)
+                    counters['bytes'] = os.path.getsize(path)
+        except docker.errors.APIError as err:
+            raise OperationError(f"failed to load '{path}': {err}")
+        finally:
+            client.close()
+        return loaded
+
+    def load(self, path):
+        """Load saved archives from a file or directory into the daemon."""
+        if os.path.isdir(path):
+            paths = sorted(
+                os.path.join(path, f) for f in os.listdir(path)
+                if f.endswith(tuple(EXTENSIONS.values()))
+            )
+        elif os.path.isfile(path):
+            paths = [path]
+        else:
+            self.logger.error(f"cache path does not exist: '{path}'")
+            return []
+        if self.settings.args.dryrun:
+            for p in paths:
+                self.logger.info(f"Dry run: loading image archive: '{p}'")
+            return []
+        loaded = []
+        futures = {p: self.executor.submit(self.import_archive, p) for p in paths}
+        for p, future in futures.items():
+            try:
+                images = future.result()
+            except OperationError as err:
+                self.logger.error(f"{err}")
+                continue
+            for image in images:
+                self.logger.info(f"loaded image: '{image}' from '{p}'")
+            loaded.extend(images)
+        return loaded
+
+    def submit(self, reference, tags=None, base_url=None):
+        references = [reference] + [t for t in (tags or []) if t != reference]
+        if self.mode == 'bundle':
+            # Images built on other daemons are bundled per daemon
+            bundle = self.bundle.setdefault(base_url or self.base_url, [])
+            bundle.extend([r for r in references if r not in bundle])
+            return
+        if self.settings.args.dryrun:
+            self.logger.info(f"Dry run: saving image: '{reference}' to '{self.filename(reference)}'")
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self.logger.info(f"saving image: '{reference}'")
+        self.futures[reference] = self.executor.submit(self.export, reference, base_url)
+
+    def wait(self):
+        success = True
+        bundles, self.bundle = self.bundle, {}
+        for i, (base_url, references) in enumerate(bundles.items()):
+            name = f"{self.name}.bundle" if i == 0 else f"{self.name}.bundle{i}"
+            if self.settings.args.dryrun:
+                self.logger.info(f"Dry run: saving {len(references)} images to '{self.filename(name)}'")
+            else:
+                os.makedirs(self.directory, exist_ok=True)
+                self.logger.info(f"saving {len(references)} images to a single archive")
+                self.futures[name] = self.executor.submit(self.export_bundle, references, base_url, name)
+        for reference, future in self.futures.items():
+            try:
+                self.logger.info(f"saved image: '{reference}' to '{future.result()}'")
+            except OperationError as err:
+                self.logger.error(f"{err}")
+                success = False
+            except Exception as err:
+                # Called from the build's finally; never hide its result
+                self.logger.error(f"failed to save '{reference}': {err}")
+                success = False
+        self.futures = {}
+        return success
+
+    def close(self):
+        self.executor.shutdown(wait=True)
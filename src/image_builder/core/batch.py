@@ -0,0 +1,171 @@
+import contextvars
+import glob
+import os
+import threading
+from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+
+from ..configs import Settings
+from ..internal import Logging, Metrics
+from .context import ContextCache
+from .docker import Docker
+from .plan import Planner
+
+__all__ = ['Batch']
+
+
+class Batch(ABC):
+    """Build several configs as one run.
+
+    Every config is planned first and the images are merged by docker path:
+    an image with the same path and cache key in several configs is built
+    once, by the first config defining it. The configs then build together
+    (``--config_workers`` at a time) with shared caches, daemon pool and
+    metrics; a config waits for the shared parents it skipped.
+    """
+    def __init__(self, configs=None, caches=None):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        self.configs = self.expand(configs or self.settings.args.configs)
+        # Warm caches and metrics of a service are reused
+        self.caches = dict(caches or {})
+        self.owns_context = self.caches.get("context") is None
+        self.caches.setdefault("context", ContextCache())
+        self.caches.setdefault("registry", {})
+        self.caches.setdefault("pools", {})
+        self.caches.setdefault("timings", {})
+        if self.caches.get("metrics") is None:
+            self.caches['metrics'] = Metrics()
+        self.builders = {}
+        self.owners = {}
+        self.shared = {}
+        self.events = {}
+        self.failed = set()
+        self.build_success = True
+
+    @classmethod
+    def applies(cls, configs):
+        return len(configs) > 1 or any([os.path.isdir(c) for c in configs])
+
+    @classmethod
+    def expand(cls, configs):
+        """Config files, with directories replaced by the YAML files they hold."""
+        paths = []
+        for config in configs:
+            if os.path.isdir(config):
+                paths.extend(sorted(glob.glob(os.path.join(config, "*.yaml")) + glob.glob(os.path.join(config, "*.yml"))))
+            else:
+                paths.append(config)
+        return list(dict.fromkeys([os.path.abspath(p) for p in paths]))
+
+    def plan(self):
+        for config in self.configs:
+            self.logger.info(f"planning config: '{config}'")
+            with Settings.override(config=config), Logging.job(config):
+                try:
+                    builder = Docker(caches=self.caches)
+                    builder.plan()
+                except SystemExit:
+                    self.logger.error(f"failed to plan config: '{config}'")
+                    self.build_success = False
+                    continue
+            self.builders[config] = builder
+            self.merge(config, builder)
+
+    def merge(self, config, builder):
+        # Images already owned by an earlier config are dropped from this one
+        shared = []
+        for job in builder.jobs:
+            owner = self.owners.get(job.get("path"))
+            if owner is None:
+                self.owners[job.get("path")] = (config, job.get("key"))
+                self.events[job.get("path")] = threading.Event()
+            elif owner[1] == job.get("key"):
+                self.logger.info(f"'{job.get('path')}' is built by config: '{owner[0]}'")
+                shared.append(job)
+            else:
+                self.logger.error(f"'{job.get('path')}' is defined differently in '{owner[0]}' and '{config}'")
+                self.build_success = False
+        builder.jobs = [job for job in builder.jobs if job not in shared]
+        builder.built_listeners.append(lambda job: self.events.get(job.get("path")).set())
+        self.shared[config] = [job.get("path") for job in shared]
+
+    def run(self, config):
+        builder = self.builders.get(config)
+        for path in self.shared.get(config):
+            self.events.get(path).wait()
+            if path in self.failed:
+                self.logger.error(f"not building config '{config}': '{path}' failed in '{self.owners.get(path)[0]}'")
+                builder.build_success = False
+                self.release(config, builder)
+                return False
+        with Settings.override(config=config), Logging.job(config):
+            try:
+                builder.build(planned=True)
+            except SystemExit:
+                builder.build_success = False
+            finally:
+                self.release(config, builder)
+                self.logger.close_logs(config)
+        if not builder.build_success:
+            self.logger.error(f"config failed: '{config}'")
+        return builder.build_success
+
+    def release(self, config, builder):
+        # Unblock configs waiting on images this one never produced
+        for path, (owner, _) in self.owners.items():
+            if owner != config or self.events.get(path).is_set():
+                continue
+            if not builder.build_success:
+                self.failed.add(path)
+            self.events.get(path).set()
+
+    def order(self):
+        """Configs longest critical path first, each after the configs owning its shared images."""
+        lengths = {c: max(b.critical_paths(b.jobs).values(), default=0.0) for c, b in self.builders.items()}
+        pending = list(self.builders)
+        ordered = []
+        while pending:
+            ready = [c for c in pending if all([self.owners.get(p)[0] in ordered for p in self.shared.get(c)])]
+            config = max(ready, key=lambda c: lengths.get(c))
+            ordered.append(config)
+            pending.remove(config)
+        return ordered
+
+    def write_plan(self):
+        plans = []
+        for config, builder in self.builders.items():
+            with Settings.override(config=config), Logging.job(config):
+                plan = Planner(builder).plan()
+            plan['shared'] = self.shared.get(config)
+            plans.append(plan)
+        planner = Planner()
+        planner.write({
+            'configs': plans,
+            'summary': planner.summary([i for p in plans for i in p.get("images")]),
+        })
+
+    def build(self):
+        self.logger.info(f"building {len(self.configs)} configs: {self.configs}")
+        try:
+            self.plan()
+            if not self.build_success:
+                self.logger.error("not building: planning failed")
+                return
+            total = sum([len(b.jobs) for b in self.builders.values()]) + sum([len(s) for s in self.shared.values()])
+            self.logger.info(f"{len(self.owners)} unique images of {total} in {len(self.builders)} configs")
+            if self.settings.args.plan:
+                self.write_plan()
+                return
+            # Owners are always submitted earlier, so they start first
+            with ThreadPoolExecutor(max_workers=max(1, self.settings.args.config_workers)) as executor:
+                futures = [executor.submit(contextvars.copy_context().run, self.run, config) for config in self.order()]
+                results = [future.result() for future in futures]
+            self.build_success = all(results)
+            self.logger.info(f"built {results.count(True)} of {len(results)} configs")
+        finally:
+            for config in self.configs:
+                self.logger.close_logs(config)
+            if self.owns_context:
+                self.caches.get("context").clear()
@@ -0,0 +1,546 @@
+import errno
+import fnmatch
+import grp
+import gzip
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import pwd
+import stat
+import struct
+import tarfile
+import tempfile
+import threading
+from abc import ABC
+from contextlib import nullcontext
+
+from rich import box
+from rich.console import Console
+from rich.table import Table
+
+from ..configs import Constants
+from ..helpers import PatternMatcher
+from ..internal import Logging
+
+__all__ = ['ContextCache', 'ContextReport', 'ContextStream']
+
+
+CHUNK_SIZE = 1024 * 1024
+BLOCK_SIZE = tarfile.BLOCKSIZE
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+# Files at least this large are copied into the body by the kernel
+KERNEL_COPY_SIZE = 64 * 1024
+# ustar header: name, mode, uid, gid, size, mtime, checksum, type, linkname,
+# magic and version, uname, gname, devmajor, devminor, prefix
+USTAR_HEADER = struct.Struct('100s8s8s8s12s12s8s1s100s8s32s32s8s8s155s12x')
+MEMBER_TYPES = {
+    stat.S_IFREG: tarfile.REGTYPE,
+    stat.S_IFDIR: tarfile.DIRTYPE,
+    stat.S_IFLNK: tarfile.SYMTYPE,
+    stat.S_IFIFO: tarfile.FIFOTYPE,
+    stat.S_IFCHR: tarfile.CHRTYPE,
+    stat.S_IFBLK: tarfile.BLKTYPE,
+}
+# copy_file_range and sendfile fail with these where a pair of files doesn't
+# support them; the copy then falls back to reading and writing
+UNSUPPORTED_COPY = {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+
+def human_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == 'B' else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+class ContextStream(ABC):
+    """A build context made of a shared tar body followed by a per-image trailer.
+
+    Behaves like a readable file with a known length, so it can be passed as
+    the build fileobj and is sent with a Content-Length header. Reproducible
+    contexts carry the sha256 digest of their bytes.
+    """
+    def __init__(self, body_path, body_size, trailer, digest=None):
+        self.body = open(body_path, 'rb') if body_size else None
+        self.body_size = body_size
+        self.trailer = io.BytesIO(trailer)
+        self.size = body_size + len(trailer)
+        self.digest = digest
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        chunk = self.read(CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = self.read(CHUNK_SIZE)
+
+    def read(self, size=-1):
+        data = b''
+        if self.body is not None:
+            data = self.body.read(size)
+            if size < 0 or len(data) < size:
+                self.body.close()
+                self.body = None
+        if size < 0:
+            return data + self.trailer.read()
+        if len(data) < size:
+            data += self.trailer.read(size - len(data))
+        return data
+
+    def close(self):
+        if self.body is not None:
+            self.body.close()
+            self.body = None
+
+
+class TarWriter(ABC):
+    """Tar members from lstat results, without the end-of-archive marker.
+
+    Headers are packed into one preallocated block and owner names are looked
+    up once per uid and gid. Into a file descriptor, headers are batched and
+    file data is copied by the kernel (``copy_file_range``, else
+    ``sendfile``); into a file object such as a compressor it goes through one
+    reused buffer. Mtimes are whole seconds, as the docker CLI sends them.
+    Members a ustar header can't hold get a pax header from tarfile.
+
+    With an epoch every member gets that mtime and root ownership, without
+    owner names, so the bytes only depend on paths, modes and contents.
+    """
+    def __init__(self, fileobj=None, fd=None, windows=False, epoch=None):
+        self.fileobj = fileobj
+        self.fd = fd
+        self.windows = windows
+        self.epoch = epoch
+        self.header = bytearray(BLOCK_SIZE)
+        self.buffer = bytearray(CHUNK_SIZE)
+        self.pending = bytearray()
+        self.users = {}
+        self.groups = {}
+        self.inodes = {}
+        self.copies = [c for c in ['copy_file_range', 'sendfile'] if hasattr(os, c)]
+
+    def owner(self, uid, gid):
+        if uid not in self.users:
+            try:
+                self.users[uid] = pwd.getpwuid(uid)[0]
+            except KeyError:
+                self.users[uid] = ''
+        if gid not in self.groups:
+            try:
+                self.groups[gid] = grp.getgrgid(gid)[0]
+            except KeyError:
+                self.groups[gid] = ''
+        return self.users.get(uid), self.groups.get(gid)
+
+    def add(self, name, path, st):
+        """Write the member for the file at path; False when it can't be archived."""
+        kind = MEMBER_TYPES.get(stat.S_IFMT(st.st_mode))
+        if kind is None:
+            # Sockets are skipped
+            return False
+        size = 0
+        linkname = ''
+        if kind == tarfile.REGTYPE:
+            inode = (st.st_ino, st.st_dev)
+            if st.st_nlink > 1 and self.inodes.get(inode, name) != name:
+                kind = tarfile.LNKTYPE
+                linkname = self.inodes.get(inode)
+            else:
+                size = st.st_size
+                if st.st_ino:
+                    self.inodes[inode] = name
+        elif kind == tarfile.SYMTYPE:
+            linkname = os.readlink(path)
+        elif kind == tarfile.DIRTYPE:
+            name += '/'
+        mode = st.st_mode & 0o7777
+        if self.windows:
+            # Windows doesn't keep track of the execute bit, so we make files
+            # and directories executable by default.
+            mode = mode & 0o755 | 0o111
+        device = (os.major(st.st_rdev), os.minor(st.st_rdev)) if kind in (tarfile.CHRTYPE, tarfile.BLKTYPE) else None
+        if self.epoch is not None:
+            self.write_header(name, mode, 0, 0, size, self.epoch, kind, linkname, device=device)
+        else:
+            uname, gname = self.owner(st.st_uid, st.st_gid)
+            self.write_header(name, mode, st.st_uid, st.st_gid, size, int(st.st_mtime), kind, linkname, uname, gname, device)
+        if size:
+            self.write_data(path, size)
+        return True
+
+    def write_header(self, name, mode, uid, gid, size, mtime, kind, linkname='', uname='', gname='', device=None):
+        fits = (
+            len(name) <= 100 and len(linkname) <= 100 and len(uname) <= 32 and len(gname) <= 32
+            and (name + linkname + uname + gname).isascii()
+            and 0 <= uid < 8**7 and 0 <= gid < 8**7 and size < 8**11 and 0 <= mtime < 8**11
+        )
+        if not fits:
+            info = tarfile.TarInfo(name)
+            info.mode, info.uid, info.gid, info.size, info.mtime, info.type = mode, uid, gid, size, mtime, kind
+            info.linkname, info.uname, info.gname = linkname, uname, gname
+            if device:
+                info.devmajor, info.devminor = device
+            self.write(info.tobuf(tarfile.PAX_FORMAT, tarfile.ENCODING, 'surrogateescape'))
+            return
+        USTAR_HEADER.pack_into(
+            self.header, 0,
+            name.encode('ascii'), b'%07o\0' % mode, b'%07o\0' % uid, b'%07o\0' % gid,
+            b'%011o\0' % size, b'%011o\0' % mtime, b'        ', kind, linkname.encode('ascii'),
+            tarfile.POSIX_MAGIC, uname.encode('ascii'), gname.encode('ascii'),
+            b'%07o\0' % device[0] if device else b'', b'%07o\0' % device[1] if device else b'', b'',
+        )
+        # The checksum is taken with its own field set to spaces
+        self.header[148:155] = b'%06o\0' % sum(self.header)
+        self.write(self.header)
+
+    def write_data(self, path, size):
+        with open(path, 'rb') as f:
+            copied = 0
+            if self.fd is not None and size >= KERNEL_COPY_SIZE:
+                self.flush()
+                copied = self.kernel_copy(f.fileno(), size)
+            view = memoryview(self.buffer)
+            while copied < size:
+                n = f.readinto(view[:min(len(view), size - copied)])
+                if not n:
+                    break
+                self.write(view[:n])
+                copied += n
+        if copied < size:
+            raise IOError(f"file shrank while archiving: {path}")
+        self.write(ZERO_BLOCK[:-size % BLOCK_SIZE])
+
+    def kernel_copy(self, src, size):
+        # Returns the bytes copied; the rest is read and written by the caller
+        copied = 0
+        while copied < size and self.copies:
+            try:
+                if self.copies[0] == 'copy_file_range':
+                    n = os.copy_file_range(src, self.fd, size - copied)
+                else:
+                    n = os.sendfile(self.fd, src, None, size - copied)
+            except OSError as err:
+                if err.errno not in UNSUPPORTED_COPY:
+                    raise
+                self.copies.pop(0)
+                continue
+            if not n:
+                break
+            copied += n
+        return copied
+
+    def write(self, data):
+        if self.fd is None:
+            self.fileobj.write(data)
+            return
+        self.pending += data
+        if len(self.pending) >= CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.fd is None or not self.pending:
+            return
+        view = memoryview(self.pending)
+        while view:
+            view = view[os.write(self.fd, view):]
+        view.release()
+        self.pending.clear()
+
+
+class ContextCache(ABC):
+    """Walk and tar each context directory once per run.
+
+    The tar body (every context file, without the end-of-archive marker) is
+    kept in a temporary file; each image only adds a small trailer holding its
+    Dockerfile and the end-of-archive blocks. The body is written by a
+    TarWriter from the stat results of the walk.
+
+    With ``revalidate`` the bodies outlive a run (serve mode): after
+    ``expire()`` a body is re-walked and reused only if the stat fingerprint
+    of its files is unchanged.
+
+    A context built with an ``epoch`` is reproducible: the same tree always
+    gives the same bytes (members sorted by path, normalized mtimes and
+    ownership, gzip headers without name or time) and its digest is kept.
+    """
+    def __init__(self, tracer=None, revalidate=False):
+        self.constants = Constants()
+        self.logger = Logging()
+
+        self.tracer = tracer
+        self.revalidate = revalidate
+        self.generation = 0
+        self.bodies = {}
+        self._lock = threading.Lock()
+        self._key_locks = {}
+
+    def walk(self, root, exclude, stats=None, dirs=None):
+        # The generated Dockerfile is always sent as 'Dockerfile' in the trailer
+        patterns = list(exclude or [])
+        patterns.append('!Dockerfile')
+        return sorted(PatternMatcher(patterns).walk(root, stats, dirs))
+
+    def write_body(self, root, files, gzip_body, stats, epoch=None):
+        f = tempfile.NamedTemporaryFile()
+        windows = self.constants.IS_WINDOWS_PLATFORM
+        if gzip_body:
+            # Neither the temporary file name nor the time goes in the gzip header
+            raw = gzip.GzipFile(filename='', fileobj=f, mode='wb', mtime=0)
+            writer = TarWriter(raw, windows=windows, epoch=epoch)
+        else:
+            writer = TarWriter(fd=f.fileno(), windows=windows, epoch=epoch)
+        with self.logger.sampling():
+            for path in files:
+                self.logger.sample('context', logging.DEBUG, "adding to context: '%s'", path)
+                full_path = os.path.join(root, path)
+                try:
+                    writer.add(path, full_path, stats[path])
+                except IOError:
+                    raise IOError(
+                        'Can not read file in context: {}'.format(full_path)
+                    )
+            writer.flush()
+            self.logger.summary('context')
+        self.logger.debug(f"added {len(files)} paths to context: '{root}'")
+        # No end-of-archive marker on purpose: it belongs to the per-image
+        # trailer.
+        if gzip_body:
+            raw.close()
+        f.flush()
+        return f, f.tell()
+
+    def fingerprint(self, files, stats):
+        digest = hashlib.sha256()
+        for path in files:
+            st = stats[path]
+            digest.update(f"{path}\0{st.st_mtime_ns}\0{st.st_size}\0{st.st_mode}\n".encode('utf-8', 'surrogateescape'))
+        return digest.hexdigest()
+
+    def expire(self):
+        # Bodies are checked against the filesystem before their next use
+        with self._lock:
+            self.generation += 1
+
+    def traced_walk(self, tracer, root, exclude, image, stats):
+        with tracer.span('walk', image) if tracer else nullcontext({}) as counters:
+            files = self.walk(root, exclude, stats)
+            counters['files'] = len(files)
+        return files
+
+    def digest(self, f):
+        digest = hashlib.sha256()
+        with open(f.name, 'rb') as body:
+            for chunk in iter(lambda: body.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest
+
+    def body(self, root, exclude=None, gzip_body=False, image=None, tracer=None, epoch=None):
+        root = os.path.abspath(root)
+        key = (root, tuple(exclude or []), bool(gzip_body), epoch)
+        tracer = tracer or self.tracer
+        # The cache lock only guards the lookup: different contexts are walked
+        # and tarred concurrently, while images sharing one wait on its lock
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                cached = self.bodies.get(key)
+                generation = self.generation
+            files = None
+            stats = {}
+            if cached is not None and self.revalidate and cached.get("generation") != generation:
+                files = self.traced_walk(tracer, root, exclude, image, stats)
+                if files == cached.get("files") and self.fingerprint(files, stats) == cached.get("fingerprint"):
+                    cached['generation'] = generation
+                else:
+                    self.logger.debug(f"context changed: '{root}'")
+                    with self._lock:
+                        if self.bodies.get(key) is cached:
+                            self.bodies.pop(key)
+                    cached.get("file").close()
+                    cached = None
+            if cached is not None:
+                self.logger.debug(f"reusing walked context: '{root}'")
+                return cached
+            if files is None:
+                files = self.traced_walk(tracer, root, exclude, image, stats)
+            with tracer.span('tar', image) if tracer else nullcontext({}) as counters:
+                f, size = self.write_body(root, files, gzip_body, stats, epoch)
+                counters['bytes'] = size
+            body = {
+                'file': f,
+                'size': size,
+                'files': files,
+                'stats': stats,
+                'generation': generation,
+                'fingerprint': self.fingerprint(files, stats) if self.revalidate else None,
+                'digest': self.digest(f) if epoch is not None else None,
+            }
+            with self._lock:
+                self.bodies[key] = body
+            return body
+
+    def trailer(self, dockerfile, extra_files=None, gzip_trailer=False, epoch=None):
+        buf = io.BytesIO()
+        t = tarfile.open(mode='w', fileobj=buf)
+        for name, contents in extra_files or []:
+            info = tarfile.TarInfo(name)
+            contents_encoded = contents.encode('utf-8')
+            info.size = len(contents_encoded)
+            info.mtime = epoch or 0
+            t.addfile(info, io.BytesIO(contents_encoded))
+        dfinfo = tarfile.TarInfo('Dockerfile')
+        dfinfo.size = len(dockerfile)
+        dfinfo.mtime = epoch or 0
+        t.addfile(dfinfo, io.BytesIO(dockerfile))
+        t.close()
+        # Concatenated gzip members decompress as one stream
+        return gzip.compress(buf.getvalue(), mtime=0) if gzip_trailer else buf.getvalue()
+
+    def context(self, root, dockerfile, exclude=None, gzip_context=False, extra_files=None, image=None, tracer=None, epoch=None):
+        body = self.body(root, exclude, gzip_context, image=image, tracer=tracer, epoch=epoch)
+        trailer = self.trailer(dockerfile, extra_files, gzip_context, epoch)
+        digest = None
+        if body.get("digest") is not None:
+            context_digest = body.get("digest").copy()
+            context_digest.update(trailer)
+            digest = f"sha256:{context_digest.hexdigest()}"
+        return ContextStream(body.get("file").name, body.get("size"), trailer, digest)
+
+    def invalidate(self, root):
+        root = os.path.abspath(root)
+        with self._lock:
+            for key in [k for k in self.bodies if k[0] == root]:
+                self.bodies.pop(key).get("file").close()
+
+    def clear(self):
+        with self._lock:
+            for body in self.bodies.values():
+                body.get("file").close()
+            self.bodies = {}
+
+
+class ContextReport(ABC):
+    """Size breakdown of a build context and the paths no COPY/ADD uses.
+
+    ``files`` is the output of ContextCache.walk and ``stats`` the lstat
+    results it collected; ``sources`` are the local COPY/ADD sources of every
+    image built from the context.
+    """
+    def __init__(self, root, files, stats, sources=None, keep=None, top=10):
+        self.root = root
+        self.top = top
+        self.sources = [s.rstrip("/") or "." for s in sources or []]
+        self.keep = set(keep or [])
+        self.sizes = {}
+        self.dirs = {}
+        for path in files:
+            st = stats[path]
+            if stat.S_ISDIR(st.st_mode):
+                self.dirs.setdefault(path, 0)
+                continue
+            self.sizes[path] = st.st_size
+            parent = posixpath.dirname(path)
+            while parent:
+                self.dirs[parent] = self.dirs.get(parent, 0) + st.st_size
+                parent = posixpath.dirname(parent)
+
+    def total(self):
+        return sum(self.sizes.values())
+
+    def largest_files(self):
+        return sorted(self.sizes.items(), key=lambda i: i[1], reverse=True)[:self.top]
+
+    def largest_dirs(self):
+        return sorted(self.dirs.items(), key=lambda i: i[1], reverse=True)[:self.top]
+
+    def referenced(self, path):
+        if path in self.keep:
+            return True
+        for src in self.sources:
+            if src == ".":
+                return True
+            # The path itself, anything below it, or a parent of a source
+            if path == src or path.startswith(src + "/") or src.startswith(path + "/"):
+                return True
+            parent = path
+            while parent:
+                if fnmatch.fnmatchcase(parent, src):
+                    return True
+                parent = posixpath.dirname(parent)
+        return False
+
+    def suggestions(self):
+        """Return (path, bytes) of the shallowest fully unreferenced paths."""
+        children = {}
+        for path in list(self.sizes) + list(self.dirs):
+            children.setdefault(posixpath.dirname(path), []).append(path)
+
+        usage = {}
+
+        def used(path):
+            if usage.get(path) is None:
+                usage[path] = self.referenced(path) or any([used(c) for c in children.get(path, [])])
+            return usage.get(path)
+
+        found = []
+
+        def visit(parent):
+            for path in sorted(children.get(parent, [])):
+                if not used(path):
+                    found.append((path, self.sizes.get(path, self.dirs.get(path, 0))))
+                elif path in self.dirs and not self.referenced(path):
+                    visit(path)
+        visit("")
+        return sorted(found, key=lambda i: i[1], reverse=True)
+
+    def as_dict(self):
+        suggestions = self.suggestions()
+        return {
+            'root': self.root,
+            'files': len(self.sizes),
+            'bytes': self.total(),
+            'unreferenced_bytes': sum(size for _, size in suggestions),
+            'largest_files': [{'path': p, 'bytes': b} for p, b in self.largest_files()],
+            'largest_dirs': [{'path': p, 'bytes': b} for p, b in self.largest_dirs()],
+            'dockerignore': [{'path': p, 'bytes': b} for p, b in suggestions],
+        }
+
+    def tables(self, images=None):
+        report = self.as_dict()
+        summary = Table(title=f"Build context: '{self.root}'", box=box.SIMPLE)
+        summary.add_column("Images")
+        summary.add_column("Files", justify="right")
+        summary.add_column("Size", justify="right")
+        summary.add_column("Unreferenced", justify="right")
+        summary.add_row(
+            "\n".join(images or []),
+            str(report['files']),
+            human_size(report['bytes']),
+            human_size(report['unreferenced_bytes']),
+        )
+        tables = [summary]
+        for title, key in [
+            (f"Largest files (top {self.top})", 'largest_files'),
+            (f"Largest directories (top {self.top})", 'largest_dirs'),
+            ("Not referenced by COPY/ADD (suggested .dockerignore entries)", 'dockerignore'),
+        ]:
+            if not report[key]:
+                continue
+            table = Table(title=title, box=box.SIMPLE)
+            table.add_column("Path")
+            table.add_column("Size", justify="right")
+            for entry in report[key][:self.top] if key == 'dockerignore' else report[key]:
+                table.add_row(entry['path'], human_size(entry['bytes']))
+            tables.append(table)
+        return tables
+
+    def show(self, images=None):
+        console = Console()
+        for table in self.tables(images):
+            console.print(table)
@@ -0,0 +1,107 @@
+import threading
+from abc import ABC
+from contextlib import nullcontext
+
+import docker
+
+from ..internal import Logging, OperationError
+
+__all__ = ['Daemon', 'DaemonPool']
+
+
+class Daemon(ABC):
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.client = docker.APIClient(base_url=base_url)
+        self.load = 0
+        self.assigned = 0
+        self.images = set()
+
+    def connect(self):
+        # Concurrent builds each use their own connection
+        return docker.APIClient(base_url=self.base_url)
+
+    def has_image(self, reference):
+        if reference in self.images:
+            return True
+        try:
+            self.client.inspect_image(reference)
+        except docker.errors.APIError:
+            return False
+        self.images.add(reference)
+        return True
+
+
+class DaemonPool(ABC):
+    """Assign builds to a pool of Docker daemons.
+
+    A build goes to the least loaded daemon, preferring one that already has
+    its parent image, so a chain sticks to one daemon while idle daemons pick
+    up concurrent builds. Parents are moved over through the registry.
+    """
+    def __init__(self, base_urls, tracer=None):
+        self.logger = Logging()
+
+        self.tracer = tracer
+        self.daemons = [Daemon(url) for url in dict.fromkeys(base_urls)]
+        self.primary = self.daemons[0]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.daemons)
+
+    def owner(self, reference):
+        for daemon in self.daemons:
+            if daemon.has_image(reference):
+                return daemon
+        return None
+
+    def acquire(self, parent=None):
+        # Looking for the parent takes a round trip per daemon, so it runs
+        # before the lock, which only guards the load accounting
+        holders = set(id(d) for d in self.daemons if parent and len(self.daemons) > 1 and d.has_image(parent))
+        with self._lock:
+            # Least loaded first; among equals, prefer a daemon with the parent
+            daemon = min(self.daemons, key=lambda d: (d.load, id(d) not in holders, d.assigned))
+            daemon.load += 1
+            daemon.assigned += 1
+        if len(self.daemons) > 1:
+            self.logger.info(f"scheduled on daemon: '{daemon.base_url}' (load {daemon.load})")
+        return daemon
+
+    def release(self, daemon, image=None):
+        with self._lock:
+            daemon.load -= 1
+            if image:
+                daemon.images.add(image)
+
+    def record(self, daemon, image):
+        with self._lock:
+            daemon.images.add(image)
+
+    def transfer(self, reference, daemon):
+        """Make reference available on daemon by pushing it from its owner."""
+        if not reference or daemon.has_image(reference):
+            return False
+        owner = self.owner(reference)
+        if owner is None:
+            # Not built here; the daemon pulls it from the registry on FROM
+            return False
+        repository, _, tag = reference.rpartition(":")
+        self.logger.info(f"transferring image: '{reference}' from '{owner.base_url}' to '{daemon.base_url}'")
+        with self.tracer.span('transfer', reference, source=owner.base_url, target=daemon.base_url) if self.tracer else nullcontext():
+            try:
+                for line in owner.client.push(repository, tag, stream=True, decode=True):
+                    if line.get("error"):
+                        raise OperationError(f"failed to push '{reference}': {line.get('error')}")
+                for line in daemon.client.pull(repository, tag, stream=True, decode=True):
+                    if line.get("error"):
+                        raise OperationError(f"failed to pull '{reference}': {line.get('error')}")
+            except docker.errors.APIError as err:
+                raise OperationError(f"failed to transfer '{reference}': {err}")
+        self.record(daemon, reference)
+        return True
+
+    def close(self):
+        for daemon in self.daemons:
+            daemon.client.close()
@@ -1,13 +1,18 @@
+import asyncio
+import contextvars
 import grp
+import logging
 import itertools
 import io
 import json
 import os
 import sys
 import pwd
-import tarfile
-import tempfile
+import re
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from pathlib import Path
 from time import time
 from typing import List
 
@@ -18,16 +23,28 @@ from rich.table import Table
 from tqdm import trange
 
 from ..configs import Constants, Settings
-from ..helpers import InputOutput, PatternMatcher
+from ..helpers import DockerfileParser, InputOutput, PatternMatcher
 from ..internal import (
     Logging,
+    Metrics,
+    Profiler,
+    Tracer,
     BuildError,
     OperationError
 )
+from .archive import Archive
+from .context import ContextCache, ContextReport, human_size
+from .daemons import DaemonPool
+from .engine import AsyncDocker
+from .history import TimingHistory
+from .journal import Journal
+from .plan import Planner
+from .registry import RegistryCache
+from .watch import Watcher
 from .operations import Operations
 
 
-__all__ = ['PushStatus', 'Docker']
+__all__ = ['PushStatus', 'BuildState', 'Docker']
 
 
 class PushStatus(ABC):
@@ -42,8 +59,12 @@ class PushStatus(ABC):
         self.pbar = {}
         self.transfer_tracker = {}
         self.time_tracker = {}
+        self.layer_bytes = {}
 
     def store(self, progress):
+        detail = progress.get("progressDetail") or {}
+        if progress.get("status") in ["Pushing", "Downloading"] and detail.get("current"):
+            self.layer_bytes[progress.get("id")] = max(self.layer_bytes.get(progress.get("id"), 0), detail.get("current"))
         for status in self.tracker:
             if status.get("id") != None:
                 self.layer[status.get("id")] = None
@@ -252,27 +273,87 @@ class PushStatus(ABC):
     def set_image(self, name):
         self.image = name
 
+    def transferred(self):
+        return sum(self.layer_bytes.values())
 
 
 
+
+class BuildState(ABC):
+    """Progress of one daemon build.
+
+    Concurrent builds (matrix variants) each keep their own, so stream
+    parsing never mixes containers, stages or results of different builds.
+    """
+    def __init__(self, client):
+        self.client = client
+        self.console_output = {}
+        self.status_test = {}
+        self.intermediate_container = None
+        self.stage_images = {}
+        self.current_stage = None
+
+
 class Docker(ABC):
-    def __init__(self):
+    def __init__(self, caches=None):
         self.constants = Constants()
         self.logger = Logging()
         self.io = InputOutput()
         self.ops = Operations()
         self.settings = Settings()
+        self.tracer = Tracer()
+        # Serve mode jobs and batch configs share warm caches, daemon pools
+        # and metrics; a single config run owns its own
+        self.shared_caches = caches is not None
+        caches = caches if caches is not None else {}
+        self.metrics = caches.get("metrics") or Metrics()
+        self.tracer.listeners.append(self.metrics.observe_span)
         
-        self.cli = docker.APIClient(base_url='unix://var/run/docker.sock')
+        # The first daemon of the pool also pulls, tags and saves
+        daemons = self.settings.args.daemon or self.ops.configs.get("info").get("daemons") or ['unix://var/run/docker.sock']
+        pools = caches.setdefault("pools", {})
+        if self.settings.args.plan:
+            # Planning is offline: a client would query the daemon's version
+            self.pool = None
+            self.base_url = daemons[0]
+            self.cli = None
+        else:
+            if pools.get(tuple(daemons)) is None:
+                pools[tuple(daemons)] = DaemonPool(daemons, tracer=self.tracer)
+            self.pool = pools.get(tuple(daemons))
+            self.base_url = self.pool.primary.base_url
+            self.cli = self.pool.primary.client
+            self.logger.debug(self.cli.version())
+        self.archive = Archive(self.base_url, name=self.ops.configs.get("info").get("name"), tracer=self.tracer)
         self.term = {}
-        self.logger.debug(self.cli.version())
         self.errors = docker.errors
         self.build_success = True
         self.pull_order = None
         self.pulled_image = None
-        self.console_output = {}
-        self.status_test = {}
-        self.out_stream = str()
+        # {index: reference} of every image the pull search found
+        self.pulled_images = {}
+        self.jobs = []
+        # Called with each job once its image exists (built or resumed)
+        self.built_listeners = []
+        self.context_cache = caches.get("context") or ContextCache(tracer=self.tracer)
+        self.context_cache.expire()
+        self.context_warned = set()
+        registry_path = self.ops.build_dir.joinpath('registry_cache.json').as_posix()
+        registries = caches.setdefault("registry", {})
+        registry_key = (registry_path, self.base_url, self.settings.args.registry_ttl, self.settings.args.dryrun)
+        if registries.get(registry_key) is None:
+            registries[registry_key] = RegistryCache(registry_path, self.base_url, tracer=self.tracer)
+        self.registry = registries.get(registry_key)
+        self.journal = Journal(
+            self.ops.project_build_dir.joinpath('journal.jsonl').as_posix(),
+            resume=self.settings.args.resume or bool(self.settings.args.plan),
+            enabled=not self.settings.args.dryrun,
+        )
+        timings_path = self.ops.build_dir.joinpath('timings.json').as_posix()
+        timings = caches.setdefault("timings", {})
+        if timings.get(timings_path) is None:
+            timings[timings_path] = TimingHistory(timings_path, enabled=not self.settings.args.dryrun)
+        self.timings = timings.get(timings_path)
 
     def _copy_from_line(self, image_count: int, from_image:str, from_files: List) -> None:
         if from_files is None:
@@ -294,6 +375,125 @@ class Docker(ABC):
             self.dockerfile_image_lines[image_count].append(from_line)
             self.dockerfile_image_lines[image_count].append(from_line)
 
+    def local_image(self, reference):
+        try:
+            self.cli.inspect_image(reference)
+            return True
+        except self.errors.ImageNotFound:
+            return False
+        except self.errors.APIError as err:
+            self.logger.debug(f"docker api error: {err}")
+            return False
+
+    def local_digest(self, reference, digest):
+        # True when the local image was pulled or pushed at this manifest digest
+        repository = reference.rsplit(":", 1)[0]
+        try:
+            repo_digests = self.cli.inspect_image(reference).get("RepoDigests") or []
+        except self.errors.APIError:
+            return False
+        return f"{repository}@{digest}" in repo_digests
+
+    def pull_cache_images(self, image, references, base_url=None):
+        """Pull references concurrently and return those usable as cache_from."""
+        base_url = base_url or self.base_url
+
+        def fetch(reference):
+            client = docker.APIClient(base_url=base_url)
+            try:
+                client.inspect_image(reference)
+                return reference
+            except self.errors.ImageNotFound:
+                pass
+            finally:
+                client.close()
+            if self.settings.args.local:
+                return None
+            repository, tag = reference.rsplit(":", 1)
+            client = docker.APIClient(base_url=base_url)
+            try:
+                for line in client.pull(repository, tag, stream=True, decode=True):
+                    if line.get("error"):
+                        self.logger.debug(f"cache image not pulled: '{reference}': {line.get('error')}")
+                        return None
+                return reference
+            except self.errors.NotFound:
+                self.logger.debug(f"cache image not found: '{reference}'")
+            except self.errors.APIError as a_err:
+                self.logger.debug(f"cache image not pulled: '{reference}': {a_err}")
+            finally:
+                client.close()
+            return None
+
+        if self.settings.args.dryrun:
+            self.logger.info(f"Dry run: pulling cache images: {references}")
+            return []
+        if self.settings.args.engine == 'async':
+            return asyncio.run(self.async_pull_cache_images(AsyncDocker(base_url), image, references))
+        with self.tracer.span('cache_from', image) as counters:
+            with ThreadPoolExecutor(max_workers=self.settings.args.cache_workers) as executor:
+                found = [r for r in executor.map(fetch, references) if r]
+            counters['images'] = len(found)
+        for reference in found:
+            self.logger.info(f"using cache from: '{reference}'")
+        return found
+
+    async def async_pull_cache_images(self, engine, image, references):
+        """pull_cache_images through the async engine, from one event loop."""
+        limit = asyncio.Semaphore(self.settings.args.cache_workers)
+
+        async def fetch(reference):
+            async with limit:
+                try:
+                    if await engine.inspect(reference) is not None:
+                        return reference
+                    if self.settings.args.local:
+                        return None
+                    repository, tag = reference.rsplit(":", 1)
+                    async for line in engine.pull(repository, tag):
+                        if line.get("error"):
+                            self.logger.debug(f"cache image not pulled: '{reference}': {line.get('error')}")
+                            return None
+                    return reference
+                except self.errors.NotFound:
+                    self.logger.debug(f"cache image not found: '{reference}'")
+                except (self.errors.APIError, OperationError, OSError) as err:
+                    self.logger.debug(f"cache image not pulled: '{reference}': {err}")
+                return None
+
+        with self.tracer.span('cache_from', image) as counters:
+            found = [r for r in await asyncio.gather(*[fetch(r) for r in references]) if r]
+            counters['images'] = len(found)
+        for reference in found:
+            self.logger.info(f"using cache from: '{reference}'")
+        return found
+
+    def inspect_image(self, reference, client=None, base_url=None):
+        # Through the async engine with --engine async, docker-py otherwise
+        if self.settings.args.engine == 'async':
+            data = asyncio.run(AsyncDocker(base_url or self.base_url).inspect(reference))
+            if data is None:
+                raise self.errors.ImageNotFound(f"no such image: '{reference}'")
+            return data
+        return (client or self.cli).inspect_image(reference)
+
+    def tag_image(self, image, repository, tag, client=None, base_url=None):
+        if self.settings.args.engine == 'async':
+            return asyncio.run(AsyncDocker(base_url or self.base_url).tag(image, repository, tag, force=True))
+        return (client or self.cli).tag(image, repository, tag, force=True)
+
+    def pull_stream(self, repository, tag, client=None, base_url=None):
+        if self.settings.args.engine == 'async':
+            engine = AsyncDocker(base_url or self.base_url)
+            return engine.iterate(engine.pull(repository, tag))
+        return (client or self.cli).pull(repository, tag, stream=True, decode=True)
+
+    def push_stream(self, reference, client=None, base_url=None):
+        if self.settings.args.engine == 'async':
+            engine = AsyncDocker(base_url or self.base_url)
+            return engine.iterate(engine.push(reference))
+        return (client or self.cli).push(reference, stream=True, decode=True)
+
     def lines_to_text(self, lines, justify=None):
         count = 0
         formated_lines = []
@@ -355,7 +555,7 @@ class Docker(ABC):
             dockerfile = os.path.relpath(abs_dockerfile, path)
         return (dockerfile, None)
 
-    def makebuildcontext(self, path, fileobj, dockerfile, exclude=None, gzip=None):
+    def makebuildcontext(self, path, fileobj, dockerfile, exclude=None, gzip=None, image=None):
         root = os.path.abspath(path)
         exclude = exclude or []
         dockerfile = dockerfile or (None, None)
@@ -369,73 +569,34 @@ class Docker(ABC):
                 dockerfile,
             ]
 
-        files=sorted(self.exclude_paths(root, exclude, dockerfile=dockerfile[0]))
-        extra_files = extra_files or []
-        extra_names = set(e[0] for e in extra_files)
-
-        f = tempfile.NamedTemporaryFile()
-        t = tarfile.open(mode='w:gz' if gzip else 'w', fileobj=f)
-
-        for path in files:
-            self.logger.debug(f"adding to context: '{path}'")
-            if path in extra_names:
-                # Extra files override context files with the same name
-                continue
-            full_path = os.path.join(root, path)
-
-            i = t.gettarinfo(full_path, arcname=path)
-
-            if i is None:
-                # This happens when we encounter a socket file. We can safely
-                # ignore it and proceed.
-                continue
-            # Workaround https://bugs.python.org/issue32713
-            if i.mtime < 0 or i.mtime > 8**11 - 1:
-                i.mtime = int(i.mtime)
-
-            if self.constants.IS_WINDOWS_PLATFORM:
-                # Windows doesn't keep track of the execute bit, so we make files
-                # and directories executable by default.
-                i.mode = i.mode & 0o755 | 0o111
-
-            if i.isfile():
-                try:
-                    with open(full_path, 'rb') as fl:
-                        t.addfile(i, fl)
-                except IOError:
-                    raise IOError(
-                        'Can not read file in context: {}'.format(full_path)
-                    )
-            else:
-                # Directories, FIFOs, symlinks... don't need to be read.
-                t.addfile(i, None)
-
-        for name, contents in extra_files:
-            info = tarfile.TarInfo(name)
-            contents_encoded = contents.encode('utf-8')
-            info.size = len(contents_encoded)
-            t.addfile(info, io.BytesIO(contents_encoded))
-    
-        dfinfo = tarfile.TarInfo('Dockerfile')
-        dfinfo.size = len(fileobj.getvalue())
-        t.addfile(dfinfo, fileobj)
-        
-        t.close()
-        f.seek(0)   
-        return f
-
-    def process_build_stream(self, line):
+        # The walked tar body is shared by every image with the same context
+        epoch = self.settings.args.source_date_epoch if self.settings.args.reproducible else None
+        context = self.context_cache.context(root, fileobj.getvalue(), exclude, gzip, extra_files, image=image, tracer=self.tracer, epoch=epoch)
+        if context.digest:
+            self.logger.debug(f"context digest for '{image}': {context.digest}")
+        limit = self.settings.args.context_warning
+        if limit and context.body_size > limit * 1024 * 1024 and root not in self.context_warned:
+            self.context_warned.add(root)
+            body = self.context_cache.body(root, exclude, gzip, epoch=epoch)
+            largest = ContextReport(root, body.get("files"), body.get("stats"), top=5).largest_files()
+            self.logger.warning(f"build context '{root}' is {human_size(context.body_size)} (limit {limit} MiB), largest files: {', '.join(f'{p} ({human_size(b)})' for p, b in largest)}")
+            self.logger.warning("run with --context_report for .dockerignore suggestions")
+        return context
+
+    def process_build_stream(self, line, state):
         def rm_imgs():
+            # Through the client of the daemon running this build
             try:
-                inter_image = self.cli.inspect_container(self.intermediate_container).get("Image")
+                inter_image = state.client.inspect_container(state.intermediate_container).get("Image")
                 self.logger.warning(f"removing image: {inter_image}")
-                self.cli.remove_container(self.intermediate_container, force=True)
-                self.cli.remove_image(inter_image, force=True)
+                state.client.remove_container(state.intermediate_container, force=True)
+                state.client.remove_image(inter_image, force=True)
             except self.errors.APIError as err:
                 raise BuildError(f"Builder: remove error - {err}")
 
         stream = line
         if stream.get("errorDetail"):
+            self.metrics.inc('image_builder_failures_total', category='daemon')
             raise BuildError("Builder: {err}".format(err=stream.get("errorDetail").get("message")))
         elif stream.get("aux"):
             if stream.get("aux").get("ID"):
@@ -446,23 +607,23 @@ class Docker(ABC):
             idn = stream.get("id")
             idn_len = len(idn) if idn is not None else 0
             status = stream.get("status")
-            self.status_test[status] = None
-            #print(list(self.status_test.keys()))
+            state.status_test[status] = None
+            #print(list(state.status_test.keys()))
             progress = stream.get("progress")
             detail = stream.get("progressDetail")
             if idn_len == 12:
-                self.console_output[idn] = {
+                state.console_output[idn] = {
                     'status': status,
                     'progress': progress,
                 }
-            if len(self.console_output) > 0:
+            if len(state.console_output) > 0:
                 #remove = {}
-                #for idn, stats in self.console_output.items():
+                #for idn, stats in state.console_output.items():
                 #    if stats.get("status") == "Pull complete":
                 #        remove[idn] = None
                 #for idn, empty in remove.items():
-                #    self.console_output.pop(idn, None)
-                return self.console_output
+                #    state.console_output.pop(idn, None)
+                return state.console_output
         elif stream.get("stream"):
             if stream.get("stream").isspace():
                 return
@@ -471,18 +632,22 @@ class Docker(ABC):
             msg = [i for i in items[1:]]
             error_prompts = ["fatal:", "ERROR:", "error:"]
             if "E:" in items[0]:
+                self.metrics.inc('image_builder_failures_total', category='apt')
                 if self.settings.args.rm_inter_imgs:
                     rm_imgs()
                 raise BuildError("Builder Apt Error: {m}".format(m=" ".join(msg)))
             elif "/bin/sh:" in items[0] and len(msg) > 0:
+                self.metrics.inc('image_builder_failures_total', category='shell')
                 if self.settings.args.rm_inter_imgs:
                     rm_imgs()
                 raise BuildError("Builder Shell Error: {m}".format(m=" ".join(msg)))
             elif "CMake" in items[0] and "Error:" in items[1]:
+                self.metrics.inc('image_builder_failures_total', category='cmake')
                 if self.settings.args.rm_inter_imgs:
                     rm_imgs()
                 raise BuildError("Builder Cmake Error: {m}".format(m=" ".join(msg[1:])))
             if any([self.io.in_list(e, items[0]) for e in error_prompts]):
+                self.metrics.inc('image_builder_failures_total', category='build')
                 if self.settings.args.rm_inter_imgs:
                     rm_imgs()
                 raise BuildError("Builder Error: {m}".format(m=" ".join(msg)))
@@ -491,14 +656,21 @@ class Docker(ABC):
             #        rm_imgs()
             #    raise BuildError("Builder: error - {m}".format(m=" ".join(msg)))
             elif items[0] == "Step": # Look for build steps
+                self.metrics.inc('image_builder_build_steps_total')
+                if len(items) > 3 and items[3].upper() == "FROM":
+                    state.current_stage = items[-1] if len(items) > 5 and items[-2].lower() == "as" else None
                 self.logger.info("Builder: Step {m}".format(m=" ".join(msg)))
             elif items[0] == "--->": # Look for build progression info
                 if items[1] == "Running" and items[2] == "in":
-                    self.intermediate_container = items[3]
+                    state.intermediate_container = items[3]
+                elif items[1] == "Using" and items[2] == "cache":
+                    self.metrics.inc('image_builder_build_cache_hits_total')
+                elif len(items) == 2 and re.match(r'^[0-9a-f]{12,}$', items[1]):
+                    # Track the latest layer of every named stage
+                    state.stage_images[state.current_stage] = items[1]
                 self.logger.info("Builder: {m}".format(m=" ".join(msg)))
             elif items[0] == "Successfully": # Look for success info
                 self.logger.info("Builder: Successfully {m}".format(m=" ".join(msg)))
-                self.build_success = True
             elif items[0] == "Fetched": # Look for fetch info
                 self.logger.info("Builder: Fetched {m}".format(m=" ".join(msg)))
             elif items[0] == "Reading": # Look for reading info
@@ -509,21 +681,744 @@ class Docker(ABC):
                 get = items[0].split(":")[0]
                 get_idx = items[0].split(":")[1]
                 if get == "Get":
-                    self.logger.info("Builder: Get({i}) {m}".format(i=get_idx, m=" ".join(msg)))
+                    self.logger.sample('download', logging.INFO, "Builder: Get(%s) %s", get_idx, " ".join(msg))
                 else:
-                    self.logger.debug(ln)
+                    self.logger.sample('build', logging.DEBUG, "%s", ln)
             else:
-                self.logger.debug(ln)
+                self.logger.sample('build', logging.DEBUG, "%s", ln)
         else:
             self.logger.error(stream)
 
-    def build(self):
+    def read_dockerignore(self, project_dir):
+        # Read dockerignore for files to exclude
+        docker_ignore = project_dir.joinpath('.dockerignore')
+        docker_exclude = None
+        if os.path.exists(docker_ignore.as_posix()):
+            with open(docker_ignore.as_posix(), 'r') as f:
+                docker_exclude = list(filter(
+                    lambda x: x != '' and x[0] != '#',
+                    [l.strip() for l in f.read().splitlines()]
+                ))
+        return docker_exclude
+
+    def minimal_exclude(self, job, exclude=None):
+        # Exclude everything, then re-include each COPY/ADD source; excluded
+        # directories that no source lives under are never walked
+        sources = DockerfileParser(job.get("lines")).copy_sources()
+        if "." in sources:
+            self.logger.debug(f"whole context is copied, using full context for: '{job.get('path')}'")
+            return exclude
+        self.logger.info(f"minimal context for '{job.get('path')}': {sources}")
+        # .dockerignore patterns still apply within the sources
+        return ['*'] + [f"!{s}" for s in sources] + (exclude or [])
+
+    def image_context(self, job):
+        project_dir = job.get("project_dir")
+        # Encode before building
+        dockerfile_text = self.lines_to_text(job.get("lines"))
+        docker_exclude = self.read_dockerignore(project_dir)
+        if self.settings.args.minimal_context or job.get("config").get("minimal_context"):
+            docker_exclude = self.minimal_exclude(job, docker_exclude)
+        # Create manifest
+        dockerfile_processed = self.process_dockerfile(job.get("dockerfile").as_posix(), project_dir.as_posix())
+        dockerfile_encoded = io.BytesIO(dockerfile_text.encode('utf-8'))
+        return self.makebuildcontext(project_dir.as_posix(), dockerfile_encoded, dockerfile_processed, docker_exclude, self.settings.args.gzip, image=job.get("path"))
+
+    def context_report(self, jobs):
+        # Images sharing a directory and .dockerignore share one context
+        contexts = {}
+        for job in jobs:
+            project_dir = job.get("project_dir").as_posix()
+            exclude = self.read_dockerignore(job.get("project_dir")) or []
+            context = contexts.setdefault((project_dir, tuple(exclude)), {'images': [], 'sources': [], 'keep': ['.dockerignore']})
+            context['images'].append(job.get("path"))
+            context['sources'].extend(DockerfileParser(job.get("lines")).copy_sources())
+            context['keep'].append(os.path.relpath(job.get("dockerfile").as_posix(), project_dir))
+
+        reports = []
+        for (project_dir, exclude), context in contexts.items():
+            stats = {}
+            with self.tracer.span('walk', project_dir) as counters:
+                files = self.context_cache.walk(project_dir, list(exclude), stats)
+                counters['files'] = len(files)
+            report = ContextReport(project_dir, files, stats, context.get("sources"), context.get("keep"), self.settings.args.context_report)
+            report.show(context.get("images"))
+            reports.append(dict(report.as_dict(), images=context.get("images")))
+
+        if not self.settings.args.dryrun:
+            report_path = self.ops.project_build_dir.joinpath('context_report.json')
+            with open(report_path.as_posix(), 'w') as f:
+                json.dump(reports, f, indent=4)
+            self.logger.info(f"context report written to: '{report_path.as_posix()}'")
+
+    def cache_references(self, job):
+        # Reuse layers of previously pushed versions of this image
+        if (self.settings.args.cache_from or job.get("config").get("cache_from")) and not self.settings.args.nocache:
+            return list(dict.fromkeys(
+                f"{job.get('repository')}/{job.get('name')}:{job.get('tag')}-{v}" for v in ["latest"] + self.ops.version_tags
+            ))
+        return []
+
+    def cache_images(self, job, base_url=None):
+        references = self.cache_references(job)
+        if not references:
+            return None
+        return self.pull_cache_images(job.get("path"), references, base_url) or None
+
+    def resumed(self, job):
+        # A journaled build counts only while its image is still on a daemon
+        if not self.settings.args.resume or not self.journal.completed(job.get("path"), job.get("key"), 'built'):
+            return False
+        image_id = self.journal.entry(job.get("path"), job.get("key")).get("built")
+        for daemon in self.pool.daemons:
+            try:
+                if daemon.client.inspect_image(job.get("path")).get("Id") == image_id:
+                    job['daemon'] = daemon
+                    self.logger.info(f"resuming: already built: '{job.get('path')}'")
+                    for listener in self.built_listeners:
+                        listener(job)
+                    return True
+            except self.errors.APIError:
+                continue
+        return False
+
+    def record_build(self, job, client=None):
+        for listener in self.built_listeners:
+            listener(job)
+        client = client or (job.get("daemon") or self.pool.primary).client
+        try:
+            image_id = client.inspect_image(job.get("path")).get("Id")
+        except self.errors.APIError as err:
+            self.logger.debug(f"docker api error: {err}")
+            return
+        self.journal.record(job.get("path"), job.get("key"), 'built', id=image_id)
+
+    def schedule(self, job):
+        # Run the build on a daemon holding the parent image where possible
+        froms = DockerfileParser(job.get("lines")).froms()
+        parent = froms[-1][0] if froms else None
+        daemon = self.pool.acquire(parent)
+        try:
+            self.pool.transfer(parent, daemon)
+        except OperationError as err:
+            self.logger.error(f"{err}")
+        job['daemon'] = daemon
+        return daemon
+
+    def daemon_build(self, fileobj, tag, buildargs=None, cache_from=None, client=None, live=True, state=None):
+        """Build on the daemon of client; returns whether the build succeeded."""
+        client = client or self.cli
+        state = state or BuildState(client)
+        success = False
+        display = Live(str(), screen=False, auto_refresh=False, transient=True) if live else nullcontext()
+        with display as live_display, self.logger.sampling():
+            try:
+                # The context is sent before the daemon starts streaming
+                with self.tracer.span('upload', tag, bytes=len(fileobj)):
+                    build_stream = client.build(
+                        fileobj=fileobj, 
+                        rm=True, 
+                        tag=tag,
+                        decode=True,
+                        custom_context=True,
+                        buildargs=buildargs,
+                        nocache=self.settings.args.nocache,
+                        cache_from=cache_from,
+                    )
+                with self.tracer.span('build', tag):
+                    for line in build_stream:
+                        out_stream = self.process_build_stream(line, state)
+                        if out_stream and live:
+                            table = Table(show_header=False, show_edge=False, box=box.SIMPLE)
+                            table.add_column("ID", width=12)
+                            table.add_column("Status", width=20)
+                            table.add_column("Progress")
+                            for idn, attr in out_stream.items():
+                                table.add_row(idn, attr.get("status"), attr.get("progress"))
+                            live_display.update(table, refresh=True)
+                success = True
+            except self.errors.APIError as a_err:
+                self.metrics.inc('image_builder_failures_total', category='api')
+                self.logger.error(f"Docker API error: {a_err}")
+            except self.errors.BuildError as b_err:
+                self.metrics.inc('image_builder_failures_total', category='daemon')
+                self.logger.error(f"Docker Build error: {b_err}")
+            except BuildError as b_err:
+                self.logger.error(f"{b_err}")
+            except TypeError as t_err:
+                self.metrics.inc('image_builder_failures_total', category='unknown')
+                self.logger.error(f"error: {t_err}")
+            except Exception as err:
+                self.metrics.inc('image_builder_failures_total', category='unknown')
+                self.logger.error(f"unknown error: {err}")
+            self.logger.summary('download', logging.INFO)
+            self.logger.summary('build')
+        return success
+
+    def publish(self, job, pushstat):
+        image_docker_path = job.get("path")
+        daemon = job.get("daemon") or self.pool.primary
+        client = daemon.client
+        image_repository = job.get("repository")
+        image_name = job.get("name")
+        image_tag = job.get("tag")
+
+        # Set version tags for final image
+        references = []
+        for t in job.get("tags"):
+            version_image_docker_path = f"{image_repository}/{image_name}:{image_tag}-{t}"
+            references.append(version_image_docker_path)
+            self.logger.info(f"tagging image: {version_image_docker_path}")
+            if self.journal.completed(image_docker_path, job.get("key"), 'tagged', version_image_docker_path):
+                self.logger.info(f"resuming: already tagged: '{version_image_docker_path}'")
+            elif not self.settings.args.dryrun:
+                try:
+                    with self.tracer.span('tag', image_docker_path, reference=version_image_docker_path):
+                        self.tag_image(f"{image_docker_path}", f"{image_repository}/{image_name}", f"{image_tag}-{t}", client, daemon.base_url)
+                    self.journal.record(image_docker_path, job.get("key"), 'tagged', reference=version_image_docker_path)
+                except self.errors.ImageNotFound as i_err:
+                    self.logger.error(f"not found: {image_docker_path}")
+                except Exception as err:
+                    self.logger.error(f"unknown error: {err}")
+
+        pending = []
+        for version_image_docker_path in references:
+            if self.journal.completed(image_docker_path, job.get("key"), 'pushed', version_image_docker_path):
+                self.logger.info(f"resuming: already pushed: '{version_image_docker_path}'")
+            else:
+                pending.append(version_image_docker_path)
+
+        plan = self.plan_push(image_docker_path, pending, client, daemon.base_url)
+        pushed_digests = set()
+        for version_image_docker_path, action in plan.get("actions"):
+            remote_digest = plan.get("remote").get(version_image_docker_path)
+            if action != 'skip' and remote_digest in pushed_digests and not self.settings.args.overwrite:
+                # Pushed under an earlier tag of this plan
+                action = 'skip'
+            if action == 'skip':
+                self.metrics.inc('image_builder_pushes_total', result='skipped')
+                self.logger.info(f"registry up to date, skipping push: '{version_image_docker_path}'")
+                self.journal.record(image_docker_path, job.get("key"), 'pushed', reference=version_image_docker_path)
+                continue
+            if action == 'tag' or (action == 'push' and pushed_digests):
+                # Every blob is in the registry already; only the manifest is put
+                action = 'tag'
+                self.logger.info(f"Pushing tag: '{version_image_docker_path}'")
+            else:
+                self.logger.info(f"Pushing: '{version_image_docker_path}'")
+            if self.settings.args.overwrite:
+                self.logger.warning(f"Overwriting image: '{version_image_docker_path}'")
+            if not self.settings.args.dryrun:
+                pushstat.set_image(version_image_docker_path)
+                with self.tracer.span('push', image_docker_path, reference=version_image_docker_path, action=action) as counters:
+                    pushed_bytes = pushstat.transferred()
+                    pushed = True
+                    for line in self.push_stream(version_image_docker_path, client, daemon.base_url):
+                        pushstat.store(line)
+                        if line.get("error"):
+                            self.logger.error(f"push error: '{version_image_docker_path}': {line.get('error')}")
+                            pushed = False
+                        elif (line.get("aux") or {}).get("Digest"):
+                            pushed_digests.add(line.get("aux").get("Digest"))
+                            self.registry.update(version_image_docker_path, line.get("aux").get("Digest"))
+                    counters['bytes'] = pushstat.transferred() - pushed_bytes
+                if pushed:
+                    self.metrics.inc('image_builder_pushes_total', result='tagged' if action == 'tag' else 'pushed')
+                    self.journal.record(image_docker_path, job.get("key"), 'pushed', reference=version_image_docker_path)
+
+        # Export in the background while the next image builds
+        if self.settings.args.save:
+            self.archive.submit(image_docker_path, [f"{image_repository}/{image_name}:{image_tag}-{t}" for t in job.get("tags")], daemon.base_url)
+
+        self.metrics.write()
+
+    def plan_push(self, image, references, client=None, base_url=None):
+        """Decide per reference whether to push, only put a tag, or skip.
+
+        A reference is skipped when its registry digest is one of the local
+        image's repo digests, and is a tag update when the manifest is in the
+        registry under another tag. Full pushes are ordered first so later
+        tags of the same image only put the manifest.
+        """
+        client = client or self.cli
+        if self.settings.args.dryrun:
+            return {'actions': [(r, 'push') for r in references], 'local': set(), 'remote': {}}
+        local = set()
+        try:
+            for repo_digest in self.inspect_image(image, client, base_url).get("RepoDigests") or []:
+                repository, _, digest = repo_digest.partition("@")
+                if repository == image.rsplit(":", 1)[0]:
+                    local.add(digest)
+        except self.errors.APIError as err:
+            self.logger.debug(f"docker api error: {err}")
+        remote = self.registry.lookup(references, tracer=self.tracer) if references else {}
+        actions = []
+        for reference in references:
+            digest = remote.get(reference)
+            if self.settings.args.overwrite:
+                actions.append((reference, 'push'))
+            elif digest and digest in local:
+                actions.append((reference, 'skip'))
+            elif local & set(remote.values()):
+                actions.append((reference, 'tag'))
+            else:
+                actions.append((reference, 'push'))
+        order = {'push': 0, 'tag': 1, 'skip': 2}
+        actions.sort(key=lambda a: order.get(a[1]))
+        self.logger.debug(f"push plan for '{image}': {actions}")
+        return {'actions': actions, 'local': local, 'remote': remote}
+
+    def run_job(self, job, pushstat):
+        image_docker_path = job.get("path")
+        resumed = not self.settings.args.dryrun and job.get("index") >= self.pull_order and self.resumed(job)
+
+        # Build images
+        self.run_build = True if self.build_success else False
+        self.logger.info(f"building: '{image_docker_path}'")
+        if self.run_build and job.get("index") >= self.pull_order:
+            if resumed:
+                self.run_build = True
+            elif not self.settings.args.dryrun:
+                with closing(self.image_context(job)) as dockerfile_obj:
+                    daemon = self.schedule(job)
+                    try:
+                        cache_from = self.cache_images(job, daemon.base_url)
+                        self.run_build = self.build_success = self.daemon_build(dockerfile_obj, image_docker_path, job.get("args"), cache_from, client=daemon.client)
+                        if self.build_success:
+                            self.record_build(job)
+                    finally:
+                        self.pool.release(daemon, image_docker_path if self.build_success else None)
+            elif self.settings.args.dryrun:
+                # Dry runs still tar the context, for its size warning
+                self.image_context(job).close()
+                self.cache_images(job)
+                self.run_build = True
+            if not self.run_build and not self.build_success:
+                self.metrics.inc('image_builder_images_total', result='failed')
+                self.logger.info(f"failed to build: '{image_docker_path}'")
+                self.logger.info(f"dockerfile: '{job.get('dockerfile').as_posix()}'")
+                sys.exit()    
+            if not self.settings.args.dryrun:
+                self.metrics.inc('image_builder_images_total', result='cached' if resumed else 'built')
+        else:
+            self.logger.info(f"succesfully built: '{image_docker_path}'")
+            self.run_build = False
+            self.build_success = True
+        self.publish(job, pushstat)
+
+    async def async_build(self, engine, fileobj, tag, buildargs=None, cache_from=None, state=None):
+        state = state or BuildState(self.cli)
+        success = False
+        with self.logger.sampling():
+            try:
+                with self.tracer.span('build', tag, bytes=len(fileobj)):
+                    async for line in engine.build(fileobj, tag=tag, buildargs=buildargs, cache_from=cache_from, nocache=self.settings.args.nocache):
+                        self.process_build_stream(line, state)
+                success = True
+            except (OperationError, self.errors.APIError) as err:
+                self.metrics.inc('image_builder_failures_total', category='api')
+                self.logger.error(f"Docker API error: {err}")
+            except BuildError as b_err:
+                self.logger.error(f"{b_err}")
+            except OSError as err:
+                self.metrics.inc('image_builder_failures_total', category='daemon')
+                self.logger.error(f"daemon connection error: {err}")
+            self.logger.summary('download', logging.INFO)
+            self.logger.summary('build')
+        return success
+
+    async def async_variants(self, jobs, contexts):
+        # One event loop streams every variant; blocking docker-py calls run in threads
+        limit = asyncio.Semaphore(self.settings.args.matrix_workers)
+        loop = asyncio.get_running_loop()
+
+        def in_thread(func, *args):
+            # asyncio.to_thread needs 3.9; threads see the job's context too
+            return loop.run_in_executor(None, contextvars.copy_context().run, func, *args)
+
+        async def build_variant(job, context):
+            async with limit:
+                daemon = await in_thread(self.schedule, job)
+                success = False
+                try:
+                    engine = AsyncDocker(daemon.base_url)
+                    references = self.cache_references(job)
+                    cache_from = (await self.async_pull_cache_images(engine, job.get("path"), references) or None) if references else None
+                    self.logger.info(f"building: '{job.get('path')}'")
+                    success = await self.async_build(engine, context, job.get("path"), job.get("args"), cache_from, BuildState(daemon.client))
+                    if success:
+                        await in_thread(self.record_build, job)
+                    return success
+                finally:
+                    self.pool.release(daemon, job.get("path") if success else None)
+                    context.close()
+
+        return await asyncio.gather(*[build_variant(job, context) for job, context in zip(jobs, contexts)])
+
+    def critical_paths(self, jobs):
+        """Return {path: seconds} of each image plus its longest chain of descendants.
+
+        Images never timed count as the mean of the timed ones.
+        """
+        estimates = {job.get("path"): self.timings.estimate(job.get("path"), job.get("key"), push=self.settings.args.push) for job in jobs}
+        known = [e for e in estimates.values() if e is not None]
+        fallback = sum(known) / len(known) if known else 0.0
+        children = {}
+        for job in jobs:
+            froms = DockerfileParser(job.get("lines")).froms()
+            if froms and froms[-1][0] in estimates and froms[-1][0] != job.get("path"):
+                children.setdefault(froms[-1][0], []).append(job.get("path"))
+        # Parents come before their children in the job list
+        lengths = {}
+        for job in reversed(jobs):
+            own = estimates.get(job.get("path"))
+            own = fallback if own is None else own
+            lengths[job.get("path")] = own + max([lengths.get(c, 0.0) for c in children.get(job.get("path"), [])], default=0.0)
+        return lengths
+
+    def longest_first(self, jobs):
+        # Ready images start longest critical path first; ties keep config order
+        lengths = self.critical_paths(self.jobs or jobs)
+        return sorted(jobs, key=lambda job: -lengths.get(job.get("path"), 0.0))
+
+    def record_timings(self):
+        phases = self.tracer.summary()
+        for job in self.jobs:
+            image = phases.get(job.get("path"))
+            if image and image.get("phases"):
+                self.timings.record(job.get("path"), job.get("key"), image.get("phases"))
+        self.timings.write()
+
+    def parent_key(self, lines):
+        # Key of the job this image builds FROM; matrix siblings don't count
+        froms = DockerfileParser(lines).froms()
+        parent = froms[-1][0] if froms else None
+        for job in reversed(self.jobs):
+            references = [job.get("path")] + [f"{job.get('repository')}/{job.get('name')}:{job.get('tag')}-{t}" for t in job.get("tags") or []]
+            if parent in references:
+                return job.get("key")
+        return None
+
+    def image_pull(self, img):
+        return bool(self.settings.args.pull or img.get("pull_version"))
+
+    def pull_candidates(self, pull_images, pull_versions):
+        """Yield (idx, img, tag, reference) in the order a run looks for an image to pull.
+
+        The most derived image comes first, then its tags in pull_versions
+        order; the first hit is pulled and its parents are skipped, see
+        pull_hit for matrix variants. --plan searches the same candidates.
+        """
+        if self.settings.args.local:
+            return
+        for idx, img in pull_images.items():
+            if not (self.image_pull(img) or self.settings.args.load_cache):
+                continue
+            for tg in pull_versions.get(img.get("path")) or []:
+                yield idx, img, tg, "{p}-{t}".format(p=img.get("path"), t=tg)
+
+    def pull_hit(self, pull_images, pulled, idx, reference):
+        """Record a hit of the pull search in pulled, {index: reference}.
+
+        Returns the index of the image whose parents are skipped once the
+        search is over, None while it goes on. Matrix variants are siblings,
+        not parents of each other: each is searched on its own, and the
+        search only ends with a variant once all of its group was found.
+        """
+        index = (len(pull_images) - 1) - idx
+        pulled[index] = reference
+        group = pull_images.get(idx).get("matrix_group")
+        if group is None:
+            return index
+        variants = [(len(pull_images) - 1) - i for i, img in pull_images.items() if img.get("matrix_group") == group]
+        if all([i in pulled for i in variants]):
+            return max(variants)
+        return None
+
+    def pull_found(self, pull_images, idx, reference):
+        # True once the pull search is over
+        order = self.pull_hit(pull_images, self.pulled_images, idx, reference)
+        if order is None:
+            return False
+        self.pull_order = order
+        self.pulled_image = self.pulled_images.get(order)
+        return True
+
+    def run_variants(self, jobs, pushstat):
+        """Build the variants of a matrix entry concurrently from one context."""
+        done = [job for job in jobs if self.resumed(job)]
+        built = jobs
+        jobs = self.longest_first([job for job in jobs if job not in done])
+        contexts = [self.image_context(job) for job in jobs]
+        self.logger.info(f"building {len(jobs)} matrix variants: {[job.get('path') for job in jobs]}")
+
+        def build_variant(job, context):
+            # Variants spread over the daemon pool
+            daemon = self.schedule(job)
+            client = daemon.connect()
+            success = False
+            try:
+                cache_from = self.cache_images(job, daemon.base_url)
+                self.logger.info(f"building: '{job.get('path')}'")
+                success = self.daemon_build(context, job.get("path"), job.get("args"), cache_from, client=client, live=False)
+                if success:
+                    self.record_build(job, client)
+                return success
+            finally:
+                self.pool.release(daemon, job.get("path") if success else None)
+                context.close()
+                client.close()
+
+        if self.settings.args.engine == 'async':
+            results = asyncio.run(self.async_variants(jobs, contexts))
+        else:
+            with ThreadPoolExecutor(max_workers=self.settings.args.matrix_workers) as executor:
+                # Each variant runs in a copy of this context (serve mode job settings and logs)
+                futures = [executor.submit(contextvars.copy_context().run, build_variant, job, context) for job, context in zip(jobs, contexts)]
+                results = [future.result() for future in futures]
+        failed = [job for job, success in zip(jobs, results) if not success]
+        if failed:
+            for job in failed:
+                self.metrics.inc('image_builder_images_total', result='failed')
+                self.logger.info(f"failed to build: '{job.get('path')}'")
+            sys.exit()
+        self.build_success = True
+        for job in built:
+            self.metrics.inc('image_builder_images_total', result='cached' if job in done else 'built')
+            self.publish(job, pushstat)
+
+    def run_jobs(self, jobs, pushstat):
+        # Consecutive variants of a matrix entry are built together
+        groups = []
+        for job in jobs:
+            group = job.get("config").get("matrix_group")
+            if groups and group is not None and groups[-1][0].get("config").get("matrix_group") == group:
+                groups[-1].append(job)
+            else:
+                groups.append([job])
+        for group in groups:
+            if len(group) == 1 or self.settings.args.dryrun:
+                for job in group:
+                    self.run_job(job, pushstat)
+            else:
+                self.run_variants(group, pushstat)
+
+    def build_multistage(self, jobs, pushstat):
+        """Build a chain of images as the named stages of one Dockerfile.
+
+        The context is uploaded once; each stage's resulting image is tagged
+        from the build stream. Returns False when the chain can't be merged.
+        """
+        # All stages share one set of build arguments
+        buildargs = {}
+        for job in jobs:
+            for k, v in (job.get("args") or {}).items():
+                if buildargs.get(k, v) != v:
+                    self.logger.warning(f"conflicting build argument '{k}', building images separately")
+                    return False
+                buildargs[k] = v
+        for job in jobs:
+            if self.process_dockerfile(job.get("dockerfile").as_posix(), job.get("project_dir").as_posix())[1] is not None:
+                self.logger.warning(f"Dockerfile outside of context: '{job.get('dockerfile')}', building images separately")
+                return False
+
+        # One context rooted at the common parent of every project directory
+        project_dirs = list(dict.fromkeys(job.get("project_dir").as_posix() for job in jobs))
+        root = os.path.commonpath(project_dirs)
+        exclude = []
+        if len(project_dirs) > 1:
+            exclude.append('*')
+            exclude.extend(f"!{os.path.relpath(d, root)}" for d in project_dirs)
+        for d in project_dirs:
+            prefix = os.path.relpath(d, root)
+            for pattern in self.read_dockerignore(Path(d)) or []:
+                negate = '!' if pattern.startswith('!') else ''
+                pattern = pattern.lstrip('!')
+                exclude.append(f"{negate}{pattern}" if prefix == '.' else f"{negate}{prefix}/{pattern.lstrip('/')}")
+
+        # Emit each image as a named stage, pointing FROM at earlier stages
+        stages = {}
+        stage_names = {}
+        lines = []
+        for job in jobs:
+            stage = job.get("alias") or f"stage{job.get('index')}"
+            prefix = os.path.relpath(job.get("project_dir").as_posix(), root)
+            instructions = DockerfileParser.join(job.get("lines"))
+            last_from = max([i for i, ins in enumerate(instructions) if DockerfileParser.split(ins)[0] == "FROM"], default=None)
+            for i, instruction in enumerate(instructions):
+                keyword = DockerfileParser.split(instruction)[0]
+                if keyword == "FROM":
+                    image, alias = DockerfileParser.parse_from(instruction)
+                    image = stages.get(image, image)
+                    instruction = DockerfileParser.replace_from(instruction, image, stage if i == last_from else alias)
+                elif keyword in ["COPY", "ADD"]:
+                    instruction = DockerfileParser.prefix_sources(instruction, prefix)
+                lines.append(instruction)
+            stage_names[job.get("path")] = stage
+            stages[job.get("path")] = stage
+            for t in job.get("tags"):
+                stages[f"{job.get('repository')}/{job.get('name')}:{job.get('tag')}-{t}"] = stage
+
+        final = jobs[-1]
+        self.logger.info(f"building {len(jobs)} images as one multi-stage build: '{final.get('path')}'")
+        if self.settings.args.show:
+            print(self.lines_to_text(lines, justify=4))
+        if self.settings.args.dryrun:
+            for job in jobs:
+                self.publish(job, pushstat)
+            return True
+
+        if all([self.resumed(job) for job in jobs]):
+            for job in jobs:
+                self.metrics.inc('image_builder_images_total', result='cached')
+                self.publish(job, pushstat)
+            return True
+
+        dockerfile_encoded = io.BytesIO(self.lines_to_text(lines).encode('utf-8'))
+        dockerfile_obj = self.makebuildcontext(root, dockerfile_encoded, None, exclude, self.settings.args.gzip, image=final.get("path"))
+        cache_from = list(dict.fromkeys(itertools.chain.from_iterable(self.cache_images(job) or [] for job in jobs))) or None
+
+        state = BuildState(self.cli)
+        self.run_build = True
+        if not self.daemon_build(dockerfile_obj, final.get("path"), buildargs or None, cache_from, state=state):
+            self.metrics.inc('image_builder_images_total', result='failed', value=len(jobs))
+            self.logger.info(f"failed to build: '{final.get('path')}'")
+            sys.exit()
+
+        # Tag the result of every intermediate stage
+        for job in jobs[:-1]:
+            image_id = state.stage_images.get(stage_names.get(job.get("path")))
+            if image_id is None:
+                self.logger.error(f"no image found for stage '{stage_names.get(job.get('path'))}' of '{job.get('path')}'")
+                sys.exit()
+            repository, tag = job.get("path").rsplit(":", 1)
+            with self.tracer.span('tag', job.get("path"), reference=job.get("path")):
+                self.cli.tag(image_id, repository, tag, force=True)
+        for job in jobs:
+            self.record_build(job)
+            self.metrics.inc('image_builder_images_total', result='built')
+            self.publish(job, pushstat)
+        return True
+
+    def build(self, planned=False):
+        profiler = None
+        if self.settings.args.profile:
+            profiler = Profiler()
+            self.tracer.profiler = profiler
+            profiler.start()
+        try:
+            self._build(planned)
+            if self.settings.args.watch and not self.settings.args.dryrun:
+                self.watch()
+        finally:
+            self.archive.wait()
+            self.archive.close()
+            if not self.shared_caches:
+                self.context_cache.clear()
+            if self.registry.enabled:
+                self.registry.write()
+            if self.timings.enabled and not self.settings.args.plan:
+                self.record_timings()
+            if profiler:
+                profiler.stop()
+                self.tracer.profiler = None
+            # Export phase timings even when the build exits early
+            if not self.settings.args.plan:
+                self.tracer.show()
+            if not self.settings.args.dryrun:
+                self.tracer.save(self.ops.project_build_dir.as_posix())
+            self.metrics.write()
+            if profiler:
+                profiler.save(self.ops.project_build_dir.as_posix())
+
+    def affected_jobs(self, changes):
+        # Images whose Dockerfile or COPY/ADD sources changed, plus their
+        # descendants; a changed .dockerignore changes every context of its project
+        affected = set()
+        dockerfiles = set()
+        for job in self.jobs:
+            root = job.get("project_dir").as_posix()
+            dockerfile = os.path.relpath(job.get("dockerfile").as_posix(), root)
+            paths = changes.get(os.path.abspath(root)) or set()
+            if dockerfile in paths:
+                dockerfiles.add(job.get("path"))
+            sources = ContextReport(root, [], {}, DockerfileParser(job.get("lines")).copy_sources(), [dockerfile, '.dockerignore'])
+            if any([sources.referenced(p) for p in paths]):
+                affected.add(job.get("path"))
+        for job in self.jobs:
+            froms = DockerfileParser(job.get("lines")).froms()
+            if froms and froms[-1][0] in affected:
+                affected.add(job.get("path"))
+        return [job for job in self.jobs if job.get("path") in affected], dockerfiles
+
+    def watch(self):
+        roots = {}
+        for job in self.jobs:
+            roots.setdefault(job.get("project_dir").as_posix(), self.read_dockerignore(job.get("project_dir")))
+        watcher = Watcher(roots)
+        self.logger.info(f"watching for changes in: {list(roots)}")
+        try:
+            while True:
+                changes = watcher.wait(self.settings.args.watch_debounce)
+                for root, paths in changes.items():
+                    self.logger.debug(f"changed in '{root}': {sorted(paths)}")
+                    if '.dockerignore' in paths:
+                        # The watcher still filters with the old patterns
+                        watcher.update(root, self.read_dockerignore(Path(root)))
+                jobs, dockerfiles = self.affected_jobs(changes)
+                if not jobs:
+                    self.logger.info("no image affected by the changes")
+                    continue
+                # Walks of untouched directories stay cached
+                for root in changes:
+                    self.context_cache.invalidate(root)
+                self.build_success = True
+                try:
+                    if dockerfiles:
+                        # Generated Dockerfile lines are stale, plan the config again
+                        self.logger.info(f"Dockerfile changed for {sorted(dockerfiles)}, rebuilding the config")
+                        self._build()
+                    else:
+                        self.logger.info(f"rebuilding: {[job.get('path') for job in jobs]}")
+                        self.run_jobs(jobs, PushStatus())
+                except SystemExit:
+                    self.logger.error("rebuild failed, waiting for changes")
+                self.metrics.write()
+        except KeyboardInterrupt:
+            self.logger.info("stopped watching")
+        finally:
+            watcher.close()
+
+    def _build(self, planned=False):
+        if not planned:
+            self.plan()
+
+        ### Report build contexts instead of building
+        if self.settings.args.context_report:
+            self.context_report(self.jobs)
+            return
+
+        ### Write the execution plan instead of building
+        if self.settings.args.plan:
+            planner = Planner(self)
+            planner.write(planner.plan())
+            return
+
+        self.execute()
+
+    def plan(self):
+        """Generate the Dockerfile of every image and queue them in self.jobs."""
         pushstat = PushStatus()
         
         self.logger.info("Starting docker builder")
         
         if self.settings.args.gzip: self.logger.info(f"gzip file compression enabled")
 
+        # Seed the daemon from saved archives before searching the repository
+        if self.settings.args.load_cache:
+            self.logger.info(f"loading image cache from: '{self.settings.args.load_cache}'")
+            self.archive.load(self.settings.args.load_cache)
+
         # Get permissions
         stat_info = os.stat(self.ops.work_dir)
         uid = stat_info.st_uid
@@ -539,6 +1434,7 @@ class Docker(ABC):
         projects = self.ops.configs.get("build").get("projects")
 
         ### Process Dockerfiles
+        self.jobs = []
         self.dockerfile_image_lines = {}
         self.dockerfile_final_lines = []
         final_image_docker_path = ""
@@ -561,6 +1457,7 @@ class Docker(ABC):
                 'tag': a_img_props.get("tag"),
                 'push_version': a_img_props.get("push_version"),
                 'pull_version': a_img_props.get("pull_version"),
+                'matrix_group': a_img_props.get("matrix_group"),
             }
         pull_images = dict(sorted(all_images_dict.items()))
 
@@ -627,51 +1524,86 @@ class Docker(ABC):
                                 push_versions[img.get("path")] = ["latest", self.ops.now_tag] if image_push else []
                                 
                             pull_version = img.get("pull_version") if img.get("pull_version") is not None else "latest"
-                            image_pull = True if self.settings.args.pull or img.get("pull_version") else False
                             pull_versions[img.get("path")] = self.ops.version_tags + [pull_version, ""]
-                            if image_pull and not self.settings.args.local:
-                                if not self.settings.args.dryrun:
-                                    for tg in pull_versions[img.get("path")]:
-                                        version_image_docker_path = "{p}-{t}".format(p=img.get("path"), t=tg)
-                                        self.logger.debug(f"pulling image: '{version_image_docker_path}'")
-                                        try:
-                                            [pushstat.store(line) for line in self.cli.pull(
-                                                "{r}/{n}".format(r=img.get("repo"), n=img.get("name")),
-                                                "{ts}-{t}".format(ts=img.get("tag"), t=tg),
-                                                stream=True, 
-                                                decode=True
-                                            )]
-                                            self.run_build = False
-                                            self.pull_order = (total_images - 1) - idx
-                                            self.pulled_image = version_image_docker_path
-                                            self.logger.info(f"Repo image found: '{version_image_docker_path}'")
-                                        except self.errors.NotFound as notfound:
-                                            self.logger.debug(f"Repo image not found: '{version_image_docker_path}'")
-                                            self.run_build = True
-                                            self.build_success = True
-                                        except self.errors.APIError as a_err:
-                                            self.logger.error(f"docker api error: {a_err}")
-                                            self.run_build = False
-                                            self.build_success = False                                                                      
-                                        except Exception as err:
-                                            self.logger.error(f"unknown error: {err}")
-                                            self.run_build = False
-                                            self.build_success = False
-                                elif self.settings.args.dryrun:
-                                    for tg in pull_versions[img.get("path")]:
-                                        version_image_docker_path = "{p}-{t}".format(p=img.get("path"), t=tg)
-                                        self.logger.debug(f"pulling image: '{version_image_docker_path}'")
+                        candidates = list(self.pull_candidates(pull_images, pull_versions))
+                        if not self.settings.args.dryrun:
+                            # Known registry state of every candidate, refreshed in bulk
+                            remote = self.registry.lookup([
+                                version_image_docker_path for _, img, _, version_image_docker_path in candidates if self.image_pull(img)
+                            ], tracer=self.tracer)
+                            for idx, img, tg, version_image_docker_path in candidates:
+                                if (total_images - 1) - idx in self.pulled_images:
+                                    continue
+                                image_pull = self.image_pull(img)
+                                # Tags seeded from --load_cache count as hits without a registry transfer
+                                if self.settings.args.load_cache and self.local_image(version_image_docker_path):
+                                    self.run_build = False
+                                    self.metrics.inc('image_builder_images_total', result='cached')
+                                    self.logger.info(f"Local image found: '{version_image_docker_path}'")
+                                    if self.pull_found(pull_images, idx, version_image_docker_path):
+                                        break
+                                    continue
+                                if not image_pull:
+                                    continue
+                                if version_image_docker_path in remote:
+                                    digest = remote.get(version_image_docker_path)
+                                    if digest is None:
+                                        self.logger.debug(f"Repo image not found (cached): '{version_image_docker_path}'")
+                                        self.run_build = True
+                                        self.build_success = True
+                                        continue
+                                    if self.local_digest(version_image_docker_path, digest):
                                         self.run_build = False
-                                        self.pull_order = (total_images - 1) - idx
-                                        self.pulled_image = version_image_docker_path
-                                        self.logger.info(f"Repo image found: '{version_image_docker_path}'")
+                                        self.metrics.inc('image_builder_images_total', result='cached')
+                                        self.logger.info(f"Repo image up to date locally: '{version_image_docker_path}'")
+                                        if self.pull_found(pull_images, idx, version_image_docker_path):
+                                            break
+                                        continue
+                                self.logger.debug(f"pulling image: '{version_image_docker_path}'")
+                                try:
+                                    with self.tracer.span('pull', img.get("path"), reference=version_image_docker_path) as counters:
+                                        pulled_bytes = pushstat.transferred()
+                                        [pushstat.store(line) for line in self.pull_stream(
+                                            "{r}/{n}".format(r=img.get("repo"), n=img.get("name")),
+                                            "{ts}-{t}".format(ts=img.get("tag"), t=tg),
+                                        )]
+                                        counters['bytes'] = pushstat.transferred() - pulled_bytes
+                                    self.run_build = False
+                                    self.metrics.inc('image_builder_images_total', result='pulled')
+                                    self.logger.info(f"Repo image found: '{version_image_docker_path}'")
+                                    if self.pull_found(pull_images, idx, version_image_docker_path):
+                                        break
+                                except self.errors.NotFound as notfound:
+                                    self.logger.debug(f"Repo image not found: '{version_image_docker_path}'")
+                                    self.run_build = True
+                                    self.build_success = True
+                                except self.errors.APIError as a_err:
+                                    self.metrics.inc('image_builder_failures_total', category='pull')
+                                    self.logger.error(f"docker api error: {a_err}")
+                                    self.run_build = False
+                                    self.build_success = False                                                                      
+                                except Exception as err:
+                                    self.logger.error(f"unknown error: {err}")
+                                    self.run_build = False
+                                    self.build_success = False
+                        elif not self.settings.args.plan:
+                            # Dry runs take the first candidate of each image as found
+                            for idx, img, tg, version_image_docker_path in candidates:
+                                if (total_images - 1) - idx in self.pulled_images:
+                                    continue
+                                self.logger.debug(f"pulling image: '{version_image_docker_path}'")
+                                self.run_build = False
+                                self.logger.info(f"Repo image found: '{version_image_docker_path}'")
+                                if self.pull_found(pull_images, idx, version_image_docker_path):
+                                    break
                         if not self.pulled_image:
                             # Set pull order to process all images
                             self.pull_order = image_count - 1          
 
                     if not self.settings.args.dryrun:
-                        # Skip parent images of pulled image
-                        if not self.pull_order or image_count <= self.pull_order:
+                        # Skip parent images of pulled image, and pulled matrix variants
+                        if not self.pull_order or image_count <= self.pull_order or image_count in self.pulled_images:
+                            self.metrics.inc('image_builder_images_total', result='skipped')
                             image_count+=1
                             continue
 
@@ -816,25 +1748,26 @@ class Docker(ABC):
                             self.dockerfile_image_lines[image_count].append(expose_line)
                             self.dockerfile_final_lines.append(expose_line)
                         # copy image files
-                        for e in copy_elements:
-                            def is_from(field):
-                                if field == "--from":
-                                    self.logger.debug(f"skipping field: '{field}'")
-                                    return True
-                                else:
-                                    return False
-                            src = project_dir.joinpath(e)
-                            dst = self.ops. project_build_dir.joinpath(e)
-                            if self.settings.args.dryrun:
-                                self.logger.debug(f"Dry run: copying: '{src}' --> '{dst}'")
-                            elif not self.settings.args.dryrun:
-                                if any([is_from(s) for s in e.split("=")]):
-                                    continue
-                                try:
-                                    self.ops.copy_path(src, dst, self.settings.args.overwrite)
-                                except OperationError as operr:
-                                    self.logger.error(operr)
-                            project_files.append(dst)
+                        with self.tracer.span('copy', image_docker_path, files=len(copy_elements)):
+                            for e in copy_elements:
+                                def is_from(field):
+                                    if field == "--from":
+                                        self.logger.debug(f"skipping field: '{field}'")
+                                        return True
+                                    else:
+                                        return False
+                                src = project_dir.joinpath(e)
+                                dst = self.ops. project_build_dir.joinpath(e)
+                                if self.settings.args.dryrun:
+                                    self.logger.debug(f"Dry run: copying: '{src}' --> '{dst}'")
+                                elif not self.settings.args.dryrun:
+                                    if any([is_from(s) for s in e.split("=")]):
+                                        continue
+                                    try:
+                                        self.ops.copy_path(src, dst, self.settings.args.overwrite)
+                                    except OperationError as operr:
+                                        self.logger.error(operr)
+                                project_files.append(dst)
                         
                         # Track log file and project build directory
                         project_files.append(self.ops.log_file.as_posix())
@@ -870,112 +1803,24 @@ class Docker(ABC):
                             print(f"Dockerfile: {dockerfile_path}")
                             print(self.lines_to_text(self.dockerfile_image_lines[image_count], justify=4))
             
-                        # Encode before building
-                        dockerfile_encoded = io.BytesIO(self.lines_to_text(self.dockerfile_image_lines[image_count]).encode('utf-8'))
-
-                        # Read dockerignore for files to exclude
-                        docker_ignore = project_dir.joinpath('.dockerignore')
-                        docker_exclude = None
-                        if os.path.exists(docker_ignore.as_posix()):
-                            with open(docker_ignore.as_posix(), 'r') as f:
-                                docker_exclude = list(filter(
-                                    lambda x: x != '' and x[0] != '#',
-                                    [l.strip() for l in f.read().splitlines()]
-                                ))
-
-                        # Create manifest
-                        dockerfile_processed = self.process_dockerfile(dockerfile_path.as_posix(), project_dir.as_posix())
-                        encoding = None
-                        encoding = 'gzip' if self.settings.args.gzip else encoding
-                        dockerfile_obj = self.makebuildcontext(project_dir.as_posix(), dockerfile_encoded, dockerfile_processed, docker_exclude, self.settings.args.gzip)
-                        
-                        # Build images
-                        self.run_build = True if self.build_success else False
+                        ### Queue image build
                         if self.build_success:
-                            self.logger.info(f"building: '{image_docker_path}'")
-                            if self.run_build and image_count >= self.pull_order:
-                                if not self.settings.args.dryrun:
-                                    with Live(self.out_stream, screen=False, auto_refresh=False, transient=True) as live:
-                                        try:
-                                            for line in self.cli.build(
-                                                fileobj=dockerfile_obj, 
-                                                rm=True, 
-                                                tag=image_docker_path,
-                                                decode=True,
-                                                custom_context=True,
-                                                buildargs=image_args,
-                                                nocache=self.settings.args.nocache,
-                                            ):
-                                                self.out_stream = self.process_build_stream(line)
-                                                if self.out_stream:
-                                                    table = Table(show_header=False, show_edge=False, box=box.SIMPLE)
-                                                    table.add_column("ID", width=12)
-                                                    table.add_column("Status", width=20)
-                                                    table.add_column("Progress")
-                                                    for idn, attr in self.out_stream.items():
-                                                        table.add_row(idn, attr.get("status"), attr.get("progress"))
-                                                    live.update(table, refresh=True)
-                                            self.run_build = True
-                                        except self.errors.APIError as a_err:
-                                            self.logger.error(f"Docker API error: {a_err}")
-                                            self.run_build = False
-                                            self.build_success = False
-                                        except self.errors.BuildError as b_err:
-                                            self.logger.error(f"Docker Build error: {b_err}")
-                                            self.run_build = False
-                                            self.build_success = False
-                                        except BuildError as b_err:
-                                            self.logger.error(f"{b_err}")
-                                            self.run_build = False
-                                            self.build_success = False
-                                        except TypeError as t_err:
-                                            self.logger.error(f"error: {t_err}")
-                                            self.run_build = False
-                                            self.build_success = False                 
-                                        except Exception as err:
-                                            self.logger.error(f"unknown error: {err}")
-                                            self.run_build = False
-                                            self.build_success = False
-                                elif self.settings.args.dryrun:
-                                    self.run_build = True
-                                if not self.run_build and not self.build_success:
-                                    self.logger.info(f"failed to build: '{image_docker_path}'")
-                                    self.logger.info(f"dockerfile: '{dockerfile_path.as_posix()}'")
-                                    sys.exit()    
-                            else:
-                                self.logger.info(f"succesfully built: '{image_docker_path}'")
-                                self.run_build = False
-                                self.build_success = True
-                            
-                            # Set version tags for final image
-                            for t in push_versions[image_docker_path]:
-                                version_image_docker_path = f"{image_repository}/{image_name}:{image_tag}-{t}"
-                                self.logger.info(f"tagging image: {version_image_docker_path}")
-                                if not self.settings.args.dryrun:
-                                    try:
-                                        self.cli.tag(f"{image_docker_path}", f"{image_repository}/{image_name}", f"{image_tag}-{t}", force=True)
-                                    except self.errors.ImageNotFound as i_err:
-                                        self.logger.error(f"not found: {image_docker_path}")
-                                    except Exception as err:
-                                        self.logger.error(f"unknown error: {err}")
-                                #if save:
-                                    #self.logger.info(f"saving image: {version_image_docker_path}")
-                                    #if not self.settings.args.dryrun:
-                                        #    f = open('/tmp/busybox-latest.tar', 'wb')
-                                        #    for chunk in image:
-                                        #        f.write(chunk)
-                                        #    f.close()
-                                self.logger.info(f"Pushing: '{version_image_docker_path}'")
-                                if not self.settings.args.dryrun:
-                                    if self.settings.args.overwrite:
-                                        self.logger.warning(f"Overwriting image: '{version_image_docker_path}'")
-                                        self.cli.remove_image(version_image_docker_path, force=True)
-
-                                    pushstat.set_image(version_image_docker_path)
-                                    [pushstat.store(line) for line in self.cli.push(
-                                        version_image_docker_path, stream=True, decode=True
-                                    )]
-
+                            self.jobs.append({
+                                'index': image_count,
+                                'path': image_docker_path,
+                                'repository': image_repository,
+                                'name': image_name,
+                                'tag': image_tag,
+                                'args': image_args,
+                                'alias': image_copy_alias,
+                                'config': image,
+                                'dockerfile': dockerfile_path,
+                                'project_dir': project_dir,
+                                'lines': self.dockerfile_image_lines[image_count],
+                                'tags': push_versions[image_docker_path],
+                                'staged': [e for e in copy_elements if not e.startswith("--")],
+                                'key': Journal.key(image, self.dockerfile_image_lines[image_count], image_args, self.parent_key(self.dockerfile_image_lines[image_count])),
+                            })
                             image_count+=1
                         else:
                             self.logger.error(f"build failed: {image_docker_path}")
@@ -986,6 +1831,28 @@ class Docker(ABC):
                 self.logger.error(f"Project dir does not exists: '{project_dir.as_posix()}")
                 sys.exit()
 
+        self.planned = {
+            'pushstat': pushstat,
+            'project_files': project_files,
+            'final_image_docker_path': final_image_docker_path,
+            'user': user,
+            'group': group,
+            'pull_images': pull_images,
+            'pull_versions': pull_versions,
+        }
+
+    def execute(self):
+        pushstat = self.planned.get("pushstat")
+        project_files = self.planned.get("project_files")
+        final_image_docker_path = self.planned.get("final_image_docker_path")
+        user, group = self.planned.get("user"), self.planned.get("group")
+
+        ### Build queued images
+        if self.settings.args.multistage and len(self.jobs) > 1 and self.build_multistage(self.jobs, pushstat):
+            pass
+        else:
+            self.run_jobs(self.jobs, pushstat)
+
         # Append to project file tracker for later (optional)removal
         project_files.append(self.ops.build_dir)
 
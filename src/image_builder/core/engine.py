@@ -0,0 +1,251 @@
+import asyncio
+import codecs
+import json
+from abc import ABC
+from urllib.parse import quote, urlencode, urlparse
+
+import docker
+
+from ..internal import Logging, OperationError
+
+__all__ = ['AsyncDocker', 'EngineResponse']
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class EngineResponse(ABC):
+    def __init__(self, status, headers, reader, writer):
+        self.status = status
+        self.headers = headers
+        self.reader = reader
+        self.writer = writer
+
+    async def iter_body(self):
+        try:
+            if self.headers.get("transfer-encoding", "").lower() == "chunked":
+                while True:
+                    size = int((await self.reader.readline()).split(b";")[0].strip() or b"0", 16)
+                    if size == 0:
+                        await self.reader.readline()
+                        break
+                    yield await self.reader.readexactly(size)
+                    await self.reader.readexactly(2)
+            elif self.headers.get("content-length") is not None:
+                remaining = int(self.headers.get("content-length"))
+                while remaining > 0:
+                    chunk = await self.reader.read(min(remaining, CHUNK_SIZE))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+            else:
+                chunk = await self.reader.read(CHUNK_SIZE)
+                while chunk:
+                    yield chunk
+                    chunk = await self.reader.read(CHUNK_SIZE)
+        finally:
+            self.close()
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_body()])
+
+    async def json(self):
+        body = await self.read()
+        return json.loads(body) if body else None
+
+    async def json_stream(self):
+        # Objects may be split across (or share) chunks
+        decoder = json.JSONDecoder()
+        text = codecs.getincrementaldecoder('utf-8')()
+        buf = ""
+        async for chunk in self.iter_body():
+            buf += text.decode(chunk)
+            while True:
+                buf = buf.lstrip()
+                if not buf:
+                    break
+                try:
+                    obj, end = decoder.raw_decode(buf)
+                except ValueError:
+                    break
+                yield obj
+                buf = buf[end:]
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+class AsyncDocker(ABC):
+    """Docker engine API client for asyncio, over the unix socket or tcp.
+
+    One connection per request, so any number of builds, pulls and pushes can
+    stream concurrently from a single event loop. Failed requests raise the
+    docker-py errors APIClient would, so callers handle both clients alike.
+    """
+    def __init__(self, base_url='unix://var/run/docker.sock'):
+        self.logger = Logging()
+
+        self.base_url = base_url
+        url = urlparse(base_url)
+        if url.scheme in ['unix', 'http+unix']:
+            # docker-py style 'unix://var/run/docker.sock' is an absolute path
+            self.socket_path = "/" + (url.netloc + url.path).lstrip("/")
+            self.address = None
+        else:
+            self.socket_path = None
+            self.address = (url.hostname or 'localhost', url.port or 2375)
+        self.auth_configs = None
+
+    async def connect(self):
+        if self.socket_path:
+            return await asyncio.open_unix_connection(self.socket_path)
+        return await asyncio.open_connection(*self.address)
+
+    def url(self, pathfmt, *args):
+        return pathfmt.format(*[quote(a, safe="/:") for a in args])
+
+    async def request(self, method, path, params=None, body=None, headers=None):
+        reader, writer = await self.connect()
+        params = {k: v for k, v in (params or {}).items() if v is not None}
+        target = path + (f"?{urlencode(params)}" if params else "")
+        lines = [f"{method} {target} HTTP/1.1", "Host: docker", "Connection: close", "User-Agent: image-builder"]
+        lines.extend(f"{k}: {v}" for k, v in (headers or {}).items())
+        if body is None:
+            lines.append("Content-Length: 0")
+        elif isinstance(body, bytes):
+            lines.append(f"Content-Length: {len(body)}")
+        elif hasattr(body, "__len__"):
+            lines.append(f"Content-Length: {len(body)}")
+        else:
+            lines.append("Transfer-Encoding: chunked")
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode('latin-1'))
+
+        if isinstance(body, bytes):
+            writer.write(body)
+        elif body is not None:
+            # File reads run off the loop; the socket applies back pressure
+            chunked = not hasattr(body, "__len__")
+            loop = asyncio.get_running_loop()
+            chunk = await loop.run_in_executor(None, body.read, CHUNK_SIZE)
+            while chunk:
+                writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+                await writer.drain()
+                chunk = await loop.run_in_executor(None, body.read, CHUNK_SIZE)
+            if chunked:
+                writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+        status_line = await reader.readline()
+        try:
+            status = int(status_line.split()[1])
+        except (IndexError, ValueError):
+            writer.close()
+            raise OperationError(f"invalid response from '{self.base_url}': {status_line!r}")
+        response_headers = {}
+        while True:
+            line = await reader.readline()
+            if line in [b"\r\n", b"\n", b""]:
+                break
+            key, _, value = line.decode('latin-1').partition(":")
+            response_headers[key.strip().lower()] = value.strip()
+        return EngineResponse(status, response_headers, reader, writer)
+
+    async def check(self, response, action, not_found=docker.errors.NotFound):
+        if response.status < 400:
+            return response
+        body = await response.read()
+        try:
+            message = json.loads(body).get("message")
+        except ValueError:
+            message = body.decode('utf-8', 'replace').strip()
+        error = not_found if response.status == 404 else docker.errors.APIError
+        raise error(f"{action} failed ({response.status}): {message}")
+
+    def iterate(self, stream):
+        """Iterate a pull or push stream from synchronous code, line by line."""
+        loop = asyncio.new_event_loop()
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(stream.__anext__())
+                except StopAsyncIteration:
+                    return
+        finally:
+            loop.run_until_complete(stream.aclose())
+            loop.close()
+
+    def load_auth(self):
+        if not self.auth_configs or self.auth_configs.is_empty:
+            self.auth_configs = docker.auth.load_config()
+        return self.auth_configs
+
+    def auth_header(self, repository):
+        # X-Registry-Auth of the registry a pull or push talks to
+        registry, _ = docker.auth.resolve_repository_name(repository)
+        auth_config = docker.auth.resolve_authconfig(self.load_auth(), registry)
+        return {'X-Registry-Auth': docker.auth.encode_header(auth_config).decode('ascii')} if auth_config else {}
+
+    def registry_config(self):
+        """Return the X-Registry-Config header of every configured registry.
+
+        Builds may pull from any (or all) registries, so the whole auth
+        configuration is sent, as docker-py does.
+        """
+        auth_configs = self.load_auth()
+        auth_data = auth_configs.get_all_credentials() if auth_configs else {}
+        if docker.auth.INDEX_URL not in auth_data and docker.auth.INDEX_NAME in auth_data:
+            auth_data[docker.auth.INDEX_URL] = auth_data.get(docker.auth.INDEX_NAME, {})
+        return docker.auth.encode_header(auth_data).decode('ascii') if auth_data else None
+
+    async def build(self, fileobj, tag=None, buildargs=None, cache_from=None, rm=True, nocache=False):
+        params = {
+            't': tag,
+            'rm': 1 if rm else 0,
+            'nocache': 1 if nocache else None,
+            'buildargs': json.dumps(buildargs) if buildargs else None,
+            'cachefrom': json.dumps(cache_from) if cache_from else None,
+        }
+        # The daemon detects a gzip compressed context by itself
+        headers = {'Content-Type': 'application/x-tar'}
+        registry_config = self.registry_config()
+        if registry_config:
+            headers['X-Registry-Config'] = registry_config
+        response = await self.request("POST", "/build", params=params, body=fileobj, headers=headers)
+        await self.check(response, f"build '{tag}'")
+        async for line in response.json_stream():
+            yield line
+
+    async def inspect(self, reference):
+        """Return the image inspect data, or None when the image doesn't exist."""
+        response = await self.request("GET", self.url("/images/{0}/json", reference))
+        if response.status == 404:
+            response.close()
+            return None
+        await self.check(response, f"inspect '{reference}'")
+        return await response.json()
+
+    async def tag(self, image, repository, tag=None, force=False):
+        params = {'repo': repository, 'tag': tag, 'force': 1 if force else None}
+        response = await self.request("POST", self.url("/images/{0}/tag", image), params=params)
+        await self.check(response, f"tag '{image}'", not_found=docker.errors.ImageNotFound)
+        response.close()
+        return True
+
+    async def pull(self, repository, tag=None):
+        if not tag:
+            repository, tag = docker.utils.parse_repository_tag(repository)
+        params = {'fromImage': repository, 'tag': tag or 'latest'}
+        response = await self.request("POST", "/images/create", params=params, headers=self.auth_header(repository))
+        await self.check(response, f"pull '{repository}:{tag}'")
+        async for line in response.json_stream():
+            yield line
+
+    async def push(self, repository, tag=None):
+        if not tag:
+            repository, tag = docker.utils.parse_repository_tag(repository)
+        response = await self.request("POST", self.url("/images/{0}/push", repository), params={'tag': tag}, headers=self.auth_header(repository))
+        await self.check(response, f"push '{repository}:{tag}'")
+        async for line in response.json_stream():
+            yield line
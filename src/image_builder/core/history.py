@@ -0,0 +1,97 @@
+import json
+import os
+import tempfile
+import threading
+from abc import ABC
+from time import time
+
+from ..internal import Logging
+
+__all__ = ['TimingHistory']
+
+
+# Phases recorded per image, and the ones an image rebuild is estimated from
+PHASES = ['walk', 'tar', 'copy', 'cache_from', 'transfer', 'upload', 'build', 'tag', 'push', 'pull']
+BUILD_PHASES = ['walk', 'tar', 'copy', 'cache_from', 'transfer', 'upload', 'build', 'tag']
+# Cache keys remembered per image
+MAX_KEYS = 5
+
+
+class TimingHistory(ABC):
+    """Phase durations of past runs, by image path and cache key.
+
+    Shared by every run in the build directory. An estimate prefers the
+    timings recorded under the same cache key and falls back to the most
+    recent timings of the image.
+    """
+    def __init__(self, path, enabled=True):
+        self.logger = Logging()
+
+        self.path = path
+        self.enabled = enabled
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.read()
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as err:
+            self.logger.debug(f"ignoring timing history '{self.path}': {err}")
+            return
+        with self._lock:
+            for image, keys in entries.items():
+                merged = self.entries.setdefault(image, {})
+                for key, entry in keys.items():
+                    if entry.get("recorded", 0) > merged.get(key, {}).get("recorded", 0):
+                        merged[key] = entry
+
+    def write(self):
+        if not self.enabled:
+            return
+        # Merge with entries written by concurrent runs, then replace atomically
+        self.read()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                    json.dump(self.entries, f, indent=4)
+            os.replace(f.name, self.path)
+        except OSError as err:
+            self.logger.error(f"failed to write timing history: {err}")
+
+    def record(self, image, key, phases):
+        phases = {p: round(s, 3) for p, s in phases.items() if p in PHASES}
+        if not phases:
+            return
+        with self._lock:
+            keys = self.entries.setdefault(image, {})
+            keys[key] = {'phases': phases, 'recorded': time()}
+            for old in sorted(keys, key=lambda k: keys[k].get("recorded", 0))[:max(0, len(keys) - MAX_KEYS)]:
+                keys.pop(old)
+
+    def phases(self, image, key=None):
+        with self._lock:
+            keys = self.entries.get(image) or {}
+            entry = keys.get(key)
+            if entry is None and keys:
+                entry = max(keys.values(), key=lambda e: e.get("recorded", 0))
+            return dict(entry.get("phases")) if entry else None
+
+    def estimate(self, image, key=None, action='build', push=False):
+        """Return the expected seconds of an image, or None when it was never timed."""
+        phases = self.phases(image, key)
+        if not phases:
+            return None
+        if action == 'pull':
+            return phases.get("pull")
+        if phases.get("build") is None:
+            return None
+        seconds = sum([phases.get(p, 0.0) for p in BUILD_PHASES])
+        if push:
+            seconds += phases.get("push", 0.0)
+        return round(seconds, 3)
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import threading
+from abc import ABC
+from datetime import datetime
+
+from ..internal import Logging
+
+__all__ = ['Journal']
+
+
+class Journal(ABC):
+    """Append-only record of the completed phases of each image.
+
+    Every line holds the image, its cache key and one phase ('built' with the
+    image id, 'tagged' or 'pushed' with the reference). A resumed run replays
+    the file and skips work recorded under an unchanged key.
+    """
+    def __init__(self, path, resume=False, enabled=True):
+        self.logger = Logging()
+
+        self.path = path
+        self.enabled = enabled
+        self.entries = {}
+        self._lock = threading.Lock()
+        if resume:
+            self.replay()
+        elif enabled and os.path.exists(self.path):
+            os.remove(self.path)
+
+    @classmethod
+    def key(cls, config, lines, args=None, parent=None):
+        # A parent's key is chained in so rebuilt parents invalidate children
+        text = json.dumps({
+            'config': config,
+            'lines': [line.rstrip("\n") for line in lines],
+            'args': args,
+            'parent': parent,
+        }, sort_keys=True, default=str)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def replay(self):
+        if not os.path.exists(self.path):
+            self.logger.warning(f"no journal to resume from: '{self.path}'")
+            return
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn final line from an interrupted run
+                    continue
+                self.apply(record)
+        self.logger.info(f"resuming {len(self.entries)} images from: '{self.path}'")
+
+    def apply(self, record):
+        image = record.get("image")
+        entry = self.entries.get(image)
+        if entry is None or entry.get("key") != record.get("key"):
+            entry = self.entries[image] = {'key': record.get("key"), 'built': None, 'tagged': set(), 'pushed': set()}
+        if record.get("phase") == 'built':
+            entry['built'] = record.get("id")
+        elif record.get("phase") in ['tagged', 'pushed']:
+            entry[record.get("phase")].add(record.get("reference"))
+
+    def entry(self, image, key):
+        entry = self.entries.get(image)
+        if entry is None or entry.get("key") != key:
+            return None
+        return entry
+
+    def completed(self, image, key, phase, reference=None):
+        entry = self.entry(image, key)
+        if entry is None:
+            return False
+        if phase == 'built':
+            return entry.get("built") is not None
+        return reference in entry.get(phase)
+
+    def record(self, image, key, phase, **fields):
+        record = dict(time=datetime.now().isoformat(), image=image, key=key, phase=phase, **fields)
+        with self._lock:
+            self.apply(record)
+            if not self.enabled:
+                return
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
@@ -1,6 +1,9 @@
+import copy
 import grp
 import hashlib
+import itertools
 import os
+import re
 import pwd
 import shutil
 import sys
@@ -23,6 +26,10 @@ from ..internal import (
 __all__ = ['Operations']
 
 
+# Validated configs by (path, mtime, size), reused by later serve mode jobs
+_configs = {}
+
+
 class Operations(ABC):
     def __init__(self):
         self.logger = Logging()
@@ -38,7 +45,7 @@ class Operations(ABC):
         self.parent_dir = self.work_dir.parent
         # Load config
         try:
-            self.configs = self._load_config()
+            self.configs = self.expand_matrix(self._load_config())
         except LoadError as err:
             self.logger.error(f"'{err}'")
             sys.exit()     
@@ -65,12 +72,28 @@ class Operations(ABC):
             self.logger.save_logs(self.log_file.as_posix())
 
     def _load_config(self):
+        try:
+            st = os.stat(self.config_path)
+            config_key = (os.path.abspath(self.config_path), st.st_mtime_ns, st.st_size)
+        except OSError:
+            config_key = None
+        if config_key in _configs:
+            self.logger.debug(f"using validated config: '{self.config_path}'")
+            return copy.deepcopy(_configs.get(config_key))
+        loaded_config = self._validate_config()
+        if config_key is not None:
+            for key in [k for k in _configs if k[0] == config_key[0]]:
+                _configs.pop(key, None)
+            _configs[config_key] = copy.deepcopy(loaded_config)
+        return loaded_config
+
+    def _validate_config(self):
         if self.io.valid_file(self.config_path, logger=True):
             schema_paths = [
                 self.script_dir.joinpath('..', 'configs', 'schema.yaml'),
                 self.etc_path.joinpath('schema.yaml'),
             ]
-            print(schema_paths)
+            self.logger.debug(f"schema search paths: {[sp.as_posix() for sp in schema_paths]}")
             if any([self.io.valid_file(sp.as_posix()) for sp in schema_paths]):
                 for sp in schema_paths:
                     if self.io.valid_file(sp.as_posix()):
@@ -109,6 +132,44 @@ class Operations(ABC):
             self.logger.debug("No yaml config files available to load")
             sys.exit()
 
+    def expand_matrix(self, configs):
+        """Expand dockerfile entries with a 'matrix' block into one entry per variant.
+
+        Each combination is appended to the entry's args; the tag is formatted
+        with the combination, or suffixed with its values when it has no fields.
+        Values may be numbers, used as YAML reads them: 3.10 is "3.1" unless quoted.
+        """
+        group = 0
+        for project in configs.get("build").get("projects"):
+            dockerfiles = []
+            for image in project.get("dockerfiles"):
+                matrix = image.get("matrix")
+                if not matrix:
+                    dockerfiles.append(image)
+                    continue
+                keys = list(matrix.keys())
+                for values in itertools.product(*[matrix.get(k) for k in keys]):
+                    combo = dict(zip(keys, [str(v) for v in values]))
+                    variant = {k: v for k, v in image.items() if k != "matrix"}
+                    variant["args"] = list(image.get("args") or []) + [f"{k}={v}" for k, v in combo.items()]
+                    tag = image.get("tag") or "latest"
+                    if "{" in tag:
+                        try:
+                            tag = tag.format(**combo)
+                        except KeyError as err:
+                            raise LoadError(f"tag '{tag}' of '{image.get('name')}' uses {err}, which is not a matrix field of {keys}")
+                        except (AttributeError, IndexError, ValueError) as err:
+                            raise LoadError(f"invalid matrix tag '{tag}' of '{image.get('name')}': {err}")
+                    else:
+                        tag = "-".join([tag] + list(combo.values()))
+                    variant["tag"] = re.sub(r'[^A-Za-z0-9_.-]', '_', tag)
+                    variant["matrix_group"] = group
+                    self.logger.debug(f"matrix variant: '{variant.get('name')}:{variant.get('tag')}' {combo}")
+                    dockerfiles.append(variant)
+                group += 1
+            project["dockerfiles"] = dockerfiles
+        return configs
+
     def copy_file(self, source, target, check=True):
         success = False
         if self.io.valid_file(source):
@@ -0,0 +1,199 @@
+import json
+import os
+import stat
+import tempfile
+from abc import ABC
+
+from ..configs import Settings
+from ..internal import Logging
+
+__all__ = ['Planner']
+
+
+class Planner(ABC):
+    """Offline execution plan of a planned config.
+
+    Decides per image whether a run would pull, skip or build it from the
+    registry digest cache and the run journal only: nothing is pulled, built
+    or looked up. Estimates come from the timing history of past runs.
+
+    Context sizes are kept in the build directory with the mtimes of the
+    directories walked; a context is walked again only once one of them
+    changed, so files edited in place keep their last known size until then.
+    """
+    def __init__(self, builder=None):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        self.builder = builder
+        self.contexts = {}
+        self.lengths = {}
+        self.walks_path = builder.ops.build_dir.joinpath('context_walks.json').as_posix() if builder else None
+        self.walks = self.read_walks()
+        self.walks_changed = False
+
+    def pull_sources(self):
+        """Same search as the run: candidates with a known digest are hits.
+
+        Returns {index: (reference, entry)} of the images pulled, and the
+        index whose parents are skipped or None.
+        """
+        planned = self.builder.planned
+        pull_images = planned.get("pull_images")
+        candidates = self.builder.pull_candidates(pull_images, planned.get("pull_versions"))
+        pulled = {}
+        entries = {}
+        for idx, img, _, reference in candidates:
+            index = (len(pull_images) - 1) - idx
+            if index in pulled or not self.builder.image_pull(img):
+                continue
+            entry = self.builder.registry.cached(reference)
+            if entry is not None and entry.get("digest"):
+                entries[index] = entry
+                order = self.builder.pull_hit(pull_images, pulled, idx, reference)
+                if order is not None:
+                    break
+        else:
+            order = None
+        return {i: (reference, entries.get(i)) for i, reference in pulled.items()}, order
+
+    def read_walks(self):
+        if self.walks_path is None or not os.path.exists(self.walks_path):
+            return {}
+        try:
+            with open(self.walks_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as err:
+            self.logger.debug(f"ignoring context walks '{self.walks_path}': {err}")
+            return {}
+
+    def write_walks(self):
+        if not self.walks_changed:
+            return
+        directory = os.path.dirname(self.walks_path)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                json.dump(self.walks, f)
+            os.replace(f.name, self.walks_path)
+        except OSError as err:
+            self.logger.error(f"failed to write context walks: {err}")
+            return
+        self.walks_changed = False
+
+    def unchanged(self, root, dirs):
+        for path, mtime in dirs.items():
+            try:
+                if os.stat(os.path.join(root, path)).st_mtime_ns != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def context(self, job):
+        root = job.get("project_dir").as_posix()
+        exclude = self.builder.read_dockerignore(job.get("project_dir"))
+        if self.settings.args.minimal_context or job.get("config").get("minimal_context"):
+            exclude = self.builder.minimal_exclude(job, exclude)
+        key = json.dumps([root, list(exclude or [])])
+        if self.contexts.get(key) is None:
+            walk = self.walks.get(key)
+            if walk is None or not self.unchanged(root, walk.get("dirs")):
+                stats = {}
+                dirs = {}
+                files = self.builder.context_cache.walk(root, exclude, stats=stats, dirs=dirs)
+                size = sum([st.st_size for st in stats.values() if not stat.S_ISDIR(st.st_mode)])
+                walk = {'dirs': dirs, 'files': len(files), 'bytes': size}
+                self.walks[key] = walk
+                self.walks_changed = True
+            self.contexts[key] = {'root': root, 'files': walk.get("files"), 'bytes': walk.get("bytes")}
+        return self.contexts.get(key)
+
+    def estimate(self, job, action, pushes):
+        if action == 'skip':
+            return 0.0
+        return self.builder.timings.estimate(job.get("path"), job.get("key"), action, push=bool(pushes))
+
+    def image(self, job, action, reason, pulled=None):
+        journal = self.builder.journal
+        references = [f"{job.get('repository')}/{job.get('name')}:{job.get('tag')}-{t}" for t in job.get("tags") or []] if action != 'pull' else []
+        pushes = []
+        for reference in references:
+            if journal.completed(job.get("path"), job.get("key"), 'pushed', reference) and self.settings.args.resume:
+                continue
+            entry = self.builder.registry.cached(reference)
+            pushes.append({'reference': reference, 'registry_digest': entry.get("digest") if entry else None, 'known': entry is not None})
+        plan = {
+            'image': job.get("path"),
+            'action': action,
+            'reason': reason,
+            'key': job.get("key"),
+            'estimate_seconds': self.estimate(job, action, pushes),
+            'critical_path_seconds': round(self.lengths.get(job.get("path"), 0.0), 3),
+        }
+        if pulled:
+            plan['pull'] = pulled
+        if action == 'build':
+            plan['context'] = self.context(job)
+            plan['staged'] = job.get("staged")
+        if action != 'skip' or pushes:
+            plan['push'] = pushes
+        return plan
+
+    def plan(self):
+        jobs = self.builder.jobs
+        journal = self.builder.journal
+        sources, order = self.pull_sources()
+        self.lengths = self.builder.critical_paths(jobs)
+        images = []
+        for job in jobs:
+            if job.get("index") in sources:
+                reference, entry = sources.get(job.get("index"))
+                pulled = {'reference': reference, 'digest': entry.get("digest"), 'checked': entry.get("checked"), 'fresh': self.builder.registry.fresh(reference)}
+                images.append(self.image(job, 'pull', "digest known in the registry cache", pulled))
+            elif order is not None and job.get("index") < order:
+                images.append(self.image(job, 'skip', "parent of the pulled image"))
+            elif journal.completed(job.get("path"), job.get("key"), 'built'):
+                if self.settings.args.resume:
+                    images.append(self.image(job, 'skip', "built by a previous run (journal)"))
+                else:
+                    images.append(self.image(job, 'build', "unchanged since the last run, daemon cache hits likely"))
+            elif journal.entries.get(job.get("path")):
+                images.append(self.image(job, 'build', "changed since the last run"))
+            else:
+                images.append(self.image(job, 'build', "not built before"))
+        self.write_walks()
+        return {
+            'config': self.builder.ops.config_path.as_posix(),
+            'images': images,
+            'summary': self.summary(images),
+        }
+
+    def summary(self, images):
+        estimates = [i.get("estimate_seconds") for i in images]
+        contexts = [i.get("context") for i in images if i.get("context")]
+        return {
+            'images': len(images),
+            'build': len([i for i in images if i.get("action") == 'build']),
+            'pull': len([i for i in images if i.get("action") == 'pull']),
+            'skip': len([i for i in images if i.get("action") == 'skip']),
+            'context_bytes': sum([c.get("bytes") for c in contexts]),
+            'context_files': sum([c.get("files") for c in contexts]),
+            'staged_paths': sum([len(i.get("staged") or []) for i in images]),
+            'pushes': sum([len(i.get("push") or []) for i in images]),
+            'estimate_seconds': round(sum([e for e in estimates if e is not None]), 3),
+            'unestimated': len([e for e in estimates if e is None]),
+        }
+
+    def write(self, plan):
+        text = json.dumps(plan, indent=4)
+        if self.settings.args.plan == '-':
+            print(text)
+            return
+        try:
+            with open(self.settings.args.plan, 'w') as f:
+                f.write(text + "\n")
+        except OSError as err:
+            self.logger.error(f"failed to write plan: {err}")
+            return
+        self.logger.info(f"execution plan written to: '{self.settings.args.plan}'")
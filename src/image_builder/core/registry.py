@@ -0,0 +1,122 @@
+import json
+import os
+import tempfile
+import threading
+from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from time import time
+
+import docker
+
+from ..configs import Settings
+from ..internal import Logging
+
+__all__ = ['RegistryCache']
+
+
+class RegistryCache(ABC):
+    """Reference to manifest digest cache shared by runs in the build directory.
+
+    A digest of None records a reference known to be missing from the
+    registry. Entries older than ``--registry_ttl`` seconds are refreshed in
+    bulk, one concurrent manifest lookup per reference.
+    """
+    def __init__(self, path, base_url, tracer=None):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        self.path = path
+        self.base_url = base_url
+        self.tracer = tracer
+        self.ttl = self.settings.args.registry_ttl
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.read()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0 and not self.settings.args.dryrun
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (OSError, ValueError) as err:
+            self.logger.debug(f"ignoring registry cache '{self.path}': {err}")
+            return {}
+        with self._lock:
+            for reference, entry in entries.items():
+                if entry.get("checked", 0) > self.entries.get(reference, {}).get("checked", 0):
+                    self.entries[reference] = entry
+        return entries
+
+    def write(self):
+        # Merge with entries written by concurrent runs, then replace atomically
+        self.read()
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with self._lock:
+                with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                    json.dump(self.entries, f, indent=4)
+            os.replace(f.name, self.path)
+        except OSError as err:
+            self.logger.error(f"failed to write registry cache: {err}")
+
+    def fresh(self, reference):
+        entry = self.entries.get(reference)
+        return entry is not None and time() - entry.get("checked", 0) < self.ttl
+
+    def fetch(self, reference):
+        client = docker.APIClient(base_url=self.base_url)
+        try:
+            return reference, client.inspect_distribution(reference).get("Descriptor", {}).get("digest")
+        except docker.errors.NotFound:
+            return reference, None
+        except docker.errors.APIError as err:
+            # Unknown (e.g. unauthorized): leave it to the caller
+            self.logger.debug(f"registry lookup failed: '{reference}': {err}")
+            return reference, False
+        finally:
+            client.close()
+
+    def lookup(self, references, tracer=None):
+        """Return {reference: digest or None} for the references with a known state."""
+        if self.settings.args.dryrun:
+            return {}
+        references = list(dict.fromkeys(references))
+        if not self.enabled:
+            with ThreadPoolExecutor(max_workers=self.settings.args.cache_workers) as executor:
+                return {r: d for r, d in executor.map(self.fetch, references) if d is not False}
+        stale = [r for r in references if not self.fresh(r)]
+        tracer = tracer or self.tracer
+        if stale:
+            with tracer.span('registry', None, references=len(stale)) if tracer else nullcontext():
+                with ThreadPoolExecutor(max_workers=self.settings.args.cache_workers) as executor:
+                    results = list(executor.map(self.fetch, stale))
+            now = time()
+            with self._lock:
+                for reference, digest in results:
+                    if digest is not False:
+                        self.entries[reference] = {'digest': digest, 'checked': now}
+            self.write()
+        self.logger.debug(f"registry cache: {len(references) - len(stale)} hits, {len(stale)} refreshed")
+        return {r: self.entries.get(r).get("digest") for r in references if self.fresh(r)}
+
+    def cached(self, reference):
+        """Return the cache entry of a reference whatever its age, without a lookup."""
+        with self._lock:
+            return self.entries.get(reference)
+
+    def update(self, reference, digest):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.entries[reference] = {'digest': digest, 'checked': time()}
+
+    def invalidate(self, reference):
+        with self._lock:
+            self.entries.pop(reference, None)
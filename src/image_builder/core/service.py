@@ -0,0 +1,344 @@
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+import uuid
+from abc import ABC
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from time import time
+from urllib.parse import parse_qs, urlparse
+
+from ..configs import Settings
+from ..internal import Logging, Metrics
+from .batch import Batch
+from .context import ContextCache
+from .docker import Docker
+
+__all__ = ['BuildService']
+
+
+# Finished jobs kept for status and log requests
+MAX_JOBS = 1000
+# Flags that make no sense for a job run by the service, or that would let a
+# client read, write or remove files outside of the build directories
+REJECTED_FLAGS = ['--serve', '--watch', '--profile', '--metrics_port', '--metrics_file', '--rm_build_files', '--plan', '--save', '--load_cache']
+
+
+class UnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+class JobLogHandler(logging.Handler):
+    """Append each record to the log of the service job it was logged for."""
+    def __init__(self, service):
+        super().__init__()
+        self.service = service
+        self.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+
+    def emit(self, record):
+        jobs = getattr(record, 'job', ())
+        if not jobs:
+            return
+        self.service.append_log(jobs[0], self.format(record))
+
+
+class BuildService(ABC):
+    """Long-running builder accepting jobs over a unix socket or HTTP.
+
+    Every job is a config path plus CLI flags, built by its own Docker
+    instance with those flags. Jobs are queued and built ``--serve_workers``
+    at a time; validated configs, compiled patterns, tarred contexts and
+    registry digests stay warm in memory between jobs.
+
+    POST /jobs                {"config": path, "args": [flags], "cwd": dir}
+    GET  /jobs                status of every job
+    GET  /jobs/<id>           status of one job
+    GET  /jobs/<id>/logs      log lines, followed until the job ends (?follow=0 to not wait)
+    DELETE /jobs/<id>         cancel a queued job
+    """
+    def __init__(self):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        self.address = self.settings.args.serve
+        self.workers = max(1, self.settings.args.serve_workers)
+        self.caches = {
+            'context': ContextCache(revalidate=True),
+            'registry': {},
+            'pools': {},
+            'timings': {},
+            'metrics': Metrics(),
+        }
+        self.jobs = {}
+        self.queue = queue.Queue()
+        self.changed = threading.Condition()
+        self.server = None
+
+    def submit(self, request):
+        config = request.get("config") if isinstance(request, dict) else None
+        args = (request.get("args") if isinstance(request, dict) else None) or []
+        if not isinstance(config, str) or not isinstance(args, list) or not all([isinstance(a, str) for a in args]):
+            raise ValueError("expected {\"config\": path, \"args\": [flags]}")
+        if not os.path.isabs(config):
+            config = os.path.join(request.get("cwd") or os.getcwd(), config)
+        argv = [config] + args
+        try:
+            with Settings.override(argv):
+                settings = Settings()
+        except SystemExit:
+            raise ValueError(f"invalid arguments: {args}")
+        # Compared once parsed, so abbreviated and '=' forms are caught too
+        rejected = [f for f in REJECTED_FLAGS if getattr(settings.args, f[2:]) != settings.parser.get_default(f[2:])]
+        if rejected:
+            raise ValueError(f"flags not allowed for service jobs: {rejected}")
+        job = {
+            'id': uuid.uuid4().hex[:12],
+            'config': config,
+            'args': args,
+            'status': 'queued',
+            'submitted': datetime.now().isoformat(),
+            'started': None,
+            'finished': None,
+            'duration': None,
+            'error': None,
+            'logs': [],
+        }
+        with self.changed:
+            self.jobs[job.get("id")] = job
+            self.prune()
+        self.queue.put(job.get("id"))
+        self.logger.info(f"queued job {job.get('id')}: '{config}' {args}")
+        return self.status(job)
+
+    def prune(self):
+        finished = [j for j in self.jobs.values() if j.get("finished")]
+        for job in sorted(finished, key=lambda j: j.get("finished"))[:max(0, len(self.jobs) - MAX_JOBS)]:
+            self.jobs.pop(job.get("id"))
+
+    def cancel(self, job_id):
+        with self.changed:
+            job = self.jobs.get(job_id)
+            if job is None or job.get("status") != 'queued':
+                return False
+            job['status'] = 'cancelled'
+            job['finished'] = datetime.now().isoformat()
+            self.changed.notify_all()
+        return True
+
+    def status(self, job):
+        return {k: v for k, v in job.items() if k != 'logs'}
+
+    def append_log(self, job_id, line):
+        with self.changed:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                job.get("logs").append(line)
+                self.changed.notify_all()
+
+    def finish(self, job, status, error=None):
+        with self.changed:
+            job['status'] = status
+            job['error'] = error
+            job['finished'] = datetime.now().isoformat()
+            self.changed.notify_all()
+
+    def run(self, job):
+        with self.changed:
+            if job.get("status") != 'queued':
+                return
+            job['status'] = 'running'
+            job['started'] = datetime.now().isoformat()
+        self.logger.info(f"running job {job.get('id')}: '{job.get('config')}'")
+        start = time()
+        status, error = 'failed', None
+        with Settings.override([job.get("config")] + job.get("args")), Logging.job(job.get("id")):
+            try:
+                configs = Settings().args.configs
+                builder = Batch(caches=self.caches) if Batch.applies(configs) else Docker(caches=self.caches)
+                builder.build()
+                status = 'succeeded' if builder.build_success else 'failed'
+            except SystemExit as exit_err:
+                # Builds stop with sys.exit() on failure
+                error = f"exited: {exit_err.code}" if exit_err.code not in [None, 0] else "build failed"
+            except Exception as err:
+                self.logger.error(f"job {job.get('id')} failed: {err}")
+                error = str(err)
+            finally:
+                Logging().close_logs(job.get("id"))
+        job['duration'] = round(time() - start, 3)
+        self.finish(job, status, error)
+        self.logger.info(f"job {job.get('id')} {status} in {job.get('duration')}s")
+
+    def worker(self):
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                return
+            job = self.jobs.get(job_id)
+            if job is not None:
+                self.run(job)
+
+    def follow(self, job_id, offset, wait):
+        """Return (new log lines, finished) for a job, waiting up to wait seconds for more."""
+        with self.changed:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None, True
+            if wait and len(job.get("logs")) <= offset and not job.get("finished"):
+                self.changed.wait(wait)
+            return job.get("logs")[offset:], job.get("finished") is not None
+
+    def handler(self):
+        service = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, code, body):
+                data = json.dumps(body, indent=4).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def route(self):
+                # /jobs[/<id>[/<action>]], or None for any other path
+                url = urlparse(self.path)
+                parts = [p for p in url.path.split("/") if p]
+                if not parts or parts[0] != 'jobs' or len(parts) > 3:
+                    self.send_error(404)
+                    return None
+                return parts[1:] + [None] * (3 - len(parts)) + [parse_qs(url.query)]
+
+            def do_GET(self):
+                route = self.route()
+                if route is None:
+                    return
+                job_id, action, query = route
+                if job_id is None:
+                    with service.changed:
+                        self.send_json(200, [service.status(j) for j in service.jobs.values()])
+                    return
+                job = service.jobs.get(job_id)
+                if job is None:
+                    self.send_error(404, f"no job: {job_id}")
+                    return
+                if action is None:
+                    self.send_json(200, service.status(job))
+                elif action == 'logs':
+                    self.stream_logs(job_id, query.get('follow', ['1'])[0] not in ['0', 'false'])
+                else:
+                    self.send_error(404)
+
+            def stream_logs(self, job_id, follow):
+                # HTTP/1.0 style: the body ends when the connection closes
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; charset=utf-8')
+                self.end_headers()
+                offset = 0
+                try:
+                    while True:
+                        lines, finished = service.follow(job_id, offset, 1.0 if follow else 0)
+                        if lines is None:
+                            return
+                        if lines:
+                            self.wfile.write("".join(f"{line}\n" for line in lines).encode('utf-8'))
+                            self.wfile.flush()
+                            offset += len(lines)
+                        elif finished or not follow:
+                            return
+                except (BrokenPipeError, ConnectionResetError):
+                    return
+
+            def do_POST(self):
+                route = self.route()
+                if route is None:
+                    return
+                if route[0] is not None:
+                    self.send_error(404)
+                    return
+                try:
+                    # Read the body before answering, else the client gets a reset
+                    body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                    content_type = (self.headers.get('Content-Type') or "").split(";")[0].strip().lower()
+                    if content_type != 'application/json':
+                        self.send_json(415, {'error': "expected Content-Type: application/json"})
+                        return
+                    self.send_json(201, service.submit(json.loads(body or b"{}")))
+                except ValueError as err:
+                    self.send_json(400, {'error': str(err)})
+
+            def do_DELETE(self):
+                route = self.route()
+                if route is None:
+                    return
+                job_id, action, _ = route
+                if job_id is None or action is not None:
+                    self.send_error(404)
+                    return
+                if service.cancel(job_id):
+                    self.send_json(200, service.status(service.jobs.get(job_id)))
+                else:
+                    self.send_json(409, {'error': f"job is not queued: {job_id}"})
+
+            def log_message(self, format, *args):
+                service.logger.debug(f"serve: {format % args}")
+
+        return Handler
+
+    def bind(self):
+        if self.address.startswith("unix://"):
+            path = "/" + self.address[len("unix://"):].lstrip("/")
+            if os.path.exists(path):
+                # A socket left behind by a previous service
+                probe = socket.socket(socket.AF_UNIX)
+                try:
+                    probe.connect(path)
+                    raise OSError(f"address already in use: '{path}'")
+                except ConnectionRefusedError:
+                    os.remove(path)
+                finally:
+                    probe.close()
+            server = UnixHTTPServer(path, self.handler())
+            # Jobs run with the service's privileges: only its user may submit
+            os.chmod(path, 0o600)
+            return server, f"unix://{path}"
+        host, _, port = self.address.rpartition(":")
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), self.handler())
+        return server, f"http://{host or '127.0.0.1'}:{port}"
+
+    def serve(self):
+        try:
+            self.server, url = self.bind()
+        except (OSError, ValueError) as err:
+            self.logger.error(f"failed to start build service on '{self.address}': {err}")
+            return
+        log_handler = JobLogHandler(self)
+        self.logger.restart_listener(add=[log_handler])
+        threads = [threading.Thread(target=self.worker, name=f"serve-worker-{i}", daemon=True) for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        self.logger.info(f"build service listening on: '{url}' ({self.workers} workers)")
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            self.logger.info("stopping build service")
+        finally:
+            self.server.server_close()
+            if isinstance(self.server, UnixHTTPServer):
+                os.remove(self.server.server_address)
+            for _ in threads:
+                self.queue.put(None)
+            self.logger.restart_listener(remove=[log_handler])
+            self.caches.get("context").clear()
+            for registry in self.caches.get("registry").values():
+                if registry.enabled:
+                    registry.write()
@@ -0,0 +1,160 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+from abc import ABC
+from time import monotonic, sleep
+
+from ..helpers import PatternMatcher
+from ..internal import Logging
+
+__all__ = ['Watcher']
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Watcher(ABC):
+    """Report changed paths under a set of context roots.
+
+    Uses inotify through ctypes where available and falls back to polling
+    stat snapshots. Paths excluded by a root's .dockerignore are ignored and
+    excluded directories are never watched.
+    """
+    def __init__(self, roots, interval=1.0):
+        self.logger = Logging()
+
+        self.roots = {os.path.abspath(root): PatternMatcher(list(exclude or [])) for root, exclude in roots.items()}
+        self.interval = interval
+        self.fd = None
+        self.watches = {}
+        self.snapshot = {}
+        self.libc = None
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            self.fd = None
+        if self.fd is None or self.fd < 0:
+            self.fd = None
+            self.logger.info("inotify is not available, polling for changes")
+            self.snapshot = self.scan()
+        else:
+            for root in self.roots:
+                self.add_tree(root, root)
+            self.logger.debug(f"watching {len(self.watches)} directories")
+
+    def relative(self, root, path):
+        rel = os.path.relpath(path, root)
+        return "" if rel == "." else rel
+
+    def excluded(self, root, path):
+        rel = self.relative(root, path)
+        return bool(rel) and self.roots.get(root).matches(rel)
+
+    def add_tree(self, root, directory):
+        for current, dirs, _ in os.walk(directory):
+            dirs[:] = [d for d in dirs if not self.excluded(root, os.path.join(current, d))]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(current), WATCH_MASK)
+            if wd < 0:
+                self.logger.debug(f"cannot watch: '{current}' (errno {ctypes.get_errno()})")
+                continue
+            self.watches[wd] = (root, current)
+
+    def update(self, root, exclude):
+        """Replace the .dockerignore patterns of a root."""
+        root = os.path.abspath(root)
+        self.roots[root] = PatternMatcher(list(exclude or []))
+        if self.fd is not None:
+            # Directories the new patterns include are watched from now on
+            self.add_tree(root, root)
+        else:
+            # Paths still included keep their snapshot, so changes made since
+            # the last poll are reported
+            snapshot = {k: v for k, v in self.snapshot.items() if k[0] != root}
+            for key, value in self.scan([root]).items():
+                snapshot[key] = self.snapshot.get(key, value)
+            self.snapshot = snapshot
+
+    def scan(self, roots=None):
+        snapshot = {}
+        for root in roots or self.roots:
+            matcher = self.roots.get(root)
+            for path in matcher.walk(root):
+                try:
+                    st = os.lstat(os.path.join(root, path))
+                except OSError:
+                    continue
+                snapshot[(root, path)] = (st.st_mtime_ns, st.st_size, st.st_mode)
+        return snapshot
+
+    def read_events(self, timeout):
+        changes = {}
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changes
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changes
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            root, directory = self.watches.get(wd, (None, None))
+            if root is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            if self.excluded(root, path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(root, path)
+            changes.setdefault(root, set()).add(self.relative(root, path))
+        return changes
+
+    def poll(self, timeout):
+        sleep(min(timeout, self.interval) if timeout is not None else self.interval)
+        snapshot = self.scan()
+        changes = {}
+        for key in set(snapshot) ^ set(self.snapshot) | set(k for k in snapshot if self.snapshot.get(k) not in [None, snapshot.get(k)]):
+            changes.setdefault(key[0], set()).add(key[1])
+        self.snapshot = snapshot
+        return changes
+
+    def wait(self, debounce=0.5):
+        """Block until something changes, then collect until quiet for debounce seconds."""
+        changes = {}
+        while not changes:
+            changes = self.read_events(None) if self.fd is not None else self.poll(None)
+        quiet_since = monotonic()
+        while monotonic() - quiet_since < debounce:
+            more = self.read_events(debounce) if self.fd is not None else self.poll(debounce)
+            if more:
+                quiet_since = monotonic()
+                for root, paths in more.items():
+                    changes.setdefault(root, set()).update(paths)
+        return changes
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
@@ -1,2 +1,3 @@
+from .dockerfile import DockerfileParser
 from .io import InputOutput
 from .pattern import Pattern, PatternMatcher
\ No newline at end of file
@@ -0,0 +1,120 @@
+import json
+import posixpath
+from abc import ABC
+
+__all__ = ['DockerfileParser']
+
+
+class DockerfileParser(ABC):
+    def __init__(self, lines):
+        self.lines = lines
+        self.instructions = self.join(lines)
+
+    @classmethod
+    def join(cls, lines):
+        # Merge continuation lines into single instructions; comment lines
+        # are dropped, also within a continuation, as docker does
+        instructions = []
+        current = []
+        for line in lines:
+            stripped = line.strip()
+            if not stripped or stripped.startswith("#"):
+                continue
+            if stripped.endswith("\\"):
+                current.append(stripped[:-1].strip())
+                continue
+            current.append(stripped)
+            instructions.append(" ".join(c for c in current if c))
+            current = []
+        if current:
+            instructions.append(" ".join(c for c in current if c))
+        return instructions
+
+    @classmethod
+    def split(cls, instruction):
+        keyword, _, rest = instruction.partition(" ")
+        return keyword.upper(), rest.strip()
+
+    @classmethod
+    def parse_from(cls, instruction):
+        """Return (image, alias) of a FROM instruction."""
+        keyword, rest = cls.split(instruction)
+        if keyword != "FROM":
+            return (None, None)
+        tokens = [t for t in rest.split() if not t.startswith("--")]
+        image = tokens[0] if tokens else None
+        alias = tokens[2] if len(tokens) > 2 and tokens[1].lower() == "as" else None
+        return (image, alias)
+
+    @classmethod
+    def parse_copy(cls, instruction):
+        """Return (keyword, flags, sources, destination, json_form) of a COPY/ADD."""
+        keyword, rest = cls.split(instruction)
+        if keyword not in ["COPY", "ADD"]:
+            return None
+        flags = []
+        while rest.startswith("--"):
+            flag, _, rest = rest.partition(" ")
+            flags.append(flag)
+            rest = rest.strip()
+        json_form = False
+        paths = None
+        if rest.startswith("["):
+            try:
+                paths = json.loads(rest)
+                json_form = True
+            except ValueError:
+                paths = None
+        if paths is None:
+            paths = rest.split()
+        if len(paths) < 2:
+            return (keyword, flags, [], paths[0] if paths else None, json_form)
+        return (keyword, flags, paths[:-1], paths[-1], json_form)
+
+    @classmethod
+    def is_local_source(cls, flags, source):
+        if any(f.startswith("--from") for f in flags):
+            return False
+        return not source.startswith(("http://", "https://", "git@"))
+
+    def froms(self):
+        return [self.parse_from(i) for i in self.instructions if self.split(i)[0] == "FROM"]
+
+    def copy_sources(self):
+        """Return the context paths referenced by COPY/ADD instructions."""
+        sources = []
+        for instruction in self.instructions:
+            parsed = self.parse_copy(instruction)
+            if not parsed:
+                continue
+            keyword, flags, srcs, dst, json_form = parsed
+            for src in srcs:
+                if self.is_local_source(flags, src):
+                    sources.append(posixpath.normpath(src.lstrip("/") or "."))
+        return list(dict.fromkeys(sources))
+
+    @classmethod
+    def prefix_sources(cls, instruction, prefix):
+        """Rewrite local COPY/ADD sources to live under prefix in the context."""
+        parsed = cls.parse_copy(instruction)
+        if not parsed or prefix in ["", "."]:
+            return instruction
+        keyword, flags, srcs, dst, json_form = parsed
+        if not srcs:
+            return instruction
+        srcs = [
+            posixpath.join(prefix, s.lstrip("/")) if cls.is_local_source(flags, s) else s
+            for s in srcs
+        ]
+        if json_form:
+            paths = json.dumps(srcs + [dst])
+        else:
+            paths = " ".join(srcs + [dst])
+        return " ".join([keyword] + flags + [paths])
+
+    @classmethod
+    def replace_from(cls, instruction, image, alias=None):
+        keyword, rest = cls.split(instruction)
+        flags = [t for t in rest.split() if t.startswith("--")]
+        line = " ".join(["FROM"] + flags + [image])
+        return f"{line} AS {alias}" if alias else line
@@ -168,21 +168,34 @@ class PatternMatcher(ABC):
 
         return matched
 
-    def walk(self, root):
+    def walk(self, root, stats=None, dirs=None):
+        """Yield the paths under root that aren't excluded.
+
+        When a dict is given as stats, it's filled with the lstat result of
+        every yielded path, so callers don't have to stat them again. A dict
+        given as dirs gets the mtime of every directory read, taken before
+        reading it.
+        """
         def rec_walk(current_dir):
-            for f in os.listdir(current_dir):
+            if dirs is not None:
+                dirs[os.path.relpath(current_dir, root)] = os.stat(current_dir).st_mtime_ns
+            with os.scandir(current_dir) as entries:
+                entries = list(entries)
+            for entry in entries:
                 fpath = os.path.join(
-                    os.path.relpath(current_dir, root), f
+                    os.path.relpath(current_dir, root), entry.name
                 )
                 if fpath.startswith('.' + os.path.sep):
                     fpath = fpath[2:]
                 match = self.matches(fpath)
                 if not match:
+                    if stats is not None:
+                        stats[fpath] = entry.stat(follow_symlinks=False)
                     yield fpath
 
-                cur = os.path.join(root, fpath)
-                if not os.path.isdir(cur) or os.path.islink(cur):
+                if not entry.is_dir(follow_symlinks=False):
                     continue
+                cur = os.path.join(root, fpath)
 
                 if match:
                     # If we want to skip this file and it's a directory
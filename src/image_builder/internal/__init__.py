@@ -3,4 +3,7 @@ from .errors import (
     LoadError,
     OperationError
 )
-from .logger import Logging
\ No newline at end of file
+from .logger import Logging
+from .metrics import Metrics
+from .profiler import Profiler
+from .tracer import Tracer
\ No newline at end of file
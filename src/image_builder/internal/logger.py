@@ -1,7 +1,14 @@
-
+import atexit
+import contextvars
+import json
 import logging
+import os
+import queue
 import sys
+import threading
 from abc import ABC
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
 
 import coloredlogs
 
@@ -10,33 +17,181 @@ from ..configs import Settings
 __all__ = ['Logging']
 
 
+# Every Logging instance enqueues into one queue; handlers (console and
+# build.log) run on the listener thread, off the build's hot path.
+_queue = None
+_listener = None
+_files = {}
+_lock = threading.Lock()
+# Service jobs and batch configs the current context builds for, outermost
+# first; records are stamped with them
+_job = contextvars.ContextVar('log_job', default=())
+# Sampling counters of the build the current context runs (see
+# Logging.sampling), else of its jobs in _samples
+_build_samples = contextvars.ContextVar('log_samples', default=None)
+_samples = {}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        if getattr(record, 'category', None):
+            entry['category'] = record.category
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class JobQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record.job = _job.get()
+        return super().prepare(record)
+
+
+class JobFilter(logging.Filter):
+    def __init__(self, job):
+        super().__init__()
+        self.job = job
+
+    def filter(self, record):
+        return self.job in getattr(record, 'job', ())
+
+
 class Logging(ABC):
-    def __init__(self):        
+    def __init__(self):
         self.settings = Settings()
-        
+
         self.setup_logging()
         self.color_logs()
-        
+
         self.critical = self.log.critical
         self.error = self.log.error
         self.warning = self.log.warning
         self.info = self.log.info
         self.debug = self.log.debug
-    
+        self.sample_limit = self.settings.args.log_sample
+
     def setup_logging(self):
         logging.basicConfig(
             format='[%(levelname)s] %(message)s',
             level=logging.INFO,
             stream=sys.stdout)
-        self.log = logging.getLogger(__name__)   
-        self.log.setLevel(self.settings.args.log_level.upper())
-    
+        self.log = logging.getLogger(__name__)
+        if not _job.get():
+            # Service jobs share the logger; they log at the service's level
+            self.log.setLevel(self.settings.args.log_level.upper())
+
     def color_logs(self):
-        coloredlogs.install(fmt='[%(levelname)s] %(message)s', level=self.settings.args.log_level.upper(), logger=self.log)
+        global _queue, _listener
+        with _lock:
+            if _queue is not None:
+                return
+            if self.settings.args.log_format == 'json':
+                console = logging.StreamHandler(sys.stdout)
+                console.setFormatter(JsonFormatter())
+                handlers = [console]
+            else:
+                # Let coloredlogs build its handler, then move it behind the queue
+                sink = logging.getLogger(f"{__name__}.console")
+                coloredlogs.install(fmt='[%(levelname)s] %(message)s', level=self.settings.args.log_level.upper(), logger=sink)
+                handlers, sink.handlers = list(sink.handlers), []
+                if not handlers:
+                    console = logging.StreamHandler(sys.stdout)
+                    console.setFormatter(logging.Formatter('[%(levelname)s] %(message)s'))
+                    handlers = [console]
+            _queue = queue.SimpleQueue()
+            _listener = QueueListener(_queue, *handlers, respect_handler_level=True)
+            _listener.start()
+            atexit.register(_listener_stop)
+            self.log.handlers = [JobQueueHandler(_queue)]
+            self.log.propagate = False
+
+    @staticmethod
+    @contextmanager
+    def job(job_id):
+        token = _job.set(_job.get() + (job_id,))
+        try:
+            yield
+        finally:
+            _job.reset(token)
+
+    def restart_listener(self, add=None, remove=None):
+        global _listener
+        with _lock:
+            handlers = [h for h in _listener.handlers if h not in (remove or [])] + list(add or [])
+            if handlers != list(_listener.handlers):
+                # Records queued meanwhile are picked up by the new listener
+                _listener.stop()
+                _listener = QueueListener(_queue, *handlers, respect_handler_level=True)
+                _listener.start()
+        for handler in remove or []:
+            handler.close()
 
     def save_logs(self, path):
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
+        job = _job.get()[-1] if _job.get() else None
+        options = (job, self.settings.args.log_level, self.settings.args.log_format)
+        if _files.get(path, (None, None, None))[2] == options and os.path.exists(path):
+            # Every Operations of a run saves to the same build.log
+            return
+        if self.settings.args.log_format == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(message)s')
         fh = logging.FileHandler(path)
         fh.setLevel(self.settings.args.log_level.upper())
         fh.setFormatter(formatter)
-        self.log.addHandler(fh)
\ No newline at end of file
+        if job is not None:
+            # Concurrent jobs and batch configs each log to their own build.log
+            fh.addFilter(JobFilter(job))
+        previous = _files.pop(path, None)
+        _files[path] = (job, fh, options)
+        self.restart_listener(add=[fh], remove=[previous[1]] if previous else None)
+
+    def close_logs(self, job_id):
+        handlers = []
+        for path in [p for p, (job, _, _) in _files.items() if job == job_id]:
+            handlers.append(_files.pop(path)[1])
+        if handlers:
+            self.restart_listener(remove=handlers)
+
+    @staticmethod
+    @contextmanager
+    def sampling():
+        """Count sampled messages apart from concurrent builds (matrix variants)."""
+        token = _build_samples.set({})
+        try:
+            yield
+        finally:
+            _build_samples.reset(token)
+
+    def sample(self, category, level, msg, *args):
+        """Log the first --log_sample messages of a category, then one in every --log_sample."""
+        if not self.log.isEnabledFor(level):
+            return
+        counts = _build_samples.get()
+        key = category if counts is not None else (_job.get(), category)
+        with _lock:
+            counts = _samples if counts is None else counts
+            count = counts[key] = counts.get(key, 0) + 1
+        if self.sample_limit and count > self.sample_limit and count % self.sample_limit:
+            return
+        self.log.log(level, msg, *args, extra={'category': category})
+
+    def summary(self, category, level=logging.DEBUG):
+        counts = _build_samples.get()
+        key = category if counts is not None else (_job.get(), category)
+        with _lock:
+            count = (_samples if counts is None else counts).pop(key, 0)
+        if self.sample_limit and count > self.sample_limit:
+            shown = self.sample_limit + (count - self.sample_limit) // self.sample_limit
+            self.log.log(level, f"{category}: {count} messages, {shown} shown", extra={'category': category})
+
+
+def _listener_stop():
+    with _lock:
+        if _listener is not None:
+            _listener.stop()
@@ -0,0 +1,149 @@
+import os
+import tempfile
+import threading
+from abc import ABC
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from ..configs import Settings
+from .logger import Logging
+
+__all__ = ['Metrics']
+
+
+SIZE_BUCKETS = [2**20, 10 * 2**20, 100 * 2**20, 2**30, 10 * 2**30]
+TIME_BUCKETS = [0.1, 0.5, 1, 5, 15, 60, 300, 900]
+RATE_BUCKETS = [2**20, 10 * 2**20, 50 * 2**20, 100 * 2**20, 500 * 2**20]
+
+
+class Metrics(ABC):
+    """Builder counters and histograms in the Prometheus text format.
+
+    Written to ``--metrics_file`` (textfile collector) after every image and
+    served live on ``--metrics_port`` when set.
+    """
+    def __init__(self):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        # Shared metrics keep the file of the run (or service) that made them
+        self.path = self.settings.args.metrics_file
+        self.counters = {}
+        self.histograms = {}
+        self.help = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+        self.describe('image_builder_images_total', 'counter', 'Images processed by result (built, skipped, pulled, cached, failed)')
+        self.describe('image_builder_build_steps_total', 'counter', 'Dockerfile steps executed by the daemon')
+        self.describe('image_builder_build_cache_hits_total', 'counter', 'Dockerfile steps served from the daemon cache')
+        self.describe('image_builder_pushes_total', 'counter', 'Tag pushes by result (pushed, tagged, skipped)')
+        self.describe('image_builder_failures_total', 'counter', 'Build failures by category')
+        self.describe('image_builder_context_bytes', 'histogram', 'Build context size in bytes', SIZE_BUCKETS)
+        self.describe('image_builder_context_walk_seconds', 'histogram', 'Time spent walking the build context', TIME_BUCKETS)
+        self.describe('image_builder_build_seconds', 'histogram', 'Time spent in the daemon build', TIME_BUCKETS)
+        self.describe('image_builder_push_bytes_per_second', 'histogram', 'Registry push throughput', RATE_BUCKETS)
+
+        if self.settings.args.metrics_port:
+            self.serve(self.settings.args.metrics_port)
+
+    def describe(self, name, kind, text, buckets=None):
+        self.help[name] = (kind, text, buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        buckets = self.help.get(name)[2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if self.histograms.get(key) is None:
+                self.histograms[key] = {'buckets': [0] * len(buckets), 'sum': 0, 'count': 0}
+            hist = self.histograms[key]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    def observe_span(self, record):
+        phase = record.get("phase")
+        counters = record.get("counters")
+        duration = record.get("end") - record.get("start")
+        if phase == 'walk':
+            self.observe('image_builder_context_walk_seconds', duration)
+        elif phase == 'upload' and counters.get("bytes") is not None:
+            self.observe('image_builder_context_bytes', counters.get("bytes"))
+        elif phase == 'build':
+            self.observe('image_builder_build_seconds', duration)
+        elif phase == 'push' and counters.get("bytes") and duration > 0:
+            self.observe('image_builder_push_bytes_per_second', counters.get("bytes") / duration)
+
+    def render(self):
+        def fmt_labels(labels, extra=None):
+            pairs = list(labels) + (extra or [])
+            if not pairs:
+                return ""
+            escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs]
+            return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+        lines = []
+        with self._lock:
+            for name, (kind, text, buckets) in self.help.items():
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                if kind == 'counter':
+                    for (n, labels), value in self.counters.items():
+                        if n == name:
+                            lines.append(f"{name}{fmt_labels(labels)} {value}")
+                elif kind == 'histogram':
+                    for (n, labels), hist in self.histograms.items():
+                        if n != name:
+                            continue
+                        for bound, count in zip(buckets, hist['buckets']):
+                            lines.append(f"{name}_bucket{fmt_labels(labels, [('le', bound)])} {count}")
+                        lines.append(f"{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {hist['count']}")
+                        lines.append(f"{name}_sum{fmt_labels(labels)} {hist['sum']}")
+                        lines.append(f"{name}_count{fmt_labels(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path=None):
+        path = path or self.path
+        if not path:
+            return
+        # Write atomically so the textfile collector never reads a partial file
+        directory = os.path.dirname(os.path.abspath(path))
+        try:
+            with tempfile.NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                f.write(self.render())
+            os.chmod(f.name, 0o644)
+            os.replace(f.name, path)
+        except OSError as err:
+            self.logger.error(f"failed to write metrics: {err}")
+
+    def serve(self, port):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ['/', '/metrics']:
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                metrics.logger.debug(f"metrics: {format % args}")
+
+        try:
+            self._server = ThreadingHTTPServer(('', port), Handler)
+        except OSError as err:
+            self.logger.error(f"failed to start metrics endpoint on port {port}: {err}")
+            return
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        self.logger.info(f"serving metrics on: 'http://0.0.0.0:{port}/metrics'")
@@ -0,0 +1,121 @@
+import cProfile
+import io
+import os
+import pstats
+import threading
+import tracemalloc
+from abc import ABC
+
+from ..configs import Settings
+from .logger import Logging
+
+__all__ = ['Profiler']
+
+
+class Profiler(ABC):
+    """Profile the build pipeline with one cProfile per tracer phase.
+
+    Time spent outside any phase is attributed to the 'run' profile. Only the
+    thread that started the profiler is profiled.
+    """
+    def __init__(self):
+        self.logger = Logging()
+        self.settings = Settings()
+
+        self.mode = self.settings.args.profile
+        self.top = self.settings.args.profile_top
+        self.memory = self.settings.args.profile_memory
+        self.profiles = {}
+        self.stack = []
+        self.sampler = None
+        self.peak_memory = None
+        self.memory_stats = []
+        self._thread = None
+
+    def _owner(self):
+        return threading.get_ident() == self._thread
+
+    def enter(self, phase):
+        if self.sampler is not None or not self._owner():
+            return
+        if self.stack:
+            self.profiles[self.stack[-1]].disable()
+        self.stack.append(phase)
+        if self.profiles.get(phase) is None:
+            self.profiles[phase] = cProfile.Profile()
+        self.profiles[phase].enable()
+
+    def exit(self):
+        if self.sampler is not None or not self._owner() or not self.stack:
+            return
+        self.profiles[self.stack.pop()].disable()
+        if self.stack:
+            self.profiles[self.stack[-1]].enable()
+
+    def start(self):
+        self._thread = threading.get_ident()
+        if self.memory:
+            tracemalloc.start(25)
+        if self.mode == 'sampling':
+            try:
+                from pyinstrument import Profiler as Sampler
+            except ImportError:
+                self.logger.warning("pyinstrument is not installed, falling back to cProfile")
+                self.mode = 'cprofile'
+            else:
+                self.sampler = Sampler()
+                self.sampler.start()
+                self.logger.info("profiling build with sampling profiler")
+                return
+        self.logger.info("profiling build with cProfile")
+        self.enter('run')
+
+    def stop(self):
+        if self.sampler is not None:
+            self.sampler.stop()
+        while self.stack:
+            self.exit()
+        if self.memory and tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            self.memory_stats = tracemalloc.take_snapshot().statistics('lineno')[:self.top]
+            tracemalloc.stop()
+
+    def report(self):
+        out = io.StringIO()
+        if self.sampler is not None:
+            out.write(self.sampler.output_text(unicode=True, color=False))
+        else:
+            totals = []
+            for phase, profile in self.profiles.items():
+                totals.append((pstats.Stats(profile).total_tt, phase))
+            out.write("Time per phase (seconds)\n")
+            for total, phase in sorted(totals, reverse=True):
+                out.write(f"  {phase.ljust(12)} {total:10.3f}\n")
+            if self.profiles:
+                out.write(f"\nTop {self.top} functions (cumulative, all phases)\n")
+                combined = pstats.Stats(*self.profiles.values(), stream=out)
+                combined.sort_stats('cumulative').print_stats(self.top)
+                for phase, profile in self.profiles.items():
+                    out.write(f"\nTop {self.top} functions in phase '{phase}' (own time)\n")
+                    pstats.Stats(profile, stream=out).sort_stats('tottime').print_stats(self.top)
+        if self.peak_memory is not None:
+            out.write(f"\nPeak traced memory: {self.peak_memory} bytes\n")
+            for stat in self.memory_stats:
+                out.write(f"  {stat}\n")
+        return out.getvalue()
+
+    def save(self, directory):
+        report = self.report()
+        if not os.path.isdir(directory):
+            print(report)
+            return
+        profile_dir = os.path.join(directory, 'profile')
+        os.makedirs(profile_dir, exist_ok=True)
+        for phase, profile in self.profiles.items():
+            profile.dump_stats(os.path.join(profile_dir, f"{phase}.prof"))
+        if self.profiles:
+            pstats.Stats(*self.profiles.values()).dump_stats(os.path.join(profile_dir, 'all.prof'))
+        report_path = os.path.join(profile_dir, 'report.txt')
+        with open(report_path, 'w') as f:
+            f.write(report)
+        self.logger.info(f"profile written to: '{profile_dir}'")
@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from abc import ABC
+from contextlib import contextmanager
+from time import perf_counter
+
+from rich import box
+from rich.console import Console
+from rich.table import Table
+
+from .logger import Logging
+
+__all__ = ['Tracer']
+
+
+class Tracer(ABC):
+    """Collect per-image phase spans and export them as a Chrome trace.
+
+    Spans are recorded with ``span(phase, image)``; the yielded dict holds
+    counters (bytes, files, ...) that the caller fills in while the phase runs.
+    """
+    def __init__(self):
+        self.logger = Logging()
+
+        self.spans = []
+        self.lanes = {}
+        self.listeners = []
+        self.profiler = None
+        self._lock = threading.Lock()
+        self._origin = perf_counter()
+
+    @contextmanager
+    def span(self, phase, image=None, **counters):
+        record = {
+            'phase': phase,
+            'image': image,
+            'counters': dict(counters),
+            'start': perf_counter(),
+            'end': None,
+        }
+        if self.profiler:
+            self.profiler.enter(phase)
+        try:
+            yield record['counters']
+        finally:
+            record['end'] = perf_counter()
+            if self.profiler:
+                self.profiler.exit()
+            with self._lock:
+                if image not in self.lanes:
+                    self.lanes[image] = len(self.lanes)
+                self.spans.append(record)
+            for listener in self.listeners:
+                listener(record)
+
+    def phases(self):
+        phases = []
+        for s in self.spans:
+            if s.get("phase") not in phases:
+                phases.append(s.get("phase"))
+        return phases
+
+    def summary(self):
+        images = {}
+        for s in self.spans:
+            image = s.get("image") or "run"
+            if images.get(image) is None:
+                images[image] = {'phases': {}, 'counters': {}, 'total': 0.0}
+            duration = s.get("end") - s.get("start")
+            phases = images[image]['phases']
+            phases[s.get("phase")] = phases.get(s.get("phase"), 0.0) + duration
+            images[image]['total'] += duration
+            for k, v in s.get("counters").items():
+                if isinstance(v, (int, float)):
+                    images[image]['counters'][k] = images[image]['counters'].get(k, 0) + v
+        return images
+
+    def chrome_trace(self):
+        pid = os.getpid()
+        events = []
+        for image, lane in self.lanes.items():
+            events.append({
+                'name': 'thread_name',
+                'ph': 'M',
+                'pid': pid,
+                'tid': lane,
+                'args': {'name': image or 'run'},
+            })
+        for s in self.spans:
+            events.append({
+                'name': s.get("phase"),
+                'cat': 'build',
+                'ph': 'X',
+                'ts': round((s.get("start") - self._origin) * 1e6, 3),
+                'dur': round((s.get("end") - s.get("start")) * 1e6, 3),
+                'pid': pid,
+                'tid': self.lanes.get(s.get("image")),
+                'args': dict(s.get("counters"), image=s.get("image")),
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def table(self):
+        phases = self.phases()
+        table = Table(title="Build phases (seconds)", box=box.SIMPLE)
+        table.add_column("Image")
+        for phase in phases:
+            table.add_column(phase, justify="right")
+        table.add_column("total", justify="right")
+        table.add_column("counters")
+        for image, stats in self.summary().items():
+            row = [image]
+            for phase in phases:
+                duration = stats['phases'].get(phase)
+                row.append(f"{duration:.2f}" if duration is not None else "-")
+            row.append(f"{stats['total']:.2f}")
+            row.append(", ".join(f"{k}={v}" for k, v in stats['counters'].items()))
+            table.add_row(*row)
+        return table
+
+    def save(self, directory):
+        if not self.spans:
+            return
+        trace_path = os.path.join(directory, 'trace.json')
+        summary_path = os.path.join(directory, 'trace_summary.txt')
+        try:
+            with open(trace_path, 'w') as f:
+                json.dump(self.chrome_trace(), f)
+            with open(summary_path, 'w') as f:
+                Console(file=f, width=200).print(self.table())
+        except OSError as err:
+            self.logger.error(f"failed to write trace: {err}")
+            return
+        self.logger.info(f"trace written to: '{trace_path}'")
+
+    def show(self):
+        if self.spans:
+            Console().print(self.table())
@@ -0,0 +1,74 @@
+import docker
+import pytest
+
+from image_builder.configs import Settings
+
+CONFIG = """\
+version: "1"
+info:
+  name: demo
+  tags: ["v1"]
+  build_dir: {build_dir}
+build:
+  base: ubuntu:20.04
+  projects:
+    - directory: proj
+      dockerfiles:
+{dockerfiles}
+"""
+
+DOCKERFILE = """\
+        - file: {file}
+          repository: repo
+          name: {name}
+          tag: "{tag}"
+"""
+
+
+class FakeClient:
+    """A docker.APIClient that talks to no daemon and knows no images."""
+    def __init__(self, base_url=None, **kwargs):
+        self.base_url = base_url
+
+    def version(self):
+        return {'Version': 'test'}
+
+    def inspect_image(self, reference):
+        raise docker.errors.ImageNotFound(reference)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def arguments():
+    # Settings parse sys.argv, which holds pytest's own arguments
+    with Settings.override(argv=['default']):
+        yield
+
+
+@pytest.fixture
+def fake_daemon(monkeypatch):
+    monkeypatch.setattr(docker, 'APIClient', FakeClient)
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    """Write a config and its project.
+
+    Images are (name, tag, Dockerfile text) tuples, optionally followed by
+    more YAML lines for the image entry. Configs of one test share their
+    project and build directory.
+    """
+    def make(images, extra="", filename="build.yaml"):
+        (tmp_path / "proj").mkdir(exist_ok=True)
+        (tmp_path / "cfg").mkdir(exist_ok=True)
+        dockerfiles = []
+        for name, tag, text, *entry in images:
+            (tmp_path / "proj" / f"Dockerfile.{name}").write_text(text)
+            dockerfiles.append(DOCKERFILE.format(file=f"Dockerfile.{name}", name=name, tag=tag))
+            dockerfiles.extend(f"          {line}\n" for line in entry)
+        config = tmp_path / "cfg" / filename
+        config.write_text(CONFIG.format(build_dir=tmp_path / "out", dockerfiles="".join(dockerfiles)) + extra)
+        return config.as_posix()
+    return make
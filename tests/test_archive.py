@@ -0,0 +1,172 @@
+import io
+import json
+import os
+import tarfile
+
+import docker
+import pytest
+import requests
+
+from image_builder.configs import Settings
+from image_builder.core import Archive
+from image_builder.core.archive import CHUNK_SIZE, INDEX_NAME, append_tar_member
+from image_builder.internal import OperationError
+
+
+def make_tar(members):
+    buf = io.BytesIO()
+    with tarfile.open(mode='w', fileobj=buf) as tar:
+        for name, data in members.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def read_tar(data):
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+
+
+def split(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+MEMBERS = {
+    'manifest.json': b"[]",
+    'layer/layer.tar': bytes(range(256)) * 9,
+    'empty': b"",
+    'block': b"x" * 512,
+}
+
+
+@pytest.mark.parametrize('size', [1, 100, 511, 512, 513, 4096, 10**6])
+def test_append_tar_member(size):
+    data = make_tar(MEMBERS)
+
+    result = b"".join(append_tar_member(split(data, size), INDEX_NAME, b"{}"))
+
+    assert read_tar(result) == dict(MEMBERS, **{INDEX_NAME: b"{}"})
+    # The original members are passed through untouched
+    end = sum([512 + -(-len(d) // 512) * 512 for d in MEMBERS.values()])
+    assert result.startswith(data[:end])
+
+
+def test_append_tar_member_to_empty_archive():
+    result = b"".join(append_tar_member([make_tar({})], INDEX_NAME, b"{}"))
+
+    assert read_tar(result) == {INDEX_NAME: b"{}"}
+
+
+class SavingClient:
+    """An APIClient saving images from a canned archive."""
+    archive = make_tar(MEMBERS)
+    calls = []
+
+    def __init__(self, base_url=None, **kwargs):
+        self.base_url = base_url
+        self.api_version = '1.41'
+
+    def inspect_image(self, reference):
+        return {'Id': f"sha256:{reference}"}
+
+    def get_image(self, image, chunk_size=None):
+        self.calls.append(('get_image', image, chunk_size))
+        return iter(split(self.archive, chunk_size))
+
+    def get(self, url, params=None, stream=False):
+        self.calls.append(('get', url, params.get("names")))
+        return SavedResponse(self.archive)
+
+    def close(self):
+        pass
+
+
+class SavedResponse:
+    def __init__(self, archive, status_code=200):
+        self.archive = archive
+        self.status_code = status_code
+        self.reason = 'OK' if status_code < 400 else 'Internal Server Error'
+        self.url = 'unix://docker.sock/v1.41/images/get'
+
+    def iter_content(self, chunk_size):
+        return iter(split(self.archive, chunk_size))
+
+
+@pytest.fixture
+def saving_daemon(monkeypatch):
+    SavingClient.calls = []
+    monkeypatch.setattr(docker, 'APIClient', SavingClient)
+
+
+@pytest.mark.parametrize('references, call', [
+    (['repo/base:v1'], ('get_image', 'repo/base:v1', CHUNK_SIZE)),
+    (['repo/base:v1', 'repo/child:v1'], ('get', 'unix://docker.sock/v1.41/images/get', ['repo/base:v1', 'repo/child:v1'])),
+])
+def test_export_bundle(tmp_path, saving_daemon, references, call):
+    with Settings.override(argv=['default', '--save', str(tmp_path), '--save_compression', 'none']):
+        archive = Archive('unix://docker.sock', name='demo')
+    path = archive.export_bundle(references)
+    archive.close()
+
+    assert SavingClient.calls == [call]
+    with open(path, 'rb') as f:
+        members = read_tar(f.read())
+    index = json.loads(members.pop(INDEX_NAME))
+    assert members == MEMBERS
+    assert index.get("images") == [{'reference': r, 'id': f"sha256:{r}"} for r in references]
+
+
+def test_export_bundle_error(tmp_path, saving_daemon, monkeypatch):
+    monkeypatch.setattr(SavingClient, 'get', lambda self, url, params=None, stream=False: SavedResponse(b"", 500))
+    with Settings.override(argv=['default', '--save', str(tmp_path)]):
+        archive = Archive('unix://docker.sock', name='demo')
+
+    with pytest.raises(OperationError):
+        archive.export_bundle(['repo/base:v1', 'repo/child:v1'])
+    archive.close()
+
+
+def broken_stream(data):
+    yield data
+    raise requests.exceptions.ChunkedEncodingError("connection broken")
+
+
+@pytest.mark.parametrize('compression', ['none', 'gzip'])
+def test_write_removes_partial_file_on_read_errors(tmp_path, compression):
+    with Settings.override(argv=['default', '--save', str(tmp_path), '--save_compression', compression]):
+        archive = Archive('unix://docker.sock', name='demo')
+    path = str(tmp_path / "base.tar")
+
+    with pytest.raises(OperationError, match="connection broken"):
+        archive.write(broken_stream(b"x" * 1024), path)
+    archive.close()
+
+    assert os.listdir(tmp_path) == []
+
+
+def test_export_connection_error(tmp_path, saving_daemon, monkeypatch):
+    def refused(self, image, chunk_size=None):
+        raise requests.exceptions.ConnectionError("connection refused")
+
+    monkeypatch.setattr(SavingClient, 'get_image', refused)
+    with Settings.override(argv=['default', '--save', str(tmp_path)]):
+        archive = Archive('unix://docker.sock', name='demo')
+
+    with pytest.raises(OperationError, match="connection refused"):
+        archive.export('repo/base:v1')
+    archive.close()
+
+
+def test_wait_reports_unexpected_errors(tmp_path, saving_daemon, monkeypatch):
+    def fail(self, image, chunk_size=None):
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(SavingClient, 'get_image', fail)
+    with Settings.override(argv=['default', '--save', str(tmp_path)]):
+        archive = Archive('unix://docker.sock', name='demo')
+        archive.submit('repo/base:v1')
+
+    assert archive.wait() is False
+    assert archive.futures == {}
+    archive.close()
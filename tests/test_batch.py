@@ -0,0 +1,68 @@
+import json
+import os
+
+from image_builder.configs import Settings
+from image_builder.core import Batch
+
+BASE = ('base', 'latest', "FROM ubuntu:20.04\n")
+SECONDS = {
+    'repo/base:latest': 10.0,
+    'repo/small:latest': 1.0,
+    'repo/big:latest': 100.0,
+    'repo/other:latest': 5.0,
+}
+
+
+def seed_timings(build_dir):
+    os.makedirs(build_dir, exist_ok=True)
+    history = {image: {'earlier': {'phases': {'build': s}, 'recorded': 1.0}} for image, s in SECONDS.items()}
+    with open(os.path.join(build_dir, "timings.json"), 'w') as f:
+        json.dump(history, f)
+
+
+def test_configs_keep_the_batch_flags(make_config, fake_daemon):
+    configs = [
+        make_config([BASE], filename="a.yaml"),
+        make_config([('other', 'latest', "FROM ubuntu:20.04\n")], filename="b.yaml"),
+    ]
+
+    # As in a service job: the batch arguments are an override, not sys.argv
+    with Settings.override(argv=configs + ['--dryrun', '--push', '--nocache']):
+        batch = Batch()
+        batch.plan()
+
+    assert batch.build_success
+    for config, builder in batch.builders.items():
+        assert builder.settings.args.config == config
+        assert builder.settings.args.push
+        assert builder.settings.args.nocache
+    assert sorted(batch.builders) == sorted([os.path.abspath(c) for c in configs])
+
+
+def test_order_longest_first_after_owners(make_config, tmp_path, fake_daemon):
+    configs = [
+        make_config([('other', 'latest', "FROM ubuntu:20.04\n")], filename="c.yaml"),
+        make_config([BASE, ('small', 'latest', "FROM repo/base:latest\n")], filename="a.yaml"),
+        make_config([BASE, ('big', 'latest', "FROM repo/base:latest\n")], filename="b.yaml"),
+    ]
+    seed_timings(tmp_path / "out")
+
+    with Settings.override(argv=configs + ['--dryrun']):
+        batch = Batch()
+        batch.plan()
+        order = batch.order()
+
+    c, a, b = [os.path.abspath(config) for config in configs]
+    # b has the longest path, but builds on the base image owned by a
+    assert batch.shared.get(b) == ['repo/base:latest']
+    assert order == [a, b, c]
+
+
+def test_order_untimed_configs_keep_their_order(make_config, fake_daemon):
+    configs = [make_config([(name, 'latest', "FROM ubuntu:20.04\n")], filename=f"{name}.yaml") for name in ["x", "y", "z"]]
+
+    with Settings.override(argv=configs + ['--dryrun']):
+        batch = Batch()
+        batch.plan()
+
+    assert batch.order() == [os.path.abspath(config) for config in configs]
@@ -0,0 +1,180 @@
+import gzip
+import hashlib
+import io
+import os
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from image_builder.core import ContextCache
+from image_builder.core.context import KERNEL_COPY_SIZE, ContextReport, TarWriter
+
+TREE = {
+    'Dockerfile': b"FROM scratch\n",
+    'app/main.py': b"print('hello')\n",
+    'app/sub/run.sh': b"#!/bin/sh\n",
+    'data/large.bin': bytes(range(256)) * (KERNEL_COPY_SIZE // 128),
+    'empty': b"",
+}
+
+
+def make_tree(root, files):
+    for path, data in files.items():
+        full_path = root / path
+        full_path.parent.mkdir(parents=True, exist_ok=True)
+        full_path.write_bytes(data)
+    return root
+
+
+def make_links(root):
+    os.chmod(root / "app/sub/run.sh", 0o755)
+    os.symlink("app/main.py", root / "link")
+    os.link(root / "app/main.py", root / "app/hard.py")
+    return root
+
+
+def tarfile_members(root, files):
+    # What tarfile writes for the same members, without the end-of-archive marker
+    buf = io.BytesIO()
+    tar = tarfile.open(mode='w', fileobj=buf)
+    for path in files:
+        info = tar.gettarinfo(os.path.join(root, path), arcname=path)
+        info.mtime = int(info.mtime)
+        if info.isfile():
+            with open(os.path.join(root, path), 'rb') as f:
+                tar.addfile(info, f)
+        else:
+            tar.addfile(info)
+    return buf.getvalue()
+
+
+@pytest.mark.parametrize('use_fd', [False, True])
+def test_tar_writer_matches_tarfile(tmp_path, use_fd):
+    root = make_links(make_tree(tmp_path / "ctx", TREE))
+    stats = {}
+    files = ContextCache().walk(str(root), [], stats)
+
+    with open(tmp_path / "body.tar", 'w+b') as f:
+        writer = TarWriter(fd=f.fileno()) if use_fd else TarWriter(f)
+        for path in files:
+            writer.add(path, os.path.join(root, path), stats[path])
+        writer.flush()
+        f.seek(0)
+        body = f.read()
+
+    assert body == tarfile_members(str(root), files)
+
+
+@pytest.mark.parametrize('size', [-1, 1000, 4096, 10**7])
+def test_context_stream_is_body_and_trailer(tmp_path, size):
+    root = make_links(make_tree(tmp_path / "ctx", TREE))
+    cache = ContextCache()
+    stats = {}
+    files = cache.walk(str(root), [], stats)
+
+    stream = cache.context(str(root), b"FROM scratch\n", extra_files=[('.dockerignore', "")])
+    chunks = list(iter(lambda: stream.read(size), b"")) if size > 0 else [stream.read()]
+    data = b"".join(chunks)
+    stream.close()
+    cache.clear()
+
+    trailer = cache.trailer(b"FROM scratch\n", [('.dockerignore', "")])
+    assert data == tarfile_members(str(root), files) + trailer
+    assert len(data) == len(stream)
+    with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+        assert tar.extractfile("Dockerfile").read() == b"FROM scratch\n"
+        assert tar.extractfile("data/large.bin").read() == TREE['data/large.bin']
+
+
+def test_write_body_requires_walk_stats(tmp_path):
+    root = make_tree(tmp_path / "ctx", TREE)
+    cache = ContextCache()
+    stats = {}
+    files = cache.walk(str(root), [], stats)
+    stats.pop('app/main.py')
+
+    with pytest.raises(KeyError):
+        cache.write_body(str(root), files, False, stats)
+
+
+@pytest.mark.parametrize('gzip_context', [False, True])
+def test_reproducible_context_is_identical(tmp_path, gzip_context):
+    contexts = []
+    for i, name in enumerate(["first", "second"]):
+        root = make_tree(tmp_path / name, TREE)
+        for path in TREE:
+            os.utime(root / path, ns=(i * 10**18, i * 10**18))
+        # A new cache per tree, as in separate runs
+        cache = ContextCache()
+        stream = cache.context(str(root), b"FROM scratch\n", ['data/*.tmp'], gzip_context, [('.dockerignore', "data/*.tmp")], epoch=1700000000)
+        data = stream.read()
+        stream.close()
+        cache.clear()
+        contexts.append((data, stream.digest))
+
+    assert contexts[0] == contexts[1]
+    data, digest = contexts[0]
+    assert digest == f"sha256:{hashlib.sha256(data).hexdigest()}"
+    with tarfile.open(fileobj=io.BytesIO(gzip.decompress(data) if gzip_context else data)) as tar:
+        members = tar.getmembers()
+    assert {m.mtime for m in members} == {1700000000}
+    assert {(m.uid, m.gid, m.uname, m.gname) for m in members} == {(0, 0, '', '')}
+
+
+def test_context_report_uses_walk_stats(tmp_path, monkeypatch):
+    root = make_tree(tmp_path / "ctx", TREE)
+    stats = {}
+    files = ContextCache().walk(str(root), [], stats)
+
+    def no_lstat(path):
+        raise AssertionError(f"lstat of '{path}'")
+
+    monkeypatch.setattr(os, "lstat", no_lstat)
+    report = ContextReport(str(root), files, stats, sources=["app"], keep=["Dockerfile"]).as_dict()
+
+    assert report.get("files") == len(TREE)
+    assert report.get("bytes") == sum([len(data) for data in TREE.values()])
+    assert report.get("dockerignore") == [
+        {'path': 'data', 'bytes': len(TREE['data/large.bin'])},
+        {'path': 'empty', 'bytes': 0},
+    ]
+
+
+def test_body_tars_contexts_concurrently(tmp_path, monkeypatch):
+    roots = [make_tree(tmp_path / name, {'Dockerfile': b"FROM scratch\n"}) for name in ["a", "b"]]
+    cache = ContextCache()
+    write_body = cache.write_body
+    barrier = threading.Barrier(len(roots), timeout=5)
+
+    def blocking_write_body(*args, **kwargs):
+        # Only returns once every context is being tarred at the same time
+        barrier.wait()
+        return write_body(*args, **kwargs)
+
+    monkeypatch.setattr(cache, "write_body", blocking_write_body)
+    with ThreadPoolExecutor(len(roots)) as executor:
+        bodies = list(executor.map(lambda root: cache.body(str(root)), roots))
+
+    assert [b.get("files") for b in bodies] == [['Dockerfile'], ['Dockerfile']]
+    cache.clear()
+
+
+def test_body_is_built_once_per_context(tmp_path, monkeypatch):
+    root = make_tree(tmp_path / "ctx", {'Dockerfile': b"FROM scratch\n", 'app/main.py': b"print()\n"})
+    cache = ContextCache()
+    write_body = cache.write_body
+    calls = []
+
+    def counting_write_body(*args, **kwargs):
+        calls.append(args[0])
+        return write_body(*args, **kwargs)
+
+    monkeypatch.setattr(cache, "write_body", counting_write_body)
+    with ThreadPoolExecutor(8) as executor:
+        bodies = list(executor.map(lambda _: cache.body(str(root)), range(8)))
+
+    assert len(calls) == 1
+    assert all([b is bodies[0] for b in bodies])
+    cache.clear()
@@ -0,0 +1,59 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import docker
+import pytest
+
+from image_builder.core import DaemonPool
+
+
+class SlowClient:
+    """An APIClient whose image lookups wait for each other."""
+    barrier = None
+    inspected = []
+
+    def __init__(self, base_url=None, **kwargs):
+        self.base_url = base_url
+
+    def inspect_image(self, reference):
+        self.inspected.append((self.base_url, reference))
+        if self.barrier is not None:
+            self.barrier.wait()
+        if self.base_url == 'unix://b.sock' and reference == 'repo/base:latest':
+            return {'Id': "sha256:1"}
+        raise docker.errors.ImageNotFound(reference)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture
+def slow_daemons(monkeypatch):
+    SlowClient.barrier = None
+    SlowClient.inspected = []
+    monkeypatch.setattr(docker, 'APIClient', SlowClient)
+
+
+def test_acquire_looks_up_parents_outside_the_lock(slow_daemons):
+    pool = DaemonPool(['unix://a.sock', 'unix://b.sock'])
+    # Only returns once both schedules look for their parent at the same time
+    SlowClient.barrier = threading.Barrier(2, timeout=5)
+
+    with ThreadPoolExecutor(2) as executor:
+        daemons = list(executor.map(pool.acquire, ['repo/one:latest', 'repo/two:latest']))
+
+    assert sorted([d.base_url for d in daemons]) == ['unix://a.sock', 'unix://b.sock']
+    assert [d.load for d in pool.daemons] == [1, 1]
+
+
+def test_acquire_prefers_the_parent_holder(slow_daemons):
+    pool = DaemonPool(['unix://a.sock', 'unix://b.sock'])
+
+    assert pool.acquire('repo/base:latest').base_url == 'unix://b.sock'
+
+
+def test_single_daemon_skips_the_lookup(slow_daemons):
+    pool = DaemonPool(['unix://a.sock'])
+
+    assert pool.acquire('repo/base:latest') is pool.primary
+    assert SlowClient.inspected == []
@@ -0,0 +1,137 @@
+import docker
+import pytest
+
+from image_builder.configs import Settings
+from image_builder.core import Docker
+from image_builder.core.docker import BuildState
+from image_builder.helpers import DockerfileParser
+from image_builder.internal import BuildError
+
+IMAGES = [
+    ('base', 'latest', "FROM ubuntu:20.04\n"),
+]
+
+
+class RemovingClient:
+    def __init__(self):
+        self.removed = []
+
+    def inspect_container(self, container):
+        return {'Image': f"image-of-{container}"}
+
+    def remove_container(self, container, force=False):
+        self.removed.append(container)
+
+    def remove_image(self, image, force=False):
+        self.removed.append(image)
+
+
+def stream(text):
+    return {'stream': f"{text}\n"}
+
+
+def test_concurrent_builds_keep_their_own_state(make_config, fake_daemon):
+    config = make_config(IMAGES)
+    with Settings.override(argv=[config, '--rm_inter_imgs']):
+        builder = Docker()
+    first, second = BuildState(RemovingClient()), BuildState(RemovingClient())
+
+    builder.process_build_stream(stream("Step 1/2 : FROM ubuntu AS one"), first)
+    builder.process_build_stream(stream(" ---> Running in aaaaaaaaaaaa"), first)
+    builder.process_build_stream(stream("Step 1/2 : FROM ubuntu AS two"), second)
+    builder.process_build_stream(stream(" ---> Running in bbbbbbbbbbbb"), second)
+    builder.process_build_stream(stream(" ---> 111111111111"), first)
+    with pytest.raises(BuildError):
+        builder.process_build_stream(stream("E: Unable to locate package"), first)
+
+    assert first.stage_images == {'one': '111111111111'}
+    assert second.stage_images == {}
+    assert second.intermediate_container == 'bbbbbbbbbbbb'
+    # Cleanup goes through the client that ran the failed build
+    assert first.client.removed == ['aaaaaaaaaaaa', 'image-of-aaaaaaaaaaaa']
+    assert second.client.removed == []
+
+
+def test_build_shuts_down_archive_workers(make_config, fake_daemon):
+    config = make_config(IMAGES)
+    with Settings.override(argv=[config, '--dryrun']):
+        builder = Docker()
+        builder.build()
+
+    with pytest.raises(RuntimeError):
+        builder.archive.executor.submit(print)
+
+
+MATRIX = [
+    ('base', 'latest', "FROM ubuntu:20.04\n"),
+    ('py', '{PY}', "FROM repo/base:latest\n", 'matrix:', '  PY: ["3.7", "3.8", "3.9"]'),
+]
+
+
+class PullingClient:
+    """Knows one image in the registry, and no local image."""
+    available = "repo/py:3.9-v1"
+
+    def __init__(self, base_url=None, **kwargs):
+        self.base_url = base_url
+
+    def version(self):
+        return {'Version': 'test'}
+
+    def inspect_image(self, reference):
+        raise docker.errors.ImageNotFound(reference)
+
+    def close(self):
+        pass
+
+    def inspect_distribution(self, reference):
+        if reference != self.available:
+            raise docker.errors.NotFound(reference)
+        return {'Descriptor': {'digest': "sha256:1"}}
+
+    def pull(self, repository, tag, stream=False, decode=False):
+        if f"{repository}:{tag}" != self.available:
+            raise docker.errors.NotFound(f"{repository}:{tag}")
+        return iter([{'status': "Downloaded"}])
+
+
+def test_pulled_variant_keeps_its_siblings(make_config, monkeypatch):
+    monkeypatch.setattr(docker, 'APIClient', PullingClient)
+    config = make_config(MATRIX)
+    with Settings.override(argv=[config, '--pull']):
+        builder = Docker()
+        builder.plan()
+
+    assert builder.pulled_images == {3: "repo/py:3.9-v1"}
+    assert builder.pulled_image is None
+    assert [job.get("path") for job in builder.jobs] == ["repo/base:latest", "repo/py:3.7", "repo/py:3.8"]
+    # Siblings still build from their own parent, not from the pulled variant
+    assert DockerfileParser(builder.jobs[1].get("lines")).froms() == [("repo/base:latest", None)]
+
+
+def test_run_job_closes_every_context(make_config, fake_daemon, monkeypatch):
+    config = make_config(IMAGES)
+    with Settings.override(argv=[config, '--dryrun']):
+        builder = Docker()
+        builder.plan()
+        streams = []
+        image_context = builder.image_context
+
+        def tracked_context(job):
+            streams.append(image_context(job))
+            assert streams[-1].body is not None
+            return streams[-1]
+
+        monkeypatch.setattr(builder, "image_context", tracked_context)
+        monkeypatch.setattr(builder, "publish", lambda job, pushstat: None)
+        # A skipped parent of a pulled image needs no context
+        builder.pull_order = 1
+        builder.run_job(builder.jobs[0], None)
+        assert streams == []
+
+        builder.pull_order = 0
+        builder.run_job(builder.jobs[0], None)
+        builder.context_cache.clear()
+
+    assert len(streams) == 1
+    assert streams[0].body is None
@@ -0,0 +1,65 @@
+import pytest
+
+from image_builder.helpers import DockerfileParser
+
+DOCKERFILE = [
+    "# syntax=docker/dockerfile:1\n",
+    "FROM --platform=linux/amd64 ubuntu:20.04 AS build\n",
+    "RUN apt-get update && \\\n",
+    "    # comments inside a continuation are dropped\n",
+    "    apt-get install -y curl\n",
+    "\n",
+    "COPY app /app\n",
+    "COPY --chown=1000 ./src/ ./lib/ /opt/\n",
+    'ADD ["conf/my file.yaml", "/etc/"]\n',
+    "ADD https://example.com/tool.tar.gz /tmp/\n",
+    "FROM repo/base:latest\n",
+    "COPY --from=build /app /app\n",
+    "COPY /abs/path .\n",
+]
+
+
+def test_join_merges_continuations_and_drops_comments():
+    instructions = DockerfileParser(DOCKERFILE).instructions
+
+    assert instructions[0] == "FROM --platform=linux/amd64 ubuntu:20.04 AS build"
+    assert instructions[1] == "RUN apt-get update && apt-get install -y curl"
+    assert len(instructions) == 9
+
+
+def test_froms():
+    assert DockerfileParser(DOCKERFILE).froms() == [("ubuntu:20.04", "build"), ("repo/base:latest", None)]
+
+
+def test_copy_sources_are_local_and_normalized():
+    assert DockerfileParser(DOCKERFILE).copy_sources() == ["app", "src", "lib", "conf/my file.yaml", "abs/path"]
+
+
+@pytest.mark.parametrize('instruction, parsed', [
+    ("COPY a b /dst/", ("COPY", [], ["a", "b"], "/dst/", False)),
+    ("add --chown=1:1 --chmod=644 a /dst", ("ADD", ["--chown=1:1", "--chmod=644"], ["a"], "/dst", False)),
+    ('COPY ["a b", "/dst"]', ("COPY", [], ["a b"], "/dst", True)),
+    ("COPY onlyone", ("COPY", [], [], "onlyone", False)),
+    ("RUN cp a b", None),
+])
+def test_parse_copy(instruction, parsed):
+    assert DockerfileParser.parse_copy(instruction) == parsed
+
+
+@pytest.mark.parametrize('instruction, rewritten', [
+    ("COPY app /app", "COPY images/base/app /app"),
+    ("COPY --chown=1000 /app /app", "COPY --chown=1000 images/base/app /app"),
+    ('COPY ["a b", "/dst"]', 'COPY ["images/base/a b", "/dst"]'),
+    ("COPY --from=build /app /app", "COPY --from=build /app /app"),
+    ("ADD https://example.com/x /x", "ADD https://example.com/x /x"),
+    ("RUN make", "RUN make"),
+])
+def test_prefix_sources(instruction, rewritten):
+    assert DockerfileParser.prefix_sources(instruction, "images/base") == rewritten
+
+
+def test_replace_from_keeps_flags():
+    instruction = "FROM --platform=linux/arm64 repo/base:latest AS base"
+
+    assert DockerfileParser.replace_from(instruction, "stage-0") == "FROM --platform=linux/arm64 stage-0"
+    assert DockerfileParser.replace_from(instruction, "stage-0", "base") == "FROM --platform=linux/arm64 stage-0 AS base"
@@ -0,0 +1,157 @@
+import asyncio
+import base64
+import io
+import json
+import threading
+from urllib.parse import parse_qsl, urlparse
+
+import docker
+import pytest
+
+from image_builder.configs import Settings
+from image_builder.core import AsyncDocker, Docker
+from image_builder.core.docker import PushStatus
+
+AUTHS = {'auths': docker.auth.parse_auth({'registry.example.com': {'auth': base64.b64encode(b"user:secret").decode()}})}
+
+
+def serve_build(socket_path, requests):
+    async def handle(reader, writer):
+        head = (await reader.readuntil(b"\r\n\r\n")).decode('latin-1')
+        requests.append(dict(line.split(": ", 1) for line in head.split("\r\n")[1:] if ": " in line))
+        await reader.readuntil(b"0\r\n\r\n")
+        body = json.dumps({'stream': "Successfully built abc\n"}).encode()
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body))
+        await writer.drain()
+        writer.close()
+
+    async def build():
+        server = await asyncio.start_unix_server(handle, path=socket_path)
+        async with server:
+            engine = AsyncDocker(f"unix://{socket_path}")
+            return [line async for line in engine.build(io.BytesIO(b"context"), tag="demo:v1")]
+
+    return asyncio.run(build())
+
+
+def test_build_sends_registry_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(docker.auth, "load_config", lambda *args, **kwargs: docker.auth.AuthConfig(AUTHS))
+    requests = []
+
+    lines = serve_build(str(tmp_path / "docker.sock"), requests)
+
+    assert lines == [{'stream': "Successfully built abc\n"}]
+    config = json.loads(base64.urlsafe_b64decode(requests[0]["X-Registry-Config"]))
+    assert config["registry.example.com"]["username"] == "user"
+    assert config["registry.example.com"]["password"] == "secret"
+
+
+def test_build_without_auth_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(docker.auth, "load_config", lambda *args, **kwargs: docker.auth.AuthConfig({}))
+    requests = []
+
+    serve_build(str(tmp_path / "docker.sock"), requests)
+
+    assert "X-Registry-Config" not in requests[0]
+
+
+@pytest.fixture
+def daemon_socket(tmp_path):
+    """A fake engine on a unix socket, answering {(method, path): (status, [objects])}."""
+    path = str(tmp_path / "engine.sock")
+    routes = {}
+    requests = []
+
+    async def handle(reader, writer):
+        head = (await reader.readuntil(b"\r\n\r\n")).decode('latin-1').split("\r\n")
+        method, target, _ = head[0].split(" ")
+        url = urlparse(target)
+        requests.append({'method': method, 'path': url.path, 'params': dict(parse_qsl(url.query)),
+                         'headers': dict(line.split(": ", 1) for line in head[1:] if ": " in line)})
+        status, objects = routes.get((method, url.path), (404, [{'message': "not found"}]))
+        body = b"".join([json.dumps(o).encode() + b"\r\n" for o in objects])
+        writer.write(b"HTTP/1.1 %d X\r\nContent-Length: %d\r\n\r\n%s" % (status, len(body), body))
+        await writer.drain()
+        writer.close()
+
+    loop = asyncio.new_event_loop()
+    server = loop.run_until_complete(asyncio.start_unix_server(handle, path=path))
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield f"unix://{path}", routes, requests
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    server.close()
+    loop.run_until_complete(server.wait_closed())
+    loop.close()
+
+
+def test_pull_sends_registry_auth(daemon_socket, monkeypatch):
+    monkeypatch.setattr(docker.auth, "load_config", lambda *args, **kwargs: docker.auth.AuthConfig(AUTHS))
+    base_url, routes, requests = daemon_socket
+    routes[("POST", "/images/create")] = (200, [{'status': "Pulling"}, {'status': "Downloaded"}])
+    engine = AsyncDocker(base_url)
+
+    lines = list(engine.iterate(engine.pull("registry.example.com/repo/app:v1")))
+
+    assert lines == [{'status': "Pulling"}, {'status': "Downloaded"}]
+    assert requests[0]["params"] == {'fromImage': "registry.example.com/repo/app", 'tag': "v1"}
+    auth = json.loads(base64.urlsafe_b64decode(requests[0]["headers"]["X-Registry-Auth"]))
+    assert auth["username"] == "user"
+
+
+def test_errors_are_docker_errors(daemon_socket):
+    base_url, routes, requests = daemon_socket
+    engine = AsyncDocker(base_url)
+
+    assert asyncio.run(engine.inspect("repo/app:v1")) is None
+    with pytest.raises(docker.errors.NotFound):
+        list(engine.iterate(engine.pull("repo/app", "v1")))
+    with pytest.raises(docker.errors.ImageNotFound):
+        asyncio.run(engine.tag("repo/app:v1", "repo/app", "v2"))
+    routes[("POST", "/images/repo/app/push")] = (500, [{'message': "registry down"}])
+    with pytest.raises(docker.errors.APIError):
+        list(engine.iterate(engine.push("repo/app:v1")))
+    assert requests[-1]["params"] == {'tag': "v1"}
+
+
+def test_async_engine_publishes_through_the_engine(daemon_socket, make_config, fake_daemon, monkeypatch):
+    base_url, routes, requests = daemon_socket
+    routes[("GET", "/images/repo/base:latest/json")] = (200, [{'Id': "sha256:1", 'RepoDigests': []}])
+    routes[("POST", "/images/repo/base:latest/tag")] = (201, [])
+    routes[("POST", "/images/repo/base/push")] = (200, [{'status': "Pushed"}, {'aux': {'Digest': "sha256:2"}}])
+    config = make_config([('base', 'latest', "FROM ubuntu:20.04\n")])
+    with Settings.override(argv=[config, '--engine', 'async', '--push', '--daemon', base_url]):
+        builder = Docker()
+        monkeypatch.setattr(builder.registry, "lookup", lambda references, tracer=None: {})
+        job = {'path': "repo/base:latest", 'repository': "repo", 'name': "base", 'tag': "latest", 'tags': ["v1"], 'key': "k"}
+        builder.publish(job, PushStatus())
+
+    assert [(r["method"], r["path"], r["params"]) for r in requests] == [
+        ("POST", "/images/repo/base:latest/tag", {'repo': "repo/base", 'tag': "latest-v1", 'force': "1"}),
+        ("GET", "/images/repo/base:latest/json", {}),
+        ("POST", "/images/repo/base/push", {'tag': "latest-v1"}),
+    ]
+    assert builder.registry.cached("repo/base:latest-v1").get("digest") == "sha256:2"
+
+
+def test_async_engine_pulls_cache_images(daemon_socket, make_config, fake_daemon):
+    base_url, routes, requests = daemon_socket
+    routes[("GET", "/images/repo/base:latest-v1/json")] = (200, [{'Id': "sha256:1"}])
+    routes[("POST", "/images/create")] = (200, [{'status': "Downloaded"}])
+    config = make_config([('base', 'latest', "FROM ubuntu:20.04\n")])
+    with Settings.override(argv=[config, '--engine', 'async', '--daemon', base_url]):
+        builder = Docker()
+        found = builder.pull_cache_images("repo/base:latest", ["repo/base:latest-v1", "repo/base:latest-latest"], base_url)
+
+    assert found == ["repo/base:latest-v1", "repo/base:latest-latest"]
+    pulls = [r.get("params") for r in requests if r.get("path") == "/images/create"]
+    assert pulls == [{'fromImage': "repo/base", 'tag': "latest-latest"}]
+
+
+def test_build_needs_no_to_thread(tmp_path, monkeypatch):
+    # asyncio.to_thread is new in Python 3.9
+    monkeypatch.delattr(asyncio, "to_thread", raising=False)
+    monkeypatch.setattr(docker.auth, "load_config", lambda *args, **kwargs: docker.auth.AuthConfig({}))
+
+    assert serve_build(str(tmp_path / "docker.sock"), []) == [{'stream': "Successfully built abc\n"}]
@@ -0,0 +1,42 @@
+from image_builder.configs import Settings
+from image_builder.core import Docker, Journal
+
+MATRIX = [
+    ('base', 'latest', "FROM ubuntu:20.04\n"),
+    ('cuda', 'cu{CUDA}', "FROM repo/base:latest\nARG CUDA\n", 'matrix:', '  CUDA: ["11.8", "12.1"]'),
+]
+
+
+def keys(config):
+    with Settings.override(argv=[config, '--dryrun']):
+        builder = Docker()
+        builder.plan()
+    return {job.get("path"): job.get("key") for job in builder.jobs}
+
+
+def test_key_depends_on_every_input():
+    key = Journal.key({'name': 'a'}, ["FROM x\n"], {'A': '1'}, "parent")
+    assert key == Journal.key({'name': 'a'}, ["FROM x"], {'A': '1'}, "parent")
+    assert key != Journal.key({'name': 'b'}, ["FROM x\n"], {'A': '1'}, "parent")
+    assert key != Journal.key({'name': 'a'}, ["FROM y\n"], {'A': '1'}, "parent")
+    assert key != Journal.key({'name': 'a'}, ["FROM x\n"], {'A': '2'}, "parent")
+    assert key != Journal.key({'name': 'a'}, ["FROM x\n"], {'A': '1'}, "other")
+
+
+def test_variant_keys_chain_to_their_from_image(make_config, tmp_path, fake_daemon):
+    config = make_config(MATRIX)
+    before = keys(config)
+    assert len(before) == 3
+
+    # Changing one variant leaves its sibling and the parent alone
+    text = (tmp_path / "cfg" / "build.yaml").read_text().replace('["11.8", "12.1"]', '["11.7", "12.1"]')
+    (tmp_path / "cfg" / "build.yaml").write_text(text)
+    after = keys(config)
+    assert after.get("repo/base:latest") == before.get("repo/base:latest")
+    assert after.get("repo/cuda:cu12.1") == before.get("repo/cuda:cu12.1")
+    assert "repo/cuda:cu11.7" in after
+
+    # Changing the parent invalidates every variant
+    (tmp_path / "proj" / "Dockerfile.base").write_text("FROM ubuntu:22.04\n")
+    changed = keys(config)
+    assert all([changed.get(p) != after.get(p) for p in after])
@@ -0,0 +1,78 @@
+import contextvars
+import json
+import logging
+
+import pytest
+
+from image_builder.configs import Settings
+from image_builder.internal import Logging
+from image_builder.internal import logger
+
+
+@pytest.fixture
+def fresh_logging(monkeypatch):
+    """Set up the log queue again, and put the shared one back afterwards."""
+    log = logging.getLogger(logger.__name__)
+    monkeypatch.setattr(logger, "_queue", None)
+    monkeypatch.setattr(logger, "_listener", None)
+    monkeypatch.setattr(logger, "_files", {})
+    monkeypatch.setattr(log, "handlers", list(log.handlers))
+    # The fixture stops its listener, not the exit hook
+    monkeypatch.setattr(logger.atexit, "register", lambda func: func)
+    yield
+    if logger._listener is not None and logger._listener._thread is not None:
+        logger._listener.stop()
+    for _, handler, _ in logger._files.values():
+        handler.close()
+
+
+def test_json_console_logs_to_stdout(fresh_logging, capsys):
+    with Settings.override(argv=['default', '--log_format', 'json']):
+        Logging().info("hello")
+    logger._listener.stop()
+
+    out, err = capsys.readouterr()
+    assert json.loads(out.splitlines()[-1]).get("message") == "hello"
+    assert err == ""
+
+
+def test_save_logs_restarts_listener_only_for_new_handlers(fresh_logging, tmp_path):
+    log = Logging()
+    log.save_logs(str(tmp_path / "build.log"))
+    listener = logger._listener
+
+    # Each Operations of a run saves to the same build.log
+    log.save_logs(str(tmp_path / "build.log"))
+    assert logger._listener is listener
+    log.close_logs("unknown-job")
+    assert logger._listener is listener
+
+    log.save_logs(str(tmp_path / "other.log"))
+    assert logger._listener is not listener
+    assert len(logger._listener.handlers) == len(listener.handlers) + 1
+
+
+def test_sampling_counts_each_build(fresh_logging, capsys):
+    with Settings.override(argv=['default', '--log_format', 'json', '--log_sample', '2']):
+        log = Logging()
+
+    def build(name, count):
+        with log.sampling():
+            for i in range(count):
+                log.sample('build', logging.INFO, f"{name} %s", i)
+                yield
+            log.summary('build', logging.INFO)
+
+    # Two concurrent builds, one step at a time each in its own context
+    builds = [(contextvars.copy_context(), build("a", 6)), (contextvars.copy_context(), build("b", 3))]
+    while builds:
+        for context, steps in list(builds):
+            try:
+                context.run(next, steps)
+            except StopIteration:
+                builds.remove((context, steps))
+    logger._listener.stop()
+
+    messages = [json.loads(line).get("message") for line in capsys.readouterr().out.splitlines()]
+    assert [m for m in messages if m.startswith("build:")] == ["build: 3 messages, 2 shown", "build: 6 messages, 4 shown"]
+    assert [m for m in messages if not m.startswith("build:")] == ["a 0", "b 0", "a 1", "b 1", "a 3", "a 5"]
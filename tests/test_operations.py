@@ -0,0 +1,62 @@
+import pytest
+
+from image_builder.configs import Settings
+from image_builder.core import Operations
+from image_builder.internal import LoadError
+
+IMAGES = [
+    ('base', 'latest', "FROM ubuntu:20.04\n"),
+]
+
+
+def matrix_config(tag, matrix):
+    return {'build': {'projects': [{'dockerfiles': [
+        {'file': 'Dockerfile', 'name': 'cuda', 'tag': tag, 'args': ['A=1'], 'matrix': matrix},
+        {'file': 'Dockerfile', 'name': 'plain', 'tag': 'latest'},
+    ]}]}}
+
+
+@pytest.fixture
+def ops(make_config):
+    with Settings.override(argv=[make_config(IMAGES)]):
+        yield Operations()
+
+
+def variants(configs):
+    return configs.get("build").get("projects")[0].get("dockerfiles")
+
+
+def test_expand_matrix_formats_tags(ops):
+    images = variants(ops.expand_matrix(matrix_config("cu{CUDA}-py{PY}", {'CUDA': ["11.8", "12.1"], 'PY': [3.1]})))
+    assert [i.get("tag") for i in images] == ["cu11.8-py3.1", "cu12.1-py3.1", "latest"]
+    assert images[0].get("args") == ["A=1", "CUDA=11.8", "PY=3.1"]
+    assert images[0].get("matrix_group") == images[1].get("matrix_group") == 0
+    assert "matrix" not in images[0]
+    assert "matrix_group" not in images[2]
+
+
+def test_expand_matrix_suffixes_tags_without_fields(ops):
+    images = variants(ops.expand_matrix(matrix_config("gpu", {'CUDA': ["11.8"], 'OS': ["ubuntu/22.04"]})))
+    assert images[0].get("tag") == "gpu-11.8-ubuntu_22.04"
+
+
+@pytest.mark.parametrize('tag', ["cu{CUDNN}", "cu{0}", "cu{CUDA!x}", "cu{CUDA"])
+def test_expand_matrix_rejects_bad_tag_fields(ops, tag):
+    with pytest.raises(LoadError):
+        ops.expand_matrix(matrix_config(tag, {'CUDA': ["11.8"]}))
+
+
+def test_unknown_tag_field_stops_loading(make_config):
+    config = make_config(IMAGES + [('cuda', 'cu{CUDNN}', "FROM repo/base:latest\n", 'matrix:', '  CUDA: ["11.8"]')])
+    with Settings.override(argv=[config]):
+        with pytest.raises(SystemExit):
+            Operations()
+
+
+def test_matrix_accepts_unquoted_numbers(make_config):
+    config = make_config(IMAGES + [('py', 'py{PY}', "FROM repo/base:latest\n", 'matrix:', '  PY: [3.8, 3.9, "3.10", 3]')])
+    with Settings.override(argv=[config]):
+        images = variants(Operations().configs)
+
+    assert [i.get("tag") for i in images[1:]] == ["py3.8", "py3.9", "py3.10", "py3"]
+    assert images[1].get("args") == ["PY=3.8"]
@@ -0,0 +1,103 @@
+import json
+import os
+from time import time
+
+from image_builder.configs import Settings
+from image_builder.core import ContextCache, Docker
+from image_builder.core.plan import Planner
+
+IMAGES = [
+    ('base', 'latest', "FROM ubuntu:20.04\n"),
+    ('child', 'latest', "FROM repo/base:latest\n"),
+    ('leaf', 'latest', "FROM repo/child:latest\n"),
+]
+
+
+def cache_registry(config, references):
+    build_dir = os.path.join(os.path.dirname(os.path.dirname(config)), "out")
+    os.makedirs(build_dir, exist_ok=True)
+    with open(os.path.join(build_dir, "registry_cache.json"), "w") as f:
+        json.dump({r: {'digest': f"sha256:{i}", 'checked': time()} for i, r in enumerate(references)}, f)
+
+
+def test_plan_pulls_what_a_dry_run_pulls(make_config, fake_daemon):
+    config = make_config(IMAGES)
+    # Every candidate is known, so the search order alone decides
+    cache_registry(config, [f"repo/{n}:latest-{t}" for n, _, _ in IMAGES for t in ["v1", "latest", ""]])
+
+    with Settings.override(argv=[config, '--pull', '--dryrun']):
+        builder = Docker()
+        builder.plan()
+    with Settings.override(argv=[config, '--pull', '--plan']):
+        planner = Docker()
+        planner.plan()
+        plan = Planner(planner).plan()
+
+    pulled = [i for i in plan.get("images") if i.get("action") == 'pull']
+    assert builder.pulled_image == "repo/leaf:latest-v1"
+    assert [i.get("pull").get("reference") for i in pulled] == [builder.pulled_image]
+    assert [i.get("action") for i in plan.get("images")] == ['skip', 'skip', 'pull']
+
+
+def test_plan_skips_unknown_candidates(make_config, fake_daemon):
+    config = make_config(IMAGES)
+    cache_registry(config, ["repo/child:latest-"])
+
+    with Settings.override(argv=[config, '--pull', '--plan']):
+        builder = Docker()
+        builder.plan()
+        plan = Planner(builder).plan()
+
+    assert [i.get("action") for i in plan.get("images")] == ['skip', 'pull', 'build']
+
+
+def test_plan_needs_no_daemon(make_config, tmp_path):
+    config = make_config(IMAGES)
+    daemon = f"unix://{tmp_path}/missing.sock"
+
+    with Settings.override(argv=[config, '--plan', '--daemon', daemon]):
+        builder = Docker()
+        builder.plan()
+        plan = Planner(builder).plan()
+
+    assert builder.pool is None
+    assert [i.get("action") for i in plan.get("images")] == ['build', 'build', 'build']
+
+
+def test_plan_reuses_context_walks(make_config, tmp_path, monkeypatch):
+    config = make_config(IMAGES[:1])
+    (tmp_path / "proj" / "app").mkdir()
+    (tmp_path / "proj" / "app" / "a.txt").write_text("a")
+
+    def contexts():
+        with Settings.override(argv=[config, '--plan']):
+            builder = Docker()
+            builder.plan()
+            return [i.get("context") for i in Planner(builder).plan().get("images")]
+
+    first = contexts()
+    walks = []
+    original = ContextCache.walk
+    monkeypatch.setattr(ContextCache, 'walk', lambda *a, **k: walks.append(a) or original(*a, **k))
+    assert contexts() == first
+    assert walks == []
+
+    (tmp_path / "proj" / "app" / "b.txt").write_text("bb")
+    changed = contexts()
+    assert len(walks) == 1
+    assert changed[0].get("files") == first[0].get("files") + 1
+    assert changed[0].get("bytes") == first[0].get("bytes") + 2
+
+
+def test_plan_searches_matrix_variants_on_their_own(make_config, fake_daemon):
+    config = make_config(IMAGES[:1] + [('py', '{PY}', "FROM repo/base:latest\n", 'matrix:', '  PY: ["3.8", "3.9"]')])
+    cache_registry(config, ["repo/py:3.9-v1", "repo/base:latest-v1"])
+
+    with Settings.override(argv=[config, '--pull', '--plan']):
+        builder = Docker()
+        builder.plan()
+        plan = Planner(builder).plan()
+
+    assert [(i.get("image"), i.get("action")) for i in plan.get("images")] == [
+        ("repo/base:latest", 'pull'), ("repo/py:3.8", 'build'), ("repo/py:3.9", 'pull'),
+    ]
@@ -0,0 +1,98 @@
+import http.client
+import json
+import os
+import socket
+import stat
+import threading
+
+import pytest
+
+from image_builder.configs import Settings
+from image_builder.core import BuildService
+
+
+class UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path):
+        super().__init__('localhost')
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX)
+        self.sock.connect(self.path)
+
+
+@pytest.fixture
+def service(tmp_path):
+    path = tmp_path / "builder.sock"
+    with Settings.override(argv=['default', '--serve', f"unix://{path}"]):
+        service = BuildService()
+        service.server, _ = service.bind()
+    thread = threading.Thread(target=service.server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield service
+    service.server.shutdown()
+    service.server.server_close()
+
+
+def post(service, body, content_type='application/json'):
+    connection = UnixConnection(service.server.server_address)
+    headers = {'Content-Type': content_type} if content_type else {}
+    connection.request("POST", "/jobs", body=json.dumps(body), headers=headers)
+    response = connection.getresponse()
+    result = response.status, json.loads(response.read())
+    connection.close()
+    return result
+
+
+def test_serve_defaults_to_unix_socket():
+    with Settings.override(argv=['default', '--serve']):
+        assert Settings().args.serve.startswith("unix://")
+
+
+def test_socket_is_private(service):
+    assert stat.S_IMODE(os.stat(service.server.server_address).st_mode) == 0o600
+
+
+def test_submit_queues_job(service, tmp_path):
+    status, job = post(service, {'config': str(tmp_path / "build.yaml"), 'args': ['--push']})
+
+    assert status == 201
+    assert job.get("status") == 'queued'
+    assert job.get("args") == ['--push']
+
+
+@pytest.mark.parametrize('content_type', [None, 'text/plain', 'application/x-www-form-urlencoded'])
+def test_submit_requires_json(service, tmp_path, content_type):
+    status, body = post(service, {'config': str(tmp_path / "build.yaml")}, content_type)
+
+    assert status == 415
+    assert not service.jobs
+
+
+@pytest.mark.parametrize('body', [[], "build.yaml", {'args': []}, {'config': "build.yaml", 'args': "--push"}])
+def test_submit_rejects_malformed_requests(service, body):
+    status, _ = post(service, body)
+
+    assert status == 400
+    assert not service.jobs
+
+
+@pytest.mark.parametrize('args', [
+    ['--metrics_file', '/etc/cron.d/job'],
+    ['--metrics_file=/etc/cron.d/job'],
+    ['--metrics_f', '/etc/cron.d/job'],
+    ['--rm_build_files'],
+    ['--plan', '/etc/passwd'],
+    ['--save', '/etc'],
+    ['--save=/etc'],
+    ['--load_cache', '/home/user/images'],
+    ['--load_c', '/home/user/images'],
+    ['--watch'],
+    ['--serve'],
+])
+def test_submit_rejects_flags(service, tmp_path, args):
+    status, body = post(service, {'config': str(tmp_path / "build.yaml"), 'args': args})
+
+    assert status == 400
+    assert "not allowed" in body.get("error")
+    assert not service.jobs
@@ -0,0 +1,60 @@
+import ctypes
+from time import monotonic
+
+import pytest
+
+from image_builder.configs import Settings
+from image_builder.core import Docker, Watcher
+
+IMAGES = [
+    ('base', 'latest', "FROM ubuntu:20.04\nCOPY app /app\n"),
+    ('tools', 'latest', "FROM ubuntu:20.04\nCOPY tools /tools\n"),
+]
+
+
+@pytest.fixture(params=['inotify', 'polling'])
+def watch_mode(request, monkeypatch):
+    if request.param == 'polling':
+        def no_libc(*args, **kwargs):
+            raise OSError("no libc")
+        monkeypatch.setattr(ctypes, "CDLL", no_libc)
+    return request.param
+
+
+def collect(watcher, timeout=2.0):
+    changes = {}
+    deadline = monotonic() + timeout
+    while not changes and monotonic() < deadline:
+        changes = watcher.read_events(0.1) if watcher.fd is not None else watcher.poll(0.05)
+    return changes
+
+
+def test_update_applies_new_patterns(tmp_path, watch_mode):
+    (tmp_path / "build").mkdir()
+    (tmp_path / "build" / "old.o").write_text("old")
+    watcher = Watcher({str(tmp_path): ['build']}, interval=0.05)
+    try:
+        (tmp_path / "build" / "ignored.o").write_text("ignored")
+        assert collect(watcher, 0.3) == {}
+
+        watcher.update(str(tmp_path), [])
+        (tmp_path / "build" / "new.o").write_text("new")
+        # Polling also reports the directory, whose mtime changed
+        assert "build/new.o" in collect(watcher).get(str(tmp_path), set())
+    finally:
+        watcher.close()
+
+
+def test_dockerignore_change_affects_every_job(make_config, tmp_path, fake_daemon):
+    config = make_config(IMAGES)
+    with Settings.override(argv=[config, '--dryrun']):
+        builder = Docker()
+        builder.plan()
+    root = str(tmp_path / "proj")
+
+    jobs, dockerfiles = builder.affected_jobs({root: {"app/main.py"}})
+    assert [job.get("path") for job in jobs] == ["repo/base:latest"]
+
+    jobs, dockerfiles = builder.affected_jobs({root: {".dockerignore"}})
+    assert [job.get("path") for job in jobs] == ["repo/base:latest", "repo/tools:latest"]
+    assert not dockerfiles